@@ -0,0 +1,60 @@
+import sys
+import time
+import random
+from tokenizer import Tokenizer
+from note_index import NoteIndex
+from memory_index import MemoryIndex
+from database_worker import DBWorker
+from migrations import SchemaMigrator
+from lexical_index import LexicalIndex
+from search_engine import SearchEngine
+from operation_stats import summarize
+from notes_repository import NotesRepository
+
+random.seed(0)
+
+def build_queries(notes_db, number_of_queries, words_per_query=3):
+    """ Queries made of words sampled from the stored notes so that they match something. """
+    vocabulary = []
+    for note in notes_db.iter_notes(fields=("title", "contents")):
+        vocabulary.extend(f"{note['title']} {note['contents']}".split())
+        if len(vocabulary) > 100000:
+            break
+    return [" ".join(random.choices(vocabulary, k=words_per_query)) for _ in range(number_of_queries)]
+
+def time_queries(search, queries):
+    timings = []
+    for query in queries:
+        start_time = time.perf_counter()
+        search(query)
+        timings.append((time.perf_counter() - start_time) * 1000)
+    return summarize(timings)
+
+def benchmark_lexical_engines(db_path, number_of_queries=200, k=10):
+    db_worker = DBWorker(db_path)
+    SchemaMigrator(db_worker).migrate()
+
+    notes_db = NotesRepository(db_worker)
+    note_index = NoteIndex(db_worker)
+    lexical_index = LexicalIndex(db_worker)
+    tokenizer = Tokenizer()
+
+    sql_engine = SearchEngine(notes_db, note_index, lexical_index, None, None, tokenizer)
+    memory_engine = SearchEngine(notes_db, note_index, lexical_index, None, None, tokenizer, MemoryIndex(note_index))
+    queries = build_queries(notes_db, number_of_queries)
+
+    engines = {"python bm25 (sql)": lambda query: sql_engine.lexical_search(query, k=k),
+               "python bm25 (memory)": lambda query: memory_engine.lexical_search(query, k=k),
+               "fts5 bm25": lambda query: sql_engine.fts_search(query, k)}
+
+    results = {name: time_queries(search, queries) for name, search in engines.items()}
+    db_worker.shutdown()
+    return results
+
+if __name__ == "__main__":
+
+    paths = sys.argv[1:] or ["database/one_thousand_notes.db", "database/ten_thousand_notes.db"]
+    for path in paths:
+        print(f"Lexical search latency in ms for {path}")
+        for name, summary in benchmark_lexical_engines(path).items():
+            print(f"  {name:<22} p50 {summary['p50']:.2f}  p95 {summary['p95']:.2f}  max {summary['max']:.2f}")
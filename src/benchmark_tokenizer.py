@@ -0,0 +1,32 @@
+import time
+import random
+from tokenizer import Tokenizer
+
+random.seed(0)
+
+def build_texts(number_of_texts=500, words_per_text=200, vocabulary_size=1000):
+    vocabulary = [f"word{i}" for i in range(vocabulary_size)]
+    return [" ".join(random.choices(vocabulary, k=words_per_text)) + ".\n" for _ in range(number_of_texts)]
+
+def benchmark_tokenizer(texts, rounds=5):
+    """ Best of `rounds` tokens per second for each tokenizer mode. """
+    tokenizer = Tokenizer()
+    number_of_tokens = sum(len(tokens) for tokens in tokenizer.tokenize_many(texts))
+    modes = {"tokenize": lambda: [tokenizer.tokenize(text) for text in texts],
+             "tokenize_many": lambda: tokenizer.tokenize_many(texts),
+             "iter_tokens": lambda: [tokenizer.count(tokenizer.iter_tokens(text)) for text in texts]}
+
+    rates = {}
+    for name, run in modes.items():
+        best = float("inf")
+        for _ in range(rounds):
+            start_time = time.perf_counter()
+            run()
+            best = min(best, time.perf_counter() - start_time)
+        rates[name] = number_of_tokens / best
+    return rates
+
+if __name__ == "__main__":
+
+    for name, rate in benchmark_tokenizer(build_texts()).items():
+        print(f"  {name:<14} {rate:,.0f} tokens per second")
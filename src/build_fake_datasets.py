@@ -1,57 +1,61 @@
 import time
 import random
-import pickle
-import ollama
 from wonderwords import RandomWord
-from database import Database
+from faiss_engine import Faiss
+from tokenizer import Tokenizer
+from note_index import NoteIndex
+from database_worker import DBWorker
+from migrations import SchemaMigrator
+from lamport_clock import LamportClock
+from search_engine import SearchEngine
+from lexical_index import LexicalIndex
+from note_importer import NoteImporter
+from device_identification import DeviceID
+from change_log_repository import ChangeLog
 from notes_repository import NotesRepository
+from embedding_provider import EmbeddingProvider
 
 random.seed(0)
 
-def build_fake_database(notes_repository, number_of_notes):
+def build_fake_notes(number_of_notes):
+    rand_words = RandomWord()
 
-    def build_a_note():
+    for _ in range(number_of_notes):
         title_size = random.randint(5, 10)
         body_size = random.randint(20, 200)
         tag_size = random.randint(1, 5)
 
-        rand_words = RandomWord()
-
         title = " ".join([rand_words.word() for _ in range(title_size)])
         body = " ".join([rand_words.word() for _ in range(body_size)])
         tag = " ".join([rand_words.word() for _ in range(tag_size)])
 
-        responce = ollama.embeddings(model="nomic-embed-text", prompt=f"{title} {body} {tag}")
-        embeddings = pickle.dumps(responce['embedding'])
-
-        return notes_repository.create_note(title, body, embeddings, tag)
-
-    for _ in range(number_of_notes):
-        _ = build_a_note()
-
-if __name__ == "__main__":
-
-    # This scritp takes about an hour to run on a core-i7 laptop.
+        yield title, body, tag
 
-    db = Database("database/ten_thousand_notes.db")
+def build_fake_database(db_path, number_of_notes):
+    db_worker = DBWorker(db_path)
+    SchemaMigrator(db_worker).migrate()
 
-    nr = NotesRepository(db)
-    nr.create_notes_table()
+    device_id = DeviceID(db_worker).get_or_generate_device_id()
+    lamport_clock = LamportClock(db_worker)
+    lamport_clock.initialize_lamport_clock()
 
-    start_time = time.perf_counter()
-    build_fake_database(nr, 10000)
-    end_time = time.perf_counter()
-    print(f"Time take to build database with 10000 notes was of: {end_time-start_time} seconds")
+    embedding_prov = EmbeddingProvider()
+    notes_db = NotesRepository(db_worker)
+    note_index = NoteIndex(db_worker)
+    lexical_index = LexicalIndex(db_worker)
+    change_log = ChangeLog(db_worker, device_id)
+    faiss_engine = Faiss(embedding_prov, notes_db)
+    search_engine = SearchEngine(notes_db, note_index, lexical_index, faiss_engine, embedding_prov, Tokenizer())
 
-    Database._instance = None
-    Database._initialized = None
+    importer = NoteImporter(db_worker, device_id, notes_db, search_engine, lexical_index,
+                            faiss_engine, embedding_prov, change_log, lamport_clock)
+    importer.import_notes(build_fake_notes(number_of_notes))
+    db_worker.shutdown()
 
-    db = Database("database/one_thousand_notes.db")
-
-    nr = NotesRepository(db)
-    nr.create_notes_table()
+if __name__ == "__main__":
 
-    start_time = time.perf_counter()
-    build_fake_database(nr, 1000)
-    end_time = time.perf_counter()
-    print(f"Time take to build database with 1000 notes was of: {end_time-start_time} seconds")
+    for path, number_of_notes in [("database/ten_thousand_notes.db", 10000), ("database/one_thousand_notes.db", 1000)]:
+        start_time = time.perf_counter()
+        build_fake_database(path, number_of_notes)
+        end_time = time.perf_counter()
+        print(f"Time take to build database with {number_of_notes} notes was of: {end_time-start_time} seconds")
@@ -38,12 +38,29 @@ class ChangeLog:
             connection.commit()
         self.db_worker.execute(_op, (note_id, operation_type, payload, lamport_timestamp, origin_device, op_id))
 
+    def log_operations(self, operations):
+        """ Bulk variant of log_operation for (note_id, operation_type, payload, lamport_timestamp, origin_device, op_id) tuples. """
+        def _op(connection, operations):
+            rows = []
+            for note_id, operation_type, payload, lamport_timestamp, origin_device, op_id in operations:
+                payload.pop("embeddings", None)
+                if op_id is None:
+                    op_id = str(uuid.uuid4())
+                rows.append((op_id, note_id, operation_type, self.device_id, json.dumps(payload), lamport_timestamp, origin_device))
+
+            cursor = connection.cursor()
+            cursor.executemany("""
+                    INSERT INTO change_log (op_id, note_id, operation_type, timestamp, device_id, payload, lamport_clock, origin_device)
+                    VALUES (?, ?, ?, CURRENT_TIMESTAMP, ?, ?, ?, ?)""", rows)
+            connection.commit()
+        self.db_worker.execute(_op, (list(operations),))
+
     def check_operation_exists(self, operation_id):
         def _op(connection, operation_id):
             cursor = connection.cursor()
             cursor.execute("SELECT EXISTS (SELECT 1 FROM change_log WHERE op_id = ?) AS value_exists", (operation_id,))
             return cursor.fetchone()['value_exists']
-        return self.db_worker.execute(_op, (operation_id,), wait=True)
+        return self.db_worker.execute(_op, (operation_id,), wait=True, read=True)
 
     def get_operations_since_timestamp(self, timestamp):
         def _op(connection, timestamp):
@@ -53,7 +70,7 @@ class ChangeLog:
                     """
             cursor.execute(query, (timestamp,))
             return cursor.fetchall()
-        return self.db_worker.execute(_op, args=(timestamp,), wait=True)
+        return self.db_worker.execute(_op, args=(timestamp,), wait=True, read=True)
 
     def get_operation_since_lamport(self, lamport_stamp):
         def _op(connection, lamport_stamp):
@@ -61,4 +78,4 @@ class ChangeLog:
             query = "SELECT * FROM change_log WHERE lamport_clock > ? ORDER BY lamport_clock ASC"
             cursor.execute(query, (lamport_stamp,))
             return cursor.fetchall()
-        return self.db_worker.execute(_op, args=(lamport_stamp,), wait=True)
+        return self.db_worker.execute(_op, args=(lamport_stamp,), wait=True, read=True)
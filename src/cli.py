@@ -1,9 +1,11 @@
-import pickle
 import logging
 from faiss_engine import Faiss
+from memory_index import MemoryIndex
+from query_cache import QueryCache
 from tokenizer import Tokenizer
 from note_index import NoteIndex
 from database_worker import DBWorker
+from migrations import SchemaMigrator
 from sync_manager import SyncManager
 from lamport_clock import LamportClock
 from search_engine import SearchEngine
@@ -12,9 +14,21 @@ from installation_wizard_cli import run_wizard_cli
 from device_identification import DeviceID
 from transport_layer import TransportLayer
 from change_log_repository import ChangeLog
-from notes_repository import NotesRepository
+from note_service import NoteService
+from embedding_queue import EmbeddingQueue
+from notes_repository import NotesRepository, DISPLAY_FIELDS
 from peer_to_peer import advertise, discover
 from embedding_provider import EmbeddingProvider
+from embedding_cache import EmbeddingCache
+
+# Searches show keyword matches alone rather than wait longer than this on Ollama.
+SEARCH_DEADLINE_MS = 800
+# Number of notes shown for a search.
+SEARCH_RESULTS = 10
+# Seconds before a single embedding request to Ollama is abandoned.
+EMBEDDING_TIMEOUT = 30
+# Seconds to spend finishing queued embeddings on exit.
+SHUTDOWN_DRAIN_TIMEOUT = 10
 
 def print_note(note):
     print("UUID: ", note['uuid'])
@@ -28,148 +42,116 @@ def print_note(note):
 
 def main(db_worker, device_id, transport_layer):
 
-    embedding_prov = EmbeddingProvider()
+    SchemaMigrator(db_worker).migrate()
+
+    embedding_cache = EmbeddingCache(db_worker)
+    embedding_prov = EmbeddingProvider(timeout=EMBEDDING_TIMEOUT, cache=embedding_cache)
 
     lamport_clock = LamportClock(db_worker)
     lamport_clock.initialize_lamport_clock()
 
     notes_db = NotesRepository(db_worker)
-    notes_db.create_notes_table()
-
     note_index = NoteIndex(db_worker)
-    note_index.create_word_index_table()
-
     lexical_index = LexicalIndex(db_worker)
-    lexical_index.create_lexical_table()
-
     change_log = ChangeLog(db_worker, device_id)
-    change_log.create_change_log_table()
 
     faiss_engine = Faiss(embedding_prov, notes_db)
 
+    memory_index = MemoryIndex(note_index)
+
     tokenizer = Tokenizer()
 
-    search_engine = SearchEngine(notes_db, note_index, lexical_index, faiss_engine, embedding_prov, tokenizer)
+    search_engine = SearchEngine(notes_db, note_index, lexical_index, faiss_engine, embedding_prov, tokenizer, memory_index, QueryCache())
+
+    embedding_queue = EmbeddingQueue(notes_db, embedding_prov, faiss_engine, search_engine)
+    embedding_queue.start()
+
+    note_service = NoteService(db_worker, device_id, notes_db, search_engine, lexical_index,
+                               faiss_engine, embedding_prov, change_log, lamport_clock, embedding_queue)
 
     synchronization_manager = SyncManager(db_worker, device_id, notes_db,
                                           change_log, lamport_clock,
                                           search_engine, lexical_index,
                                           faiss_engine, embedding_prov,
-                                          transport_layer)
-
-    synchronization_manager.create_last_sync_table()
-    synchronization_manager.initialize_sync_table()
-    synchronization_manager.create_lamport_last_sync_table()
-
-    while True:
-        user_choice = input(
-            "Choose an option:\n1. Enter a new note\n2. Search for a note\n3. Edit a note\n4. Delete a note\n5. List all\n6. Sync\nYour choice: ")
-
-        if user_choice == '1':
-            print("Enter the data for your note or leave it blank.")
-            title = input("Choose a title for your note: ")
-            contents = input("Enter the contents of your note: ")
-            tags = input("Enter comma separated tags for your note: ")
-
-            responce = embedding_prov.embed(f"{title} {contents} {tags}")
-            embeddings = pickle.dumps(responce['embedding'])
-
-            note_id = notes_db.create_note(title, contents, embeddings, tags)
-
-            search_engine.index_note(note_id)
-            lexical_index.index_note_for_lexical_search(note_id, title, contents)
-            faiss_engine.add_embedding(note_id, responce['embedding'])
-
-            # Convert the SQLite row object into a dictionary.
-            note_as_dict = dict(notes_db.get_note(note_id))
-
-            lamport_clock.increment_lamport_time()
-            lamport_clock.save_lamport_time_to_db()
-            change_log.log_operation(note_id, "create", note_as_dict, lamport_clock.now(), device_id)
-            print(f"You successfully entered a note with an ID of {note_id}")
-
-        elif user_choice == '2':
-            search_params = input("Enter search parameters: ")
-
-            top_results = search_engine.hybrid_search(search_params)
-
-            if top_results is None:
-                print("Database is empty, could not search.")
-                continue
-
-            if len(top_results) == 0:
-                print("No search results found.")
-                continue
-
-            for res in top_results:
-                note = notes_db.get_note(res[0])
-                print_note(note)
-
-        elif user_choice == '3':
-            note_id = input("Enter ID of note to edit: ")
-            title = input("Enter a new title (or leave blank to remain unchanged): ")
-            contents = input("Enter the new contents (or leave blank): ")
-            tags = input("Enter the new tags (or leave blank): ")
-            title = title if title.strip() != "" else None
-            contents = contents if contents.strip() != "" else None
-            tags = tags if tags.strip() != "" else None
-
-            old_note = notes_db.get_note(note_id)
-
-            change_as_json = {}
-            # Build the change log with only what's changed.
-            if title is not None:
-                change_as_json['title'] = title
-            if contents is not None:
-                change_as_json['contents'] = contents
-            if tags is not None:
-                change_as_json['tags'] = tags
-
-            # Build the note merging old and new contents.
-            if title is None:
-                title = old_note['title']
-            if contents is None:
-                contents = old_note['contents']
-            if tags is None:
-                tags = old_note['tags']
-
-            responce = embedding_prov.embed(f"{title} {contents} {tags}")
-            embeddings = pickle.dumps(responce['embedding'])
-
-            notes_db.update_note(note_id, title, contents, embeddings, tags)
-            lexical_index.index_note_for_lexical_search(note_id, title, contents)
-            search_engine.update_index(note_id)
-
-            faiss_engine.update_embedding(note_id, responce['embedding'])
-
-            change_as_json['embeddings'] = embeddings
-            lamport_clock.increment_lamport_time()
-            lamport_clock.save_lamport_time_to_db()
-            change_log.log_operation(note_id, "update", change_as_json, lamport_clock.now(), device_id)
-
-            print("Note updated.")
-
-        elif user_choice == '4':
-            note_id = input("Enter ID of note to delete: ")
-            notes_db.mark_note_as_deleted(note_id)
-            lexical_index.delete_note_from_lexical_search(note_id)
-            search_engine.remove_from_index(note_id)
-            faiss_engine.delete_embedding(note_id)
-            lamport_clock.increment_lamport_time()
-            lamport_clock.save_lamport_time_to_db()
-            change_log.log_operation(note_id, "delete", {"deleted": 1}, lamport_clock.now(), device_id)
-            print(f"Note {note_id} marked as deleted.")
-
-        elif user_choice == '5':
-            print("\nPrinting all notes in the database...\n")
-            for note in notes_db.list_all_notes():
-                print_note(note)
-
-        elif user_choice == '6':
-            synchronization_manager.sync()
-
-        else:
-            print("\nInvalid choice. Try again or press ctrl c to exit.\n")
+                                          transport_layer, note_service)
+
+    try:
+        while True:
+            user_choice = input(
+                "Choose an option:\n1. Enter a new note\n2. Search for a note\n3. Edit a note\n4. Delete a note\n5. List all\n6. Sync\nYour choice: ")
+
+            if user_choice == '1':
+                print("Enter the data for your note or leave it blank.")
+                title = input("Choose a title for your note: ")
+                contents = input("Enter the contents of your note: ")
+                tags = input("Enter comma separated tags for your note: ")
+
+                note_id = note_service.create_note(title, contents, tags)
+                print(f"You successfully entered a note with an ID of {note_id}")
+
+            elif user_choice == '2':
+                search_params = input("Enter search parameters: ")
+
+                top_results = search_engine.hybrid_search(search_params, k=SEARCH_RESULTS, deadline_ms=SEARCH_DEADLINE_MS)
+
+                if top_results is None:
+                    print("Database is empty, could not search.")
+                    continue
+
+                if len(top_results) == 0:
+                    print("No search results found.")
+                    continue
+
+                if top_results.partial:
+                    print("Semantic search unavailable, showing keyword matches only.\n")
+
+                for note in notes_db.get_notes([res[0] for res in top_results], fields=DISPLAY_FIELDS):
+                    print_note(note)
+
+            elif user_choice == '3':
+                note_id = input("Enter ID of note to edit: ")
+                title = input("Enter a new title (or leave blank to remain unchanged): ")
+                contents = input("Enter the new contents (or leave blank): ")
+                tags = input("Enter the new tags (or leave blank): ")
+                title = title if title.strip() != "" else None
+                contents = contents if contents.strip() != "" else None
+                tags = tags if tags.strip() != "" else None
+
+                # Only what's changed is rewritten, reindexed and logged.
+                changes = note_service.update_note(note_id, title, contents, tags)
+                if changes is None:
+                    print(f"Could not find note {note_id}.")
+                    continue
+                if not changes:
+                    print("Nothing to update.")
+                    continue
+
+                print("Note updated.")
+
+            elif user_choice == '4':
+                note_id = input("Enter ID of note to delete: ")
+                note_service.delete_note(note_id)
+                print(f"Note {note_id} marked as deleted.")
+
+            elif user_choice == '5':
+                print("\nPrinting all notes in the database...\n")
+                for note in notes_db.iter_notes(fields=DISPLAY_FIELDS):
+                    print_note(note)
+
+            elif user_choice == '6':
+                synchronization_manager.sync()
+
+            else:
+                print("\nInvalid choice. Try again or press ctrl c to exit.\n")
+    finally:
+        search_engine.shutdown()
+        # Finish the embeddings already queued, the rest resume on the next start.
+        embedding_queue.shutdown(timeout=SHUTDOWN_DRAIN_TIMEOUT)
+        embedding_prov.shutdown()
+        logging.info("Embedding queue stats: %s", embedding_queue.stats())
+        logging.info("Embedding cache stats: %s", embedding_cache.stats())
+        logging.info("Embedding request stats: %s", embedding_prov.stats())
+        logging.info("Query cache stats: %s", search_engine.query_cache.stats())
 
 if __name__ == "__main__":
 
@@ -201,6 +183,7 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         logging.info("Shutting down...")
         logging.info("Closing database ...")
+        logging.info("Database stats: %s", db_worker.stats())
         db_worker.shutdown()
         logging.info("Unregistering device ...")
         advertiser.unregister_service(info)
@@ -1,51 +1,396 @@
 import os
+import time
 import queue
 import sqlite3
 import logging
 import threading
 from pathlib import Path
+from concurrent.futures import Future
+from operation_stats import OperationStats
+from contextlib import contextmanager
 
 DATABASE_PATH = os.environ.get("DB_PATH", 'database/database.db')
 
+# Markers placed on the writer queue to open and close a transaction.
+_TRANSACTION_BEGIN = object()
+_TRANSACTION_END = object()
+# Returned by _next_write() when the open group commit batch is due.
+_COMMIT_BATCH = object()
+
+class _WriterConnection:
+    """ Writer connection handed to ops. Lets DBWorker decide when commits happen. """
+    def __init__(self, connection):
+        self._connection = connection
+        self.defer_commits = False
+
+    def commit(self):
+        if not self.defer_commits:
+            self._connection.commit()
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
 class DBWorker:
-    def __init__(self, db_path=DATABASE_PATH):
+    """
+    Serializes database access through a single writer thread.
+
+    With wal=True the database is switched to WAL journaling and `readers`
+    extra threads, each owning a read-only connection, serve calls made with
+    read=True. Reads then run in parallel with writes and with each other.
+    A read waits for the writes its own thread queued before it, so callers
+    keep seeing their own changes without queueing behind other threads'
+    writes.
+
+    With group_commit=True the commits issued by individual ops are merged:
+    queued writes share one commit until `max_batch_ops` ops have run or
+    `commit_interval` seconds have passed. Durability guarantees:
+      - A call made with wait=True only returns once the commit containing
+        its write is on disk, so an acknowledged write is never lost.
+      - A call made with wait=False may sit in an open batch for up to
+        `commit_interval` seconds and is lost if the process dies first.
+      - A failing op is rolled back on its own and does not affect the rest
+        of the batch.
+
+    Every op is timed under its name (the repository method that queued it):
+    time spent waiting in the queue, time spent running and rows returned.
+    Ops running for at least `slow_op_threshold` seconds are logged. See
+    stats() for percentiles and queue depths.
+    """
+    def __init__(self, db_path=DATABASE_PATH, wal=False, readers=0,
+                 group_commit=False, commit_interval=0.05, max_batch_ops=500,
+                 slow_op_threshold=0.1):
         self.db_path = db_path
+        self.wal = wal
+        self.readers = readers if wal else 0
+        self.group_commit = group_commit
+        self.commit_interval = commit_interval
+        self.max_batch_ops = max_batch_ops
         self.queue = queue.Queue()
+        self.read_queue = queue.Queue()
+
+        self._ready = threading.Event()
+        self._local = threading.local()
+        self._writes = threading.Condition()
+        self._submitted_writes = 0
+        self._completed_writes = 0
+
+        self.operation_stats = OperationStats(slow_threshold=slow_op_threshold)
+        # Peak queue depths, updated under self._writes.
+        self._max_depth = {"write": 0, "read": 0}
+
+        # Group commit state, only touched by the writer thread.
+        self._batch_ops = 0
+        self._batch_started = None
+        self._batch_waiting = []
+
         self.thread = threading.Thread(target=self._run, daemon=True)
         self.thread.start()
 
+        self.reader_threads = []
+        for _ in range(self.readers):
+            reader = threading.Thread(target=self._run_reader, daemon=True)
+            reader.start()
+            self.reader_threads.append(reader)
+
     def _run(self):
         if not os.path.isdir(self.db_path):
             path = Path(self.db_path)
             path.parent.mkdir(parents=True, exist_ok=True)
-        self.connection = sqlite3.connect(self.db_path)
-        self.connection.row_factory = sqlite3.Row
+        connection = sqlite3.connect(self.db_path)
+        connection.row_factory = sqlite3.Row
+        if self.wal:
+            connection.execute("PRAGMA journal_mode=WAL")
+        self.connection = _WriterConnection(connection)
+        self.connection.defer_commits = self.group_commit
+        self._ready.set()
         logging.info("Database worker thread started.")
 
         while True:
-            item = self.queue.get()
+            item = self._next_write()
             if item is None:
                 break
 
-            fn, args, kwargs, result_q = item
-            try:
-                result = fn(self.connection, *args, **kwargs)
-                if result_q:
-                    result_q.put(result)
-            except Exception as e:
-                logging.exception("Database operation failed.")
-                if result_q:
-                    result_q.put(e)
-
-    def execute(self, fn, args=(), wait=False, kwargs={}):
-        result_q = queue.Queue() if wait else None
-        self.queue.put((fn, args, kwargs, result_q))
-        if wait:
-            result = result_q.get()
-            if isinstance(result, Exception):
-                raise result
+            if item is _COMMIT_BATCH:
+                self._commit_batch()
+                continue
+
+            if item[0] is _TRANSACTION_BEGIN:
+                self._commit_batch()
+                self._run_transaction(item[1][0], item[5])
+                self._complete_writes(1)
+                continue
+
+            fn, args, kwargs, future, read, _ = item
+
+            if not self.group_commit or (read and not self._batch_ops):
+                self._deliver(future, self._process(self.connection, item))
+                self._complete_writes(1)
+                continue
+
+            if not self._batch_ops:
+                if not self.connection.in_transaction:
+                    self.connection.execute("BEGIN")
+                self._batch_started = time.monotonic()
+
+            result = self._process(self.connection, item, savepoint=not read)
+            self._batch_ops += 1
+            if read:
+                self._deliver(future, result)
+            elif future:
+                self._batch_waiting.append((future, result))
+
+            if self._batch_ops >= self.max_batch_ops:
+                self._commit_batch()
+
+        self._commit_batch()
+
+    def _next_write(self):
+        """ Returns the next writer queue item, or _COMMIT_BATCH when the open batch is due. """
+        if not self._batch_ops:
+            return self.queue.get()
+
+        remaining = self._batch_started + self.commit_interval - time.monotonic()
+        try:
+            if remaining <= 0:
+                return _COMMIT_BATCH
+            # Callers are blocked on this batch, don't make them wait for the window.
+            if self._batch_waiting:
+                return self.queue.get_nowait()
+            return self.queue.get(timeout=remaining)
+        except queue.Empty:
+            return _COMMIT_BATCH
+
+    def _commit_batch(self):
+        if not self._batch_ops:
+            return
+
+        waiting = self._batch_waiting
+        ops = self._batch_ops
+        self._batch_waiting = []
+        self._batch_ops = 0
+
+        start = time.perf_counter()
+        failed = False
+        try:
+            self.connection._connection.commit()
+        except Exception as e:
+            logging.exception("Group commit failed.")
+            self.connection.rollback()
+            waiting = [(future, e) for future, _ in waiting]
+            failed = True
+        # Reports ops per commit as the size, and how long the batch stayed open as the wait.
+        self.operation_stats.record("DBWorker.commit", time.monotonic() - self._batch_started,
+                                    time.perf_counter() - start, ops, failed)
+
+        for future, result in waiting:
+            self._deliver(future, result)
+        self._complete_writes(ops)
+
+    def _run_transaction(self, tx_queue, enqueued_at):
+        start = time.perf_counter()
+        ops = 0
+        self.connection.defer_commits = True
+        failure = None
+        try:
+            # Don't let writes an op left uncommitted leak into this unit of work.
+            if self.connection.in_transaction:
+                self.connection._connection.commit()
+            self.connection.execute("BEGIN IMMEDIATE")
+        except sqlite3.Error as e:
+            logging.exception("Could not start transaction.")
+            failure = e
+
+        try:
+            while True:
+                item = tx_queue.get()
+                if item[0] is _TRANSACTION_END:
+                    _, commit, done = item
+                    break
+
+                if failure is not None:
+                    self._deliver(item[3], failure)
+                    continue
+
+                result = self._process(self.connection, item)
+                ops += 1
+                if isinstance(result, Exception) and failure is None:
+                    failure = result
+                self._deliver(item[3], result)
+
+            # Any failed op aborts the whole unit of work.
+            if commit and failure is None:
+                try:
+                    self.connection._connection.commit()
+                except Exception as e:
+                    logging.exception("Transaction commit failed.")
+                    self.connection.rollback()
+                    failure = e
+            elif self.connection.in_transaction:
+                self.connection.rollback()
+            done.set_result(failure)
+        finally:
+            self.connection.defer_commits = self.group_commit
+            self.operation_stats.record("DBWorker.transaction", start - enqueued_at,
+                                        time.perf_counter() - start, ops, failure is not None)
+
+    def _run_reader(self):
+        self._ready.wait()
+        uri = Path(self.db_path).resolve().as_uri() + "?mode=ro"
+        connection = sqlite3.connect(uri, uri=True)
+        connection.row_factory = sqlite3.Row
+
+        while True:
+            item = self.read_queue.get()
+            if item is None:
+                break
+
+            barrier, item = item
+            with self._writes:
+                self._writes.wait_for(lambda: self._completed_writes >= barrier)
+
+            self._deliver(item[3], self._process(connection, item))
+
+        connection.close()
+
+    def _process(self, connection, item, savepoint=False):
+        fn, args, kwargs, future, _, enqueued_at = item
+        # The caller gave up on this call before it ran.
+        if future and not future.set_running_or_notify_cancel():
+            return None
+        start = time.perf_counter()
+        try:
+            if savepoint:
+                connection.execute("SAVEPOINT op")
+            result = fn(connection, *args, **kwargs)
+            if savepoint:
+                connection.execute("RELEASE op")
+            self._record(fn, enqueued_at, start, result)
             return result
+        except Exception as e:
+            self._record(fn, enqueued_at, start, None, failed=True)
+            logging.exception("Database operation failed.")
+            if savepoint:
+                try:
+                    connection.execute("ROLLBACK TO op")
+                    connection.execute("RELEASE op")
+                except sqlite3.Error:
+                    logging.exception("Could not roll back failed operation.")
+            return e
+
+    def _record(self, fn, enqueued_at, start, result, failed=False):
+        if result is None:
+            size = 0
+        elif isinstance(result, (list, tuple)) and not isinstance(result, sqlite3.Row):
+            size = len(result)
+        else:
+            size = 1
+        self.operation_stats.record(_operation_name(fn), start - enqueued_at,
+                                    time.perf_counter() - start, size, failed)
+
+    def _deliver(self, future, result):
+        if not future or future.done():
+            return
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+    def _complete_writes(self, count):
+        with self._writes:
+            self._completed_writes += count
+            self._writes.notify_all()
+
+    def _put_write(self, item):
+        with self._writes:
+            self._submitted_writes += 1
+            self.queue.put(item)
+            self._max_depth["write"] = max(self._max_depth["write"], self.queue.qsize())
+            # Writes complete in queue order, so reads from this thread only
+            # have to wait until this one is done.
+            self._local.last_write = self._submitted_writes
+
+    def execute(self, fn, args=(), wait=False, kwargs={}, read=False):
+        if wait:
+            return self.execute_async(fn, args, kwargs, read).result()
+        self._submit((fn, args, kwargs, None, read, time.perf_counter()))
+
+    def execute_async(self, fn, args=(), kwargs={}, read=False):
+        """
+        Queues fn and returns a concurrent.futures.Future for its result, so
+        several independent calls can be in flight at once. Use
+        asyncio.wrap_future() to await it from a coroutine.
+        """
+        future = Future()
+        self._submit((fn, args, kwargs, future, read, time.perf_counter()))
+        return future
+
+    def execute_batch(self, calls, read=False):
+        """ Submits every (fn, args) pair before waiting on any, returns the results in order. """
+        futures = [self.execute_async(fn, args, read=read) for fn, args in calls]
+        return [future.result() for future in futures]
+
+    def _submit(self, item):
+        read = item[4]
+        tx_queue = getattr(self._local, "tx_queue", None)
+        if tx_queue is not None:
+            tx_queue.put(item)
+        elif read and self.readers:
+            barrier = getattr(self._local, "last_write", 0)
+            self.read_queue.put((barrier, item))
+            with self._writes:
+                self._max_depth["read"] = max(self._max_depth["read"], self.read_queue.qsize())
+        else:
+            self._put_write(item)
+
+    def stats(self):
+        """
+        Returns live and peak queue depths plus, per operation, call and
+        error counts, rows returned and p50/p95/p99/max of the queue wait
+        and run time in seconds, and the recent slow operations.
+        """
+        stats = self.operation_stats.snapshot()
+        stats["queues"] = {"write": {"depth": self.queue.qsize(), "max_depth": self._max_depth["write"]},
+                           "read": {"depth": self.read_queue.qsize(), "max_depth": self._max_depth["read"]}}
+        return stats
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs every execute() made by this thread inside the block as one
+        atomic unit with a single commit. The writer thread is reserved for
+        the block, so other threads' writes wait until it ends. If the block
+        raises, or any op inside it fails, everything is rolled back.
+        Nested transaction() blocks join the outer one.
+        """
+        if getattr(self._local, "tx_queue", None) is not None:
+            yield
+            return
+
+        tx_queue = queue.Queue()
+        self._put_write((_TRANSACTION_BEGIN, (tx_queue,), {}, None, False, time.perf_counter()))
+        self._local.tx_queue = tx_queue
+
+        commit = False
+        try:
+            yield
+            commit = True
+        finally:
+            self._local.tx_queue = None
+            done = Future()
+            tx_queue.put((_TRANSACTION_END, commit, done))
+            failure = done.result()
+            if commit and failure is not None:
+                raise failure
 
     def shutdown(self):
+        for _ in self.reader_threads:
+            self.read_queue.put(None)
+        for reader in self.reader_threads:
+            reader.join()
         self.queue.put(None)
         self.thread.join()
+
+def _operation_name(fn):
+    """ Names an op after the method that defined it, e.g. NoteIndex.retrieve_similar_tokens. """
+    name = getattr(fn, "__qualname__", repr(fn))
+    return name.removesuffix(".<locals>._op")
@@ -0,0 +1,140 @@
+import time
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from embedding_codec import encode_embedding, decode_embedding
+
+def normalize_text(text):
+    """ Unicode and whitespace insensitive form of a text, used in cache keys. """
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+def cache_key(model, text):
+    return hashlib.sha256(f"{model}\n{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    """
+    Content addressed store of embeddings keyed by model and text, kept in
+    the embedding_cache table so a text is embedded once per database
+    rather than once per run. The most recently used vectors are also held
+    in an in-memory LRU of `max_memory_entries`. The table is trimmed to
+    its `max_entries` most recently used rows.
+    """
+    def __init__(self, db_worker, max_memory_entries=1024, max_entries=50000):
+        self.db_worker = db_worker
+        self.max_memory_entries = max_memory_entries
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._stored = None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _remember(self, key, blob):
+        """ Adds to the in-memory LRU, the caller holds the lock. """
+        self._entries[key] = blob
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_memory_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, model, text):
+        """ Returns the cached vector for `text` as a list of floats, or None. """
+        return self.get_many(model, [text])[0]
+
+    def get_many(self, model, texts):
+        """ Cached vectors for `texts` in order, None for those not cached. One round trip for the ones not in memory. """
+        keys = [cache_key(model, text) for text in texts]
+        blobs = {}
+        with self._lock:
+            for key in keys:
+                blob = self._entries.get(key)
+                if blob is not None:
+                    self._entries.move_to_end(key)
+                    self.memory_hits += 1
+                    blobs[key] = blob
+        unknown = list(dict.fromkeys(key for key in keys if key not in blobs))
+
+        if unknown:
+            def _op(connection, keys):
+                cursor = connection.cursor()
+                placeholders = ",".join("?" * len(keys))
+                cursor.execute(f"SELECT key, embedding FROM embedding_cache WHERE key IN ({placeholders})", keys)
+                return {row[0]: row[1] for row in cursor.fetchall()}
+            # Batched under SQLite's default limit of 999 bound parameters.
+            stored = {}
+            for rows in self.db_worker.execute_batch([(_op, (unknown[start:start + 900],))
+                                                      for start in range(0, len(unknown), 900)], read=True):
+                stored.update(rows)
+            if stored:
+                self._touch(list(stored))
+
+            with self._lock:
+                for key in unknown:
+                    if key in stored:
+                        self.disk_hits += 1
+                        self._remember(key, stored[key])
+                    else:
+                        self.misses += 1
+            blobs.update(stored)
+
+        return [decode_embedding(blobs[key]).tolist() if key in blobs else None for key in keys]
+
+    def _touch(self, keys):
+        """ Queues the last_used update of rows read from disk, nothing waits on it. """
+        def _op(connection, keys, now):
+            connection.cursor().executemany("UPDATE embedding_cache SET last_used = ? WHERE key = ?", [(now, key) for key in keys])
+            connection.commit()
+        self.db_worker.execute(_op, args=(keys, time.time()))
+
+    def put(self, model, text, vector):
+        self.put_many(model, [(text, vector)])
+
+    def put_many(self, model, items):
+        """ Stores (text, vector) pairs in one round trip. """
+        rows = {cache_key(model, text): encode_embedding(vector, model) for text, vector in items}
+        if not rows:
+            return
+        with self._lock:
+            for key, blob in rows.items():
+                self._remember(key, blob)
+
+        def _op(connection, rows, model, now, max_entries):
+            cursor = connection.cursor()
+            inserted = 0
+            for key, blob in rows.items():
+                cursor.execute("INSERT OR IGNORE INTO embedding_cache (key, model, embedding, last_used) VALUES (?, ?, ?, ?)",
+                               (key, model, blob, now))
+                if cursor.rowcount:
+                    inserted += 1
+                else:
+                    cursor.execute("UPDATE embedding_cache SET embedding = ?, last_used = ? WHERE key = ?", (blob, now, key))
+            # Row count is only read once, then tracked. It is only ever
+            # touched from the database thread.
+            if self._stored is None:
+                cursor.execute("SELECT COUNT(*) FROM embedding_cache")
+                self._stored = cursor.fetchone()[0]
+            else:
+                self._stored += inserted
+            evicted = 0
+            if self._stored > max_entries:
+                cursor.execute("""DELETE FROM embedding_cache WHERE key IN
+                                  (SELECT key FROM embedding_cache ORDER BY last_used ASC LIMIT ?)""",
+                               (self._stored - max_entries,))
+                evicted = cursor.rowcount
+                self._stored -= evicted
+            connection.commit()
+            return evicted
+        evicted = self.db_worker.execute(_op, args=(rows, model, time.time(), self.max_entries), wait=True)
+        if evicted:
+            with self._lock:
+                self.evictions += evicted
+
+    def stats(self):
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {"memory_hits": self.memory_hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                    "hit_rate": hits / lookups if lookups else None,
+                    "evictions": self.evictions, "memory_entries": len(self._entries)}
@@ -0,0 +1,63 @@
+import pickle
+import struct
+import numpy as np
+
+# Model the stored embeddings are computed with, the default for
+# EmbeddingProvider and for the model id written with each vector.
+EMBEDDING_MODEL = "nomic-embed-text"
+
+# Stored embedding layout: magic, dimension, length of the model id, the
+# model id (utf-8) and then the vector as little-endian float32 values.
+MAGIC = b"NEv1"
+HEADER = struct.Struct("<4sIH")
+FLOAT32 = np.dtype("<f4")
+
+def encode_embedding(vector, model=EMBEDDING_MODEL):
+    values = np.ascontiguousarray(vector, dtype=FLOAT32).reshape(-1)
+    model_id = model.encode("utf-8")
+    return HEADER.pack(MAGIC, values.shape[0], len(model_id)) + model_id + values.tobytes()
+
+def is_encoded(blob):
+    return blob is not None and bytes(blob[:len(MAGIC)]) == MAGIC
+
+def is_legacy_pickle(blob):
+    # Older versions stored pickle.dumps(list_of_floats), protocol 2 or newer.
+    return blob is not None and bytes(blob[:1]) == b"\x80"
+
+def _parse_header(blob):
+    _, dimension, model_length = HEADER.unpack_from(blob)
+    return dimension, model_length, HEADER.size + model_length
+
+def decode_embedding(blob):
+    """
+    Returns the stored vector as a read-only float32 array that views the
+    blob's memory without copying. Pickled lists written by older versions
+    are still understood. None stays None.
+    """
+    if blob is None:
+        return None
+    if is_encoded(blob):
+        dimension, _, offset = _parse_header(blob)
+        return np.frombuffer(blob, dtype=FLOAT32, count=dimension, offset=offset)
+    if is_legacy_pickle(blob):
+        return np.asarray(pickle.loads(blob), dtype=FLOAT32)
+    raise ValueError("Unknown embedding format.")
+
+def embedding_model(blob):
+    """ Model id stored with the vector, None for legacy pickles. """
+    if not is_encoded(blob):
+        return None
+    _, model_length, offset = _parse_header(blob)
+    return bytes(blob[HEADER.size:offset]).decode("utf-8")
+
+def embedding_payload(blob):
+    """
+    Bytes that identify the vector regardless of how it was stored, used for
+    note hashes. Blobs that are neither format are returned unchanged.
+    """
+    if is_encoded(blob):
+        _, _, offset = _parse_header(blob)
+        return bytes(blob[offset:])
+    if is_legacy_pickle(blob):
+        return decode_embedding(blob).tobytes()
+    return blob
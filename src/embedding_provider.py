@@ -1,6 +1,414 @@
+import time
+import heapq
+import asyncio
 import ollama
+import logging
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from operation_stats import OperationStats
+from embedding_codec import EMBEDDING_MODEL
+
+# Request priorities, lower runs first. Search queries are interactive,
+# embedding notes is bulk work.
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+def _plan_batches(texts, vectors, batch_size):
+    """ Positions of each text still missing a vector, and those texts split into batches. """
+    positions = {}
+    for position, (text, vector) in enumerate(zip(texts, vectors)):
+        if vector is None:
+            positions.setdefault(text, []).append(position)
+    missing = list(positions)
+    return positions, [missing[start:start + batch_size] for start in range(0, len(missing), batch_size)]
+
+def _check_batch(batch, response):
+    embeddings = response['embeddings']
+    if len(embeddings) != len(batch):
+        raise ValueError(f"Expected {len(batch)} embeddings, got {len(embeddings)}.")
+    return embeddings
+
+def _fill(vectors, positions, batch, embeddings):
+    for text, vector in zip(batch, embeddings):
+        for position in positions[text]:
+            vectors[position] = vector
+
+class EmbeddingUnavailableError(Exception):
+    """ Raised without calling Ollama while the circuit breaker is open. """
+    def __init__(self, retry_after):
+        super().__init__(f"Embedding calls are paused for another {retry_after:.1f} seconds after repeated failures.")
+        self.retry_after = retry_after
+
+class RequestGate:
+    """
+    Lets at most `max_in_flight` requests run at once. Waiting requests are
+    let in by priority, then in arrival order. Threads wait in acquire(),
+    coroutines in acquire_async(), both in the same line.
+    """
+    def __init__(self, max_in_flight):
+        self.max_in_flight = max_in_flight
+        self._lock = threading.Lock()
+        # Heap of (priority, order, wake), wake() tells the waiter it is in.
+        self._waiting = []
+        self._order = itertools.count()
+        self.in_flight = 0
+        self.max_waiting = 0
+
+    def _enqueue(self, priority, wake):
+        with self._lock:
+            entry = (priority, next(self._order), wake)
+            heapq.heappush(self._waiting, entry)
+            self.max_waiting = max(self.max_waiting, len(self._waiting))
+            self._admit()
+            return entry
+
+    def _admit(self):
+        """ Lets in waiters while there is room, the caller holds the lock. """
+        while self._waiting and self.in_flight < self.max_in_flight:
+            _, _, wake = heapq.heappop(self._waiting)
+            self.in_flight += 1
+            wake()
+
+    def acquire(self, priority):
+        admitted = threading.Event()
+        self._enqueue(priority, admitted.set)
+        admitted.wait()
+
+    async def acquire_async(self, priority):
+        """ acquire() for coroutines, the event loop keeps running while they wait. """
+        loop = asyncio.get_running_loop()
+        admitted = loop.create_future()
+        def _wake():
+            loop.call_soon_threadsafe(lambda: admitted.done() or admitted.set_result(None))
+        entry = self._enqueue(priority, _wake)
+        try:
+            await admitted
+        except asyncio.CancelledError:
+            with self._lock:
+                if entry in self._waiting:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                    entry = None
+            if entry is not None:
+                # Let in just before being cancelled, hand the slot back.
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+            self._admit()
+
+    def waiting(self):
+        """ Number of requests waiting, per priority. """
+        with self._lock:
+            counts = dict.fromkeys(PRIORITY_NAMES.values(), 0)
+            for priority, _, _ in self._waiting:
+                name = PRIORITY_NAMES.get(priority, str(priority))
+                counts[name] = counts.get(name, 0) + 1
+            return counts
 
 class EmbeddingProvider:
+    """
+    Wraps Ollama's batch embedding endpoint with a circuit breaker. After
+    `failure_threshold` consecutive failed calls the circuit opens and
+    embed() raises EmbeddingUnavailableError immediately for `cooldown`
+    seconds. The first call after that is let through as a probe and the
+    others keep raising until it returns: success closes the circuit,
+    failure opens it again. `timeout` bounds each HTTP
+    request in seconds, None waits as long as Ollama takes.
+
+    Requests share one Ollama client, and with it one pool of HTTP
+    connections, aembed_many one ollama.AsyncClient per event loop. At most `max_in_flight` of them run at once and waiting
+    requests go in priority order, so a search query isn't stuck behind a
+    backlog of notes being embedded. A failed request is retried `retries`
+    times, waiting `retry_delay` seconds and doubling the wait each time,
+    before it counts towards the circuit breaker.
+
+    With an EmbeddingCache, texts it already holds are answered from it,
+    even while the circuit is open, and new vectors are added to it.
+    """
+    model = EMBEDDING_MODEL
+
+    def __init__(self, failure_threshold=3, cooldown=30.0, timeout=None, cache=None,
+                 max_in_flight=2, retries=2, retry_delay=0.25):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.timeout = timeout
+        self._client = ollama.Client(timeout=timeout) if timeout is not None else None
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open_until = 0.0
+        self._probing = False
+        self.cache = cache
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.retried = 0
+        self.gate = RequestGate(max_in_flight)
+        self.request_stats = OperationStats()
+        # Threads sending the batches of an embed_many call side by side, and
+        # threads running embed_many_async calls. Started on first use.
+        self._batch_executor = None
+        self._call_executor = None
+        # One ollama.AsyncClient per event loop for aembed_many, an httpx
+        # session can't be shared between loops.
+        self._async_clients = {}
+
+    def _async_client(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                # Loops that have been closed took their connections with them.
+                for closed in [other for other in self._async_clients if other.is_closed()]:
+                    del self._async_clients[closed]
+                client = self._async_clients[loop] = ollama.AsyncClient(timeout=self.timeout)
+            return client
+
+    async def aclose(self):
+        """ Closes the running event loop's HTTP session for aembed_many. """
+        with self._lock:
+            client = self._async_clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.close()
+
+    def _executors(self):
+        with self._lock:
+            if self._batch_executor is None:
+                self._batch_executor = ThreadPoolExecutor(max_workers=self.gate.max_in_flight, thread_name_prefix="embedding-batch")
+                # Not bounded by the gate, calls have to reach it to be ordered by priority.
+                self._call_executor = ThreadPoolExecutor(thread_name_prefix="embedding")
+            return self._batch_executor, self._call_executor
+
+    def shutdown(self):
+        """
+        Stops the request threads once the requests already sent have
+        finished, and closes the aembed_many sessions of loops still open.
+        """
+        with self._lock:
+            executors = [self._call_executor, self._batch_executor]
+            self._batch_executor = self._call_executor = None
+            async_clients = self._async_clients
+            self._async_clients = {}
+        for executor in executors:
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
+        for loop, client in async_clients.items():
+            if loop.is_closed():
+                continue
+            if loop.is_running():
+                asyncio.run_coroutine_threadsafe(client.close(), loop)
+            else:
+                loop.run_until_complete(client.close())
+
+    def _enter(self, probe):
+        """ Raises while the circuit is open, returns whether the call is the half-open probe. """
+        with self._lock:
+            remaining = self._open_until - time.monotonic()
+            if remaining > 0:
+                raise EmbeddingUnavailableError(remaining)
+            if self._open_until and not probe:
+                # Half open, only one call finds out if Ollama is back.
+                if self._probing:
+                    raise EmbeddingUnavailableError(self.cooldown)
+                self._probing = probe = True
+            return probe
+
+    def _record(self, priority, queued, started, size, failure):
+        self.request_stats.record(PRIORITY_NAMES.get(priority, str(priority)), started - queued,
+                                  time.perf_counter() - started, size, failed=failure is not None)
+
+    def _succeeded(self):
+        with self._lock:
+            self._failures = 0
+            self._open_until = 0.0
+
+    def _retrying(self, attempt, delay, failure):
+        with self._lock:
+            self.retried += 1
+        logging.info(f"Embedding request failed, retry {attempt} of {self.retries} in {delay} seconds: {failure}")
+
+    def _failed(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._open_until = time.monotonic() + self.cooldown
+                logging.warning(f"Embedding failed {self._failures} times in a row, pausing calls for {self.cooldown} seconds.")
+
+    def _end_probe(self, probe):
+        if probe:
+            with self._lock:
+                self._probing = False
+
+    def _call(self, request, priority=BULK, size=1):
+        """ Runs one Ollama request through the circuit breaker, the request gate and the retry policy. """
+        delay = self.retry_delay
+        attempt = 0
+        probe = False
+        try:
+            while True:
+                probe = self._enter(probe)
+                failure = None
+                queued = time.perf_counter()
+                self.gate.acquire(priority)
+                started = time.perf_counter()
+                try:
+                    response = request(self._client if self._client is not None else ollama)
+                except Exception as e:
+                    failure = e
+                finally:
+                    self.gate.release()
+                    self._record(priority, queued, started, size, failure)
+
+                if failure is None:
+                    self._succeeded()
+                    return response
+                if attempt < self.retries:
+                    attempt += 1
+                    self._retrying(attempt, delay, failure)
+                    time.sleep(delay)
+                    delay *= 2
+                    continue
+                self._failed()
+                raise failure
+        finally:
+            self._end_probe(probe)
+
+    async def _acall(self, request, client, priority=BULK, size=1):
+        """ _call for a coroutine `request` sent with an ollama.AsyncClient. """
+        delay = self.retry_delay
+        attempt = 0
+        probe = False
+        try:
+            while True:
+                probe = self._enter(probe)
+                failure = None
+                queued = time.perf_counter()
+                await self.gate.acquire_async(priority)
+                started = time.perf_counter()
+                try:
+                    response = await request(client)
+                except Exception as e:
+                    failure = e
+                finally:
+                    self.gate.release()
+                    self._record(priority, queued, started, size, failure)
+
+                if failure is None:
+                    self._succeeded()
+                    return response
+                if attempt < self.retries:
+                    attempt += 1
+                    self._retrying(attempt, delay, failure)
+                    await asyncio.sleep(delay)
+                    delay *= 2
+                    continue
+                self._failed()
+                raise failure
+        finally:
+            self._end_probe(probe)
+
+    def embed(self, text, model=EMBEDDING_MODEL, max_chars=5000, priority=INTERACTIVE):
+        return {"embedding": self.embed_many([text], model, max_chars, priority=priority)[0]}
+
+    def embed_many(self, texts, model=EMBEDDING_MODEL, max_chars=5000, batch_size=64, priority=BULK):
+        """
+        Embeds `texts` with one request per `batch_size` of them and returns
+        the vectors in the same order. Batches are sent side by side, as
+        many at once as the request gate allows. Cached and repeated texts
+        are not sent. When a batch fails its texts get None and the other
+        batches still run, the error is raised only if no text could be
+        embedded.
+        """
+        texts = [text[:max_chars] for text in texts]
+        vectors = self.cache.get_many(model, texts) if self.cache is not None else [None] * len(texts)
+        positions, batches = _plan_batches(texts, vectors, batch_size)
+
+        def _send(batch):
+            return _check_batch(batch, self._call(lambda api: api.embed(model=model, input=batch), priority, len(batch)))
+
+        # A single batch, the common case, is sent from the calling thread.
+        futures = None
+        if len(batches) > 1:
+            batch_executor, _ = self._executors()
+            futures = [batch_executor.submit(_send, batch) for batch in batches]
+
+        error = None
+        for index, batch in enumerate(batches):
+            try:
+                embeddings = futures[index].result() if futures else _send(batch)
+            except Exception as e:
+                logging.warning(f"Embedding a batch of {len(batch)} texts failed: {e}")
+                error = e
+                continue
+            _fill(vectors, positions, batch, embeddings)
+            if self.cache is not None:
+                self.cache.put_many(model, zip(batch, embeddings))
+
+        if error is not None and all(vector is None for vector in vectors):
+            raise error
+        return vectors
+
+    def embed_many_async(self, texts, model=EMBEDDING_MODEL, max_chars=5000, batch_size=64, priority=BULK):
+        """
+        Runs embed_many on the provider's threads and returns a
+        concurrent.futures.Future for the vectors. Coroutines can use
+        aembed_many instead.
+        """
+        _, call_executor = self._executors()
+        return call_executor.submit(self.embed_many, texts, model, max_chars, batch_size, priority)
+
+    async def aembed_many(self, texts, model=EMBEDDING_MODEL, max_chars=5000, batch_size=64, priority=BULK):
+        """
+        embed_many as a coroutine. The batches are sent with an
+        ollama.AsyncClient, through the same circuit breaker and request
+        gate as the other calls. Cache lookups run on a worker thread.
+        """
+        texts = [text[:max_chars] for text in texts]
+        if self.cache is not None:
+            vectors = await asyncio.to_thread(self.cache.get_many, model, texts)
+        else:
+            vectors = [None] * len(texts)
+        positions, batches = _plan_batches(texts, vectors, batch_size)
+        if not batches:
+            return vectors
+
+        client = self._async_client()
+
+        async def _send(batch):
+            return _check_batch(batch, await self._acall(lambda api: api.embed(model=model, input=batch),
+                                                         client, priority, len(batch)))
+        results = await asyncio.gather(*(_send(batch) for batch in batches), return_exceptions=True)
+
+        error = None
+        for batch, embeddings in zip(batches, results):
+            if isinstance(embeddings, Exception):
+                logging.warning(f"Embedding a batch of {len(batch)} texts failed: {embeddings}")
+                error = embeddings
+                continue
+            _fill(vectors, positions, batch, embeddings)
+            if self.cache is not None:
+                await asyncio.to_thread(self.cache.put_many, model, list(zip(batch, embeddings)))
+
+        if error is not None and all(vector is None for vector in vectors):
+            raise error
+        return vectors
+
+    def is_available(self):
+        """ False while the circuit breaker is open or its probe is running. """
+        with self._lock:
+            return time.monotonic() >= self._open_until and not self._probing
 
-    def embed(self, text, model="nomic-embed-text", max_chars=5000):
-        return ollama.embeddings(model=model, prompt=text[:max_chars])
+    def stats(self):
+        """
+        Requests in flight and waiting per priority, the deepest the wait
+        queue has been, retries, and per priority request counts, errors,
+        texts sent and p50/p95/p99/max wait and run times in seconds.
+        """
+        with self._lock:
+            retried = self.retried
+        return {"in_flight": self.gate.in_flight, "waiting": self.gate.waiting(),
+                "max_waiting": self.gate.max_waiting, "retried": retried,
+                "requests": self.request_stats.snapshot()["operations"]}
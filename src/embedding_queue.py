@@ -0,0 +1,233 @@
+import time
+import queue
+import logging
+import threading
+from embedding_codec import encode_embedding
+from embedding_provider import EmbeddingUnavailableError
+
+class EmbeddingQueue:
+    """
+    Computes note embeddings in the background so saving a note doesn't
+    wait on the embedding model.
+
+    Notes are written with pending_embedding = 1 and their ids submitted
+    here. A pool of `workers` threads embeds each note, stores the vector,
+    clears the flag and adds the vector to FAISS. Failed embeddings are
+    retried up to `max_attempts` times, waiting `retry_delay` seconds and
+    doubling the wait after each failure. A note edited or deleted while its
+    embedding was computed is left to the job queued by that change.
+
+    At most `max_queued` ids are held in memory. Ids that don't fit stay
+    pending in the database and are read back once the queue runs dry, as
+    are the notes left pending by a previous run when start() is called.
+    A worker takes up to `batch_size` queued notes at a time and embeds
+    them with one call to embed_many.
+    """
+    def __init__(self, notes_repository, embedding_provider, faiss_engine, search_engine,
+                 workers=2, max_queued=1000, max_attempts=5, retry_delay=1.0, batch_size=32):
+        self.notes_repo = notes_repository
+        self.embedding_provider = embedding_provider
+        self.faiss_engine = faiss_engine
+        self.search_engine = search_engine
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.batch_size = batch_size
+
+        self.queue = queue.Queue(maxsize=max_queued)
+        self._lock = threading.Lock()
+        self._queued = set()
+        self._active = set()
+        self._rerun = set()
+        self._given_up = set()
+        self._overflow = False
+        self._stopping = threading.Event()
+        self.threads = []
+
+        self.completed = 0
+        self.failed = 0
+
+    def start(self):
+        """ Starts the workers and queues every note left pending by earlier runs. """
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._run, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        self.resume()
+
+    def resume(self):
+        """ Queues the pending notes stored in the database, as many as fit. """
+        stored = self.notes_repo.list_pending_embeddings(self.max_queued)
+        with self._lock:
+            # Notes that ran out of attempts wait for an edit or a restart.
+            note_ids = [note_id for note_id in stored if note_id not in self._given_up]
+            # There may be more than one batch of them.
+            self._overflow = len(stored) == self.max_queued and bool(note_ids)
+        self.submit_many(note_ids)
+        logging.info(f"Queued {len(note_ids)} notes waiting for an embedding.")
+
+    def submit(self, note_id):
+        self.submit_many([note_id])
+
+    def submit_many(self, note_ids):
+        with self._lock:
+            for note_id in note_ids:
+                self._given_up.discard(note_id)
+                if note_id in self._queued:
+                    continue
+                # Being embedded right now, possibly from text that has since
+                # changed. It is queued again once that job ends.
+                if note_id in self._active:
+                    self._rerun.add(note_id)
+                    continue
+                self._put(note_id)
+
+    def _put(self, note_id):
+        try:
+            self.queue.put_nowait(note_id)
+        except queue.Full:
+            # Still flagged in the database, picked up by resume().
+            self._overflow = True
+            return
+        self._queued.add(note_id)
+
+    def pending(self):
+        """ Number of notes queued or being embedded. """
+        with self._lock:
+            return len(self._queued) + len(self._active)
+
+    def _take_batch(self, first_id):
+        """ `first_id` plus whatever else is queued, up to `batch_size` ids, and whether a stop sentinel was taken. """
+        note_ids = [first_id]
+        while len(note_ids) < self.batch_size:
+            try:
+                note_id = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if note_id is None:
+                # Each worker takes exactly one sentinel.
+                return note_ids, True
+            note_ids.append(note_id)
+        return note_ids, False
+
+    def _run(self):
+        while True:
+            try:
+                note_id = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                if self._overflow and not self._stopping.is_set():
+                    self.resume()
+                continue
+            if note_id is None:
+                self.queue.task_done()
+                return
+            note_ids, stop = self._take_batch(note_id)
+            with self._lock:
+                self._queued.difference_update(note_ids)
+                self._active.update(note_ids)
+            try:
+                self._embed_notes(note_ids)
+            except Exception:
+                logging.exception(f"Could not embed notes {note_ids}.")
+            finally:
+                with self._lock:
+                    for note_id in note_ids:
+                        self._active.discard(note_id)
+                        if note_id in self._rerun:
+                            self._rerun.discard(note_id)
+                            self._put(note_id)
+                for _ in note_ids:
+                    self.queue.task_done()
+            if stop:
+                self.queue.task_done()
+                return
+
+    def _embed_notes(self, note_ids):
+        notes = self.notes_repo.get_notes(note_ids, fields=("title", "contents", "tags", "deleted", "pending_embedding"))
+        # Skips notes already embedded by an earlier job, or no longer needed.
+        notes = [(note_id, note) for note_id, note in zip(note_ids, notes)
+                 if note is not None and note['deleted'] != 1 and note['pending_embedding']]
+
+        delay = self.retry_delay
+        attempt = 0
+        while notes:
+            try:
+                vectors = self.embedding_provider.embed_many(
+                    [f"{note['title']} {note['contents']} {note['tags']}" for _, note in notes])
+            except EmbeddingUnavailableError as e:
+                # Not an attempt, the provider is waiting out earlier failures.
+                if self._stopping.wait(e.retry_after):
+                    return
+                continue
+            except Exception as e:
+                logging.warning(f"Embedding {len(notes)} notes failed: {e}")
+                vectors = [None for _ in notes]
+
+            for (note_id, note), vector in zip(notes, vectors):
+                if vector is not None:
+                    self._store(note_id, note, vector)
+            # Only the notes whose batch failed are tried again.
+            notes = [(note_id, note) for (note_id, note), vector in zip(notes, vectors) if vector is None]
+            if not notes:
+                return
+
+            attempt += 1
+            logging.warning(f"Embedding {len(notes)} notes failed on attempt {attempt} of {self.max_attempts}.")
+            if attempt == self.max_attempts or self._stopping.wait(delay):
+                with self._lock:
+                    self.failed += len(notes)
+                    self._given_up.update(note_id for note_id, _ in notes)
+                return
+            delay *= 2
+
+    def _store(self, note_id, note, vector):
+        if not self.notes_repo.complete_embedding(note_id, note['title'], note['contents'], note['tags'], encode_embedding(vector)):
+            return
+        self.faiss_engine.update_embedding(note_id, vector)
+        self.search_engine.invalidate_cache()
+        with self._lock:
+            self.completed += 1
+
+    def drain(self, timeout=None):
+        """
+        Blocks until every queued note, including those that didn't fit in
+        the queue, has been processed, or `timeout` seconds have passed.
+        Returns whether the queue was drained.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.queue.all_tasks_done:
+                remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+                if not self.queue.all_tasks_done.wait_for(lambda: not self.queue.unfinished_tasks, remaining):
+                    return False
+            if not self._overflow:
+                return True
+            self.resume()
+
+    def shutdown(self, drain=True, timeout=None):
+        """
+        Stops the workers, first finishing the queued notes when `drain` is
+        set, waiting at most `timeout` seconds for them. Anything not
+        embedded stays pending for the next start().
+        """
+        if drain:
+            self.drain(timeout)
+        self._stopping.set()
+        while True:
+            try:
+                note_id = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._queued.discard(note_id)
+            self.queue.task_done()
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def stats(self):
+        with self._lock:
+            return {"queued": len(self._queued), "active": len(self._active), "completed": self.completed, "failed": self.failed}
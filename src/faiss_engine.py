@@ -1,6 +1,18 @@
 import faiss
-import pickle
+import logging
+import threading
 import numpy as np
+from embedding_codec import decode_embedding
+
+def _unit_rows(vectors):
+    """
+    Float32 copy of the vectors scaled to unit length. Ollama's batch
+    endpoint returns unit vectors and the older single text one doesn't,
+    so everything is normalised before it reaches the index.
+    """
+    rows = np.array(vectors, dtype="float32")
+    faiss.normalize_L2(rows)
+    return rows
 
 class Faiss:
     def __init__(self, emb_prov, notes_repository):
@@ -9,6 +21,9 @@ class Faiss:
 
         self.embedding_dim = self._get_embedding_dimension()
         self.embedding_database = faiss.IndexFlatL2(self.embedding_dim)
+        # Vectors are added by the embedding queue's workers while searches
+        # run on other threads.
+        self._lock = threading.RLock()
 
         self.faiss_to_uuid = []
         self.initialize_faiss_index()
@@ -17,30 +32,58 @@ class Faiss:
         sample = self.embedding_provider.embed("dimension probe")
         return len(sample["embedding"])
 
-    def initialize_faiss_index(self):
+    def initialize_faiss_index(self, batch_size=1000):
         """ Assumes FAISS is empty otherwise it will append to existing data. """
-        all_notes = self.notes_repo.list_all_notes()
-
-        for note in all_notes:
-            if note['embeddings'] is None:
+        uuids = []
+        vectors = []
+        for note in self.notes_repo.iter_embeddings(batch_size):
+            if note['embedding'] is None:
                 continue
-            vector = pickle.loads(note["embeddings"])
-            self.embedding_database.add(np.array([vector], dtype="float32"))
-            self.faiss_to_uuid.append(note["uuid"])
+            vector = decode_embedding(note["embedding"])
+            if vector.shape[0] != self.embedding_dim:
+                logging.warning(f"Skipping embedding of note {note['uuid']} with dimension {vector.shape[0]}, expected {self.embedding_dim}.")
+                continue
+            vectors.append(vector)
+            uuids.append(note["uuid"])
+
+            if len(vectors) == batch_size:
+                self._add_batch(uuids, vectors)
+                uuids = []
+                vectors = []
+
+        self._add_batch(uuids, vectors)
+
+    def _add_batch(self, uuids, vectors):
+        if not vectors:
+            return
+        with self._lock:
+            self.embedding_database.add(_unit_rows(np.vstack(vectors)))
+            self.faiss_to_uuid.extend(uuids)
 
     def add_embedding(self, uuid, vector):
-        self.embedding_database.add(np.array([vector], dtype="float32"))
-        self.faiss_to_uuid.append(uuid)
+        with self._lock:
+            self.embedding_database.add(_unit_rows([vector]))
+            self.faiss_to_uuid.append(uuid)
+
+    def add_embeddings(self, uuids, vectors):
+        """ Adds many vectors with a single call to the index. """
+        self._add_batch(list(uuids), [np.asarray(vector, dtype="float32") for vector in vectors])
 
     def delete_embedding(self, uuid):
-        faiss_index = self.faiss_to_uuid.index(uuid)
-        faiss_index = np.array([faiss_index])
-        self.embedding_database.remove_ids(faiss_index)
-        self.faiss_to_uuid.remove(uuid)
+        with self._lock:
+            # Notes still waiting for their embedding have no vector yet.
+            if uuid not in self.faiss_to_uuid:
+                return
+            faiss_index = self.faiss_to_uuid.index(uuid)
+            faiss_index = np.array([faiss_index])
+            self.embedding_database.remove_ids(faiss_index)
+            self.faiss_to_uuid.remove(uuid)
 
     def update_embedding(self, uuid, vector):
-        self.delete_embedding(uuid)
-        self.add_embedding(uuid, vector)
+        with self._lock:
+            self.delete_embedding(uuid)
+            self.add_embedding(uuid, vector)
 
     def search(self, embedding_vector, k):
-        return self.embedding_database.search(embedding_vector, k)
+        with self._lock:
+            return self.embedding_database.search(_unit_rows(embedding_vector), k)
@@ -1,5 +1,4 @@
 import sys
-import pickle
 import logging
 import traceback
 from functools import partial
@@ -11,9 +10,12 @@ from PySide6.QtGui import QIcon
 from PySide6.QtCore import Signal, Qt
 
 from faiss_engine import Faiss
+from memory_index import MemoryIndex
+from query_cache import QueryCache
 from tokenizer import Tokenizer
 from note_index import NoteIndex
 from database_worker import DBWorker
+from migrations import SchemaMigrator
 from sync_manager import SyncManager
 from lamport_clock import LamportClock
 from search_engine import SearchEngine
@@ -22,9 +24,21 @@ from installation_wizard import run_wizard
 from device_identification import DeviceID
 from transport_layer import TransportLayer
 from change_log_repository import ChangeLog
-from notes_repository import NotesRepository
+from note_service import NoteService
+from embedding_queue import EmbeddingQueue
+from notes_repository import NotesRepository, DISPLAY_FIELDS
 from peer_to_peer import advertise, discover
 from embedding_provider import EmbeddingProvider
+from embedding_cache import EmbeddingCache
+
+# Searches show keyword matches alone rather than wait longer than this on Ollama.
+SEARCH_DEADLINE_MS = 800
+# Number of notes shown for a search.
+SEARCH_RESULTS = 10
+# Seconds before a single embedding request to Ollama is abandoned.
+EMBEDDING_TIMEOUT = 30
+# Seconds to spend finishing queued embeddings on exit.
+SHUTDOWN_DRAIN_TIMEOUT = 10
 
 class ResultCard(QFrame):
     clicked = Signal(dict)
@@ -154,6 +168,8 @@ class MainWindow(QWidget):
         search_layout.addWidget(self.search_bar)
         search_layout.addWidget(self.search_button)
 
+        self.search_status = QLabel("")
+
         self.title_label = QLabel("Note`s title:")
         self.title_field = QLineEdit()
 
@@ -188,6 +204,7 @@ class MainWindow(QWidget):
         buttons_layout.addWidget(self.sync_button)
 
         left_layout.addLayout(search_layout)
+        left_layout.addWidget(self.search_status)
         left_layout.addLayout(title_layout)
         left_layout.addLayout(contents_layout)
         left_layout.addLayout(tags_layout)
@@ -229,7 +246,7 @@ class MainWindow(QWidget):
         if user_query == "":
             return
 
-        top_results = self.app.search_engine.hybrid_search(user_query)
+        top_results = self.app.search_engine.hybrid_search(user_query, k=SEARCH_RESULTS, deadline_ms=SEARCH_DEADLINE_MS)
 
         if top_results is None:
             QMessageBox.warning(self, "Could not search!", "The database appears to be empty.")
@@ -241,8 +258,14 @@ class MainWindow(QWidget):
 
         self.clear_results()
 
-        for result in top_results:
-            note = self.app.notes_db.get_note(result[0])
+        if top_results.partial:
+            self.search_status.setText("Semantic search unavailable, showing keyword matches only.")
+        else:
+            self.search_status.setText("")
+
+        notes = self.app.notes_db.get_notes([result[0] for result in top_results], fields=DISPLAY_FIELDS)
+
+        for note in notes:
             note = dict(note)  # SQLite to dict.
             card = ResultCard(note)
             card.clicked.connect(self.on_result_clicked)
@@ -255,21 +278,7 @@ class MainWindow(QWidget):
         contents = self.contents_field.toPlainText().strip()
         tags = self.tags_field.text().strip()
 
-        responce = self.app.embedding_prov.embed(f"{title} {contents} {tags}")
-        embeddings = pickle.dumps(responce['embedding'])
-
-        note_id = self.app.notes_db.create_note(title, contents, embeddings, tags)
-
-        self.app.search_engine.index_note(note_id)
-        self.app.lexical_index.index_note_for_lexical_search(note_id, title, contents)
-        self.app.faiss_engine.add_embedding(note_id, responce['embedding'])
-
-        # Convert the SQLite row object into a dictionary.
-        note_as_dict = dict(self.app.notes_db.get_note(note_id))
-
-        self.app.lamport_clock.increment_lamport_time()
-        self.app.lamport_clock.save_lamport_time_to_db()
-        self.app.change_log.log_operation(note_id, "create", note_as_dict, self.app.lamport_clock.now(), self.app.device_id)
+        self.app.note_service.create_note(title, contents, tags)
 
         self.app.synchronization_manager.sync()
 
@@ -283,13 +292,7 @@ class MainWindow(QWidget):
         # No note selected, do nothing.
         if self.current_note_id == "":
             return
-        self.app.notes_db.mark_note_as_deleted(self.current_note_id)
-        self.app.lexical_index.delete_note_from_lexical_search(self.current_note_id)
-        self.app.search_engine.remove_from_index(self.current_note_id)
-        self.app.faiss_engine.delete_embedding(self.current_note_id)
-        self.app.lamport_clock.increment_lamport_time()
-        self.app.lamport_clock.save_lamport_time_to_db()
-        self.app.change_log.log_operation(self.current_note_id, "delete", {"deleted": 1}, self.app.lamport_clock.now(), self.app.device_id)
+        self.app.note_service.delete_note(self.current_note_id)
         self.app.synchronization_manager.sync()
         QMessageBox.information(self, "Note deleted!", "You deleted a note.")
 
@@ -308,42 +311,14 @@ class MainWindow(QWidget):
         contents = self.contents_field.toPlainText().strip()
         tags = self.tags_field.text().strip()
 
-        old_note = self.app.notes_db.get_note(self.current_note_id)
-
-        # Can't edit note if it has been deleted.
-        if old_note["deleted"] == 1:
+        # Only what's changed is rewritten, reindexed and logged. None means
+        # the note has been deleted and can't be edited.
+        changes = self.app.note_service.update_note(self.current_note_id, title, contents, tags)
+        if changes is None:
+            return
+        if not changes:
+            QMessageBox.information(self, "Nothing to save!", "The note has not changed.")
             return
-
-        change_as_json = {}
-        # Build the change log with only what's changed.
-        if title is not None:
-            change_as_json['title'] = title
-        if contents is not None:
-            change_as_json['contents'] = contents
-        if tags is not None:
-            change_as_json['tags'] = tags
-
-        # Build the note merging old and new contents.
-        if title is None:
-            title = old_note['title']
-        if contents is None:
-            contents = old_note['contents']
-        if tags is None:
-            tags = old_note['tags']
-
-        responce = self.app.embedding_prov.embed(f"{title} {contents} {tags}")
-        embeddings = pickle.dumps(responce['embedding'])
-
-        self.app.notes_db.update_note(self.current_note_id, title, contents, embeddings, tags)
-        self.app.lexical_index.index_note_for_lexical_search(self.current_note_id, title, contents)
-        self.app.search_engine.update_index(self.current_note_id)
-
-        self.app.faiss_engine.update_embedding(self.current_note_id, responce['embedding'])
-
-        change_as_json['embeddings'] = embeddings
-        self.app.lamport_clock.increment_lamport_time()
-        self.app.lamport_clock.save_lamport_time_to_db()
-        self.app.change_log.log_operation(self.current_note_id, "update", change_as_json, self.app.lamport_clock.now(), self.app.device_id)
 
         self.app.synchronization_manager.sync()
 
@@ -365,7 +340,10 @@ class MainWindow(QWidget):
 
 class App:
     def __init__(self):
-        self.db_worker = DBWorker()
+        # Searches run on the GUI thread while sync batches are applied from
+        # the TCP handler thread, so give reads their own connections and
+        # let the burst of index writes per note share commits.
+        self.db_worker = DBWorker(wal=True, readers=2, group_commit=True)
         self.device = DeviceID(self.db_worker)
 
         self.device.create_device_name_table()
@@ -389,31 +367,42 @@ class App:
         self.advertiser, self.info = advertise(self.device_id, self.public_key, self.device_name)
         self.discoverer = discover(self.device_id, self.transport_layer)
 
-        self.embedding_prov = EmbeddingProvider()
+        SchemaMigrator(self.db_worker).migrate()
+
+        self.embedding_cache = EmbeddingCache(self.db_worker)
+        self.embedding_prov = EmbeddingProvider(timeout=EMBEDDING_TIMEOUT, cache=self.embedding_cache)
 
         self.lamport_clock = LamportClock(self.db_worker)
         self.lamport_clock.initialize_lamport_clock()
 
         self.notes_db = NotesRepository(self.db_worker)
-        self.notes_db.create_notes_table()
-
         self.note_index = NoteIndex(self.db_worker)
-        self.note_index.create_word_index_table()
-
         self.lexical_index = LexicalIndex(self.db_worker)
-        self.lexical_index.create_lexical_table()
-
         self.change_log = ChangeLog(self.db_worker, self.device_id)
-        self.change_log.create_change_log_table()
 
         self.faiss_engine = Faiss(self.embedding_prov, self.notes_db)
 
+        self.memory_index = MemoryIndex(self.note_index)
+
         self.tokenizer = Tokenizer()
 
         self.search_engine = SearchEngine(self.notes_db, self.note_index,
                                           self.lexical_index,
                                           self.faiss_engine,
-                                          self.embedding_prov, self.tokenizer)
+                                          self.embedding_prov, self.tokenizer,
+                                          self.memory_index, QueryCache())
+
+        # Saving a note returns once it is searchable lexically, its
+        # embedding is computed in the background.
+        self.embedding_queue = EmbeddingQueue(self.notes_db, self.embedding_prov,
+                                              self.faiss_engine, self.search_engine)
+        self.embedding_queue.start()
+
+        self.note_service = NoteService(self.db_worker, self.device_id, self.notes_db,
+                                        self.search_engine, self.lexical_index,
+                                        self.faiss_engine, self.embedding_prov,
+                                        self.change_log, self.lamport_clock,
+                                        self.embedding_queue)
 
         self.synchronization_manager = SyncManager(self.db_worker,
                                                    self.device_id,
@@ -424,11 +413,8 @@ class App:
                                                    self.lexical_index,
                                                    self.faiss_engine,
                                                    self.embedding_prov,
-                                                   self.transport_layer)
-
-        self.synchronization_manager.create_last_sync_table()
-        self.synchronization_manager.initialize_sync_table()
-        self.synchronization_manager.create_lamport_last_sync_table()
+                                                   self.transport_layer,
+                                                   self.note_service)
 
 def exception_hook(exc_type, exc_value, exc_traceback):
     tb_str = "".join(traceback.format_exception(exc_type, exc_value, exc_traceback))
@@ -443,6 +429,14 @@ def exception_hook(exc_type, exc_value, exc_traceback):
 
 def shutdown(app):
     logging.info("Shutting down app...")
+    app.search_engine.shutdown()
+    app.embedding_queue.shutdown(timeout=SHUTDOWN_DRAIN_TIMEOUT)
+    app.embedding_prov.shutdown()
+    logging.info("Embedding queue stats: %s", app.embedding_queue.stats())
+    logging.info("Embedding cache stats: %s", app.embedding_cache.stats())
+    logging.info("Embedding request stats: %s", app.embedding_prov.stats())
+    logging.info("Database stats: %s", app.db_worker.stats())
+    logging.info("Query cache stats: %s", app.search_engine.query_cache.stats())
     app.db_worker.shutdown()
     # TODO send logout signal to peers.
     app.advertiser.unregister_service(app.info)
@@ -1,10 +1,11 @@
 
 import hashlib
+from embedding_codec import embedding_payload
 
 def compute_note_hash(title, contents, tags, embeddings, deleted):
     """
     Compute SHA-256 hex hash for a note's content state.
-    embeddings: bytes (pickle dumped) or None
+    embeddings: bytes (encoded float32 or legacy pickle) or None
     deleted: int or bool
     """
     h = hashlib.sha256()
@@ -22,7 +23,8 @@ def compute_note_hash(title, contents, tags, embeddings, deleted):
     h.update(b"\ndeleted:")
     h.update(str(int(bool(deleted))).encode("utf-8"))
 
-    # embeddings could be bytes (pickle dumps) — include raw bytes
+    # Hash the float32 values rather than the stored bytes so a note keeps
+    # its hash whether the vector is a legacy pickle or the float32 format.
     if embeddings is not None:
         if isinstance(embeddings, memoryview):
             emb_bytes = bytes(embeddings)
@@ -31,6 +33,8 @@ def compute_note_hash(title, contents, tags, embeddings, deleted):
         # if embeddings is a string, encode it
         if isinstance(emb_bytes, str):
             emb_bytes = emb_bytes.encode("utf-8")
+        else:
+            emb_bytes = embedding_payload(emb_bytes)
         h.update(b"\nembeddings:")
         h.update(emb_bytes)
 
@@ -24,6 +24,20 @@ class LamportClock:
     def increment_lamport_time(self, remote_time=0):
         self.__lamport_time = max(self.__lamport_time, remote_time) + 1
 
+    def reserve_lamport_times(self, count, remote_time=0):
+        """ Advances the clock by `count` ticks at once and returns the reserved timestamps. """
+        start = max(self.__lamport_time, remote_time) + 1
+        self.__lamport_time = start + count - 1
+        return range(start, start + count)
+
+    def rewind(self, timestamp, expected):
+        """
+        Sets the clock back to `timestamp` after the ticks that took it to
+        `expected` were rolled back. Left alone if it has moved on since.
+        """
+        if self.__lamport_time == expected:
+            self.__lamport_time = timestamp
+
     def save_lamport_time_to_db(self):
         def _op(connection):
             cursor = connection.cursor()
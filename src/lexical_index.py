@@ -1,3 +1,12 @@
+# Column weights for FTS5 bm25(), in table order. note_id is not indexed.
+TITLE_WEIGHT = 2.0
+CONTENTS_WEIGHT = 1.0
+TAGS_WEIGHT = 1.0
+
+def build_match_query(tokens):
+    """ ORs the tokens together as quoted FTS5 strings, so user input can never be read as query syntax. """
+    terms = dict.fromkeys(token.replace('"', '""') for token in tokens if token)
+    return " OR ".join(f'"{term}"' for term in terms)
 
 class LexicalIndex:
 
@@ -7,16 +16,37 @@ class LexicalIndex:
     def create_lexical_table(self):
         def _op(connection):
             cursor = connection.cursor()
-            cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS lexical USING fts5(note_id, title, contents)")
+            cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS lexical USING fts5(note_id UNINDEXED, title, contents, tags)")
         self.db_worker.execute(_op)
 
-    def index_note_for_lexical_search(self, note_id, title, contents):
-        def _op(connection, note_id, title, contents):
+    def index_note_for_lexical_search(self, note_id, title, contents, tags=""):
+        def _op(connection, note_id, title, contents, tags):
             cursor = connection.cursor()
             cursor.execute("DELETE FROM lexical WHERE note_id = ?", (note_id,))
-            cursor.execute("INSERT INTO lexical (note_id, title, contents) VALUES (?, ?, ?)", (note_id, title, contents))
+            cursor.execute("INSERT INTO lexical (note_id, title, contents, tags) VALUES (?, ?, ?, ?)", (note_id, title, contents, tags))
             connection.commit()
-        self.db_worker.execute(_op, (note_id, title, contents))
+        self.db_worker.execute(_op, (note_id, title, contents, tags))
+
+    def index_notes_for_lexical_search(self, notes):
+        """ Bulk variant of index_note_for_lexical_search for (note_id, title, contents, tags) tuples. """
+        def _op(connection, notes):
+            cursor = connection.cursor()
+            cursor.executemany("DELETE FROM lexical WHERE note_id = ?", [(note[0],) for note in notes])
+            cursor.executemany("INSERT INTO lexical (note_id, title, contents, tags) VALUES (?, ?, ?, ?)", notes)
+            connection.commit()
+        self.db_worker.execute(_op, (list(notes),))
+
+    def update_note_for_lexical_search(self, note_id, title=None, contents=None, tags=None):
+        """ Rewrites only the columns that are given. Does nothing when none are. """
+        columns = {name: value for name, value in (("title", title), ("contents", contents), ("tags", tags)) if value is not None}
+        if not columns:
+            return
+        assignments = ", ".join(f"{name} = ?" for name in columns)
+        def _op(connection, note_id, values):
+            cursor = connection.cursor()
+            cursor.execute(f"UPDATE lexical SET {assignments} WHERE note_id = ?", (*values, note_id))
+            connection.commit()
+        self.db_worker.execute(_op, (note_id, list(columns.values())))
 
     def delete_note_from_lexical_search(self, note_id):
         def _op(connection, note_id):
@@ -30,11 +60,30 @@ class LexicalIndex:
             cursor = connection.cursor()
             result = cursor.execute("SELECT * FROM lexical WHERE note_id = ?", (note_id,))
             return result.fetchone()
-        return self.db_worker.execute(_op, (note_id,), wait=True)
+        return self.db_worker.execute(_op, (note_id,), wait=True, read=True)
 
     def search_lexical_index(self, query):
         def _op(connection, query):
             cursor = connection.cursor()
             results = cursor.execute("SELECT note_id FROM lexical WHERE lexical = ?", (query,))
             return results.fetchall()
-        return self.db_worker.execute(_op, (query,), wait=True)
+        return self.db_worker.execute(_op, (query,), wait=True, read=True)
+
+    def ranked_search(self, tokens, k=10, weights=(TITLE_WEIGHT, CONTENTS_WEIGHT, TAGS_WEIGHT)):
+        """
+        Ranks notes matching any of the tokens with FTS5's bm25() in a single
+        query. Returns the top `k` (note_id, score) pairs, or all of them
+        when `k` is None, best first, with the sign flipped so that higher
+        scores are better.
+        """
+        match_query = build_match_query(tokens)
+        if not match_query:
+            return []
+        rank = f"bm25(0.0, {', '.join(str(float(weight)) for weight in weights)})"
+        def _op(connection, match_query, rank, k):
+            cursor = connection.cursor()
+            cursor.execute("SELECT note_id, -rank AS score FROM lexical WHERE lexical MATCH ? AND rank MATCH ? ORDER BY rank LIMIT ?",
+                           (match_query, rank, k))
+            return [(row["note_id"], row["score"]) for row in cursor.fetchall()]
+        # A negative LIMIT is no limit.
+        return self.db_worker.execute(_op, (match_query, rank, -1 if k is None else k), wait=True, read=True)
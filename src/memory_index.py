@@ -0,0 +1,261 @@
+import math
+import logging
+import threading
+import numpy as np
+from collections import defaultdict
+
+class MemoryIndex:
+    """
+    Inverted index held in memory for BM25.
+
+    Every term maps to parallel numpy arrays of document ids and term
+    frequencies sorted by id, and documents have a length array. Notes get
+    increasing integer ids, so new postings are appended to a pending list
+    that is merged into the term's arrays the next time the term is read.
+    Removed notes are tombstoned in the `live` array and dropped for good by
+    compact(), which runs once tombstones exceed `compaction_ratio` of the
+    ids handed out.
+
+    Each term also keeps (max_tf, min_length) over its postings. A term's
+    BM25 contribution grows with tf and shrinks with length, so these give
+    an upper bound on what the term can add to any note's score, which
+    top-k searches use to skip work.
+    """
+    def __init__(self, notes_index, compaction_ratio=0.25, batch_size=5000):
+        self.notes_index = notes_index
+        self.compaction_ratio = compaction_ratio
+        self._lock = threading.Lock()
+
+        self.uuid_to_doc = {}
+        self.doc_to_uuid = []
+        self.doc_lengths = np.zeros(1024, dtype=np.int32)
+        self.live = np.zeros(1024, dtype=bool)
+        self.postings = {}
+        self.bounds = {}
+        self.pending = defaultdict(list)
+        self.document_count = 0
+        self.total_length = 0
+        self.tombstones = 0
+
+        self.initialize_memory_index(batch_size)
+
+    def initialize_memory_index(self, batch_size=5000):
+        """ Loads every posting of the tokens table. Assumes the index is empty. """
+        note_tokens = defaultdict(dict)
+        for row in self.notes_index.iter_tokens(batch_size):
+            counts = note_tokens[row['note_id']]
+            counts[row['token']] = counts.get(row['token'], 0) + row['count']
+
+        with self._lock:
+            for note_id, token_counts in note_tokens.items():
+                self._add(note_id, token_counts)
+        logging.info(f"Loaded {self.document_count} notes into the in-memory index.")
+
+    def add_document(self, note_id, token_counts):
+        """ Indexes a note from its {token: count} mapping, replacing any previous version. """
+        with self._lock:
+            self._remove(note_id)
+            self._add(note_id, token_counts)
+            self._maybe_compact()
+
+    def add_documents(self, documents):
+        """ Bulk add_document for (note_id, token_counts) pairs. """
+        with self._lock:
+            for note_id, token_counts in documents:
+                self._remove(note_id)
+                self._add(note_id, token_counts)
+            self._maybe_compact()
+
+    def remove_document(self, note_id):
+        with self._lock:
+            self._remove(note_id)
+            self._maybe_compact()
+
+    def _add(self, note_id, token_counts):
+        if not token_counts:
+            return
+        doc = len(self.doc_to_uuid)
+        if doc == self.live.shape[0]:
+            self.doc_lengths = np.concatenate([self.doc_lengths, np.zeros_like(self.doc_lengths)])
+            self.live = np.concatenate([self.live, np.zeros_like(self.live)])
+
+        length = sum(token_counts.values())
+        self.uuid_to_doc[note_id] = doc
+        self.doc_to_uuid.append(note_id)
+        self.doc_lengths[doc] = length
+        self.live[doc] = True
+        self.document_count += 1
+        self.total_length += length
+
+        for token, count in token_counts.items():
+            self.pending[token].append((doc, count))
+            max_tf, min_length = self.bounds.get(token, (0, length))
+            self.bounds[token] = (max(max_tf, count), min(min_length, length))
+
+    def _remove(self, note_id):
+        doc = self.uuid_to_doc.pop(note_id, None)
+        if doc is None:
+            return
+        self.live[doc] = False
+        self.document_count -= 1
+        self.total_length -= int(self.doc_lengths[doc])
+        self.tombstones += 1
+
+    def _term(self, token):
+        """ The (doc ids, term frequencies) arrays of a term with pending postings merged in. """
+        pending = self.pending.pop(token, None)
+        if pending:
+            docs = np.fromiter((doc for doc, _ in pending), dtype=np.int32, count=len(pending))
+            tfs = np.fromiter((count for _, count in pending), dtype=np.float32, count=len(pending))
+            if token in self.postings:
+                old_docs, old_tfs = self.postings[token]
+                docs = np.concatenate([old_docs, docs])
+                tfs = np.concatenate([old_tfs, tfs])
+            self.postings[token] = (docs, tfs)
+        return self.postings.get(token)
+
+    def _maybe_compact(self):
+        if self.tombstones and self.tombstones > self.compaction_ratio * len(self.doc_to_uuid):
+            self._compact()
+
+    def compact(self):
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        """ Drops tombstoned documents and renumbers the live ones densely. """
+        size = len(self.doc_to_uuid)
+        live = self.live[:size]
+        new_ids = np.cumsum(live, dtype=np.int32) - 1
+
+        for token in list(self.pending):
+            self._term(token)
+        for token, (docs, tfs) in list(self.postings.items()):
+            keep = live[docs]
+            if not keep.any():
+                del self.postings[token]
+                del self.bounds[token]
+                continue
+            if not keep.all():
+                docs, tfs = docs[keep], tfs[keep]
+                self.bounds[token] = (int(tfs.max()), int(self.doc_lengths[docs].min()))
+            self.postings[token] = (new_ids[docs], tfs)
+
+        self.doc_to_uuid = [note_id for note_id, alive in zip(self.doc_to_uuid, live) if alive]
+        self.uuid_to_doc = {note_id: doc for doc, note_id in enumerate(self.doc_to_uuid)}
+        capacity = max(1024, self.live.shape[0])
+        lengths = np.zeros(capacity, dtype=np.int32)
+        lengths[:len(self.doc_to_uuid)] = self.doc_lengths[:size][live]
+        self.doc_lengths = lengths
+        self.live = np.zeros(capacity, dtype=bool)
+        self.live[:len(self.doc_to_uuid)] = True
+        self.tombstones = 0
+
+    def search(self, query_counts, k1=1.5, b=0.75, k=None):
+        """
+        BM25 over {token: count in query}. Returns (note_id, score) pairs
+        sorted by descending score, like SearchEngine.lexical_search(), or
+        only the best `k` of them.
+        """
+        with self._lock:
+            if not self.document_count:
+                return []
+            average_document_length = self.total_length / self.document_count
+
+            def score(docs, tfs, weight):
+                return tfs / (tfs + k1 * (1 - b + b * (self.doc_lengths[docs] / average_document_length))) * weight
+
+            terms = []
+            for token, query_count in query_counts.items():
+                term = self._term(token)
+                if term is None:
+                    continue
+                docs, tfs = term
+                notes_containing_token = int(np.count_nonzero(self.live[docs])) if self.tombstones else docs.shape[0]
+                if not notes_containing_token:
+                    continue
+
+                idf = math.log((self.document_count-notes_containing_token+0.5)/(notes_containing_token+0.5))
+                weight = idf * query_count
+                max_tf, min_length = self.bounds[token]
+                bound = weight * max_tf / (max_tf + k1 * (1 - b + b * (min_length / average_document_length)))
+                terms.append((bound, weight, docs, tfs))
+
+            if not terms:
+                return []
+            if k is None:
+                docs, scores = self._score_all(terms, score)
+            else:
+                docs, scores = self._score_top_k(terms, score, k)
+            order = np.lexsort((docs, -scores))
+            return [(self.doc_to_uuid[docs[i]], float(scores[i])) for i in order]
+
+    def _live_postings(self, docs, tfs):
+        if self.tombstones:
+            keep = self.live[docs]
+            return docs[keep], tfs[keep]
+        return docs, tfs
+
+    def _score_all(self, terms, score):
+        matched_docs = []
+        matched_scores = []
+        for _, weight, docs, tfs in terms:
+            docs, tfs = self._live_postings(docs, tfs)
+            matched_docs.append(docs)
+            matched_scores.append(score(docs, tfs, weight))
+
+        docs = np.concatenate(matched_docs)
+        scores = np.bincount(docs, weights=np.concatenate(matched_scores), minlength=len(self.doc_to_uuid))
+        hits = np.unique(docs)
+        return hits, scores[hits]
+
+    def _score_top_k(self, terms, score, k):
+        """
+        Term at a time MaxScore. Terms are visited from the highest upper
+        bound down. While the terms left could still lift an unseen note
+        into the top k, every posting is scored (OR mode). After that only
+        the current candidates are looked up in the remaining posting lists
+        with a binary search (AND mode), and candidates that can no longer
+        reach the k-th best score are dropped. Common, low idf terms are
+        therefore probed at a handful of positions instead of being scanned.
+        """
+        terms.sort(key=lambda term: term[0], reverse=True)
+        # What the unvisited terms can still add to, or take from, a score.
+        # Terms with a negative idf can only lower it.
+        upper = np.cumsum([max(0.0, term[0]) for term in reversed(terms)])[::-1].tolist() + [0.0]
+        lower = np.cumsum([min(0.0, term[0]) for term in reversed(terms)])[::-1].tolist() + [0.0]
+
+        candidates = np.empty(0, dtype=np.int32)
+        scores = np.empty(0, dtype=np.float64)
+        or_mode = True
+        for position, (_, weight, docs, tfs) in enumerate(terms):
+            if or_mode:
+                docs, tfs = self._live_postings(docs, tfs)
+                candidates, inverse = np.unique(np.concatenate([candidates, docs]), return_inverse=True)
+                scores = np.bincount(inverse, weights=np.concatenate([scores, score(docs, tfs, weight)]))
+            else:
+                found = np.searchsorted(docs, candidates)
+                found[found == docs.shape[0]] = 0
+                hit = docs[found] == candidates
+                scores[hit] += score(candidates[hit], tfs[found[hit]], weight)
+
+            if candidates.shape[0] < k:
+                continue
+            # Every candidate ends with at least its score plus what the
+            # remaining terms could take away, so the k-th of those is a
+            # score the final top k is guaranteed to reach.
+            threshold = np.partition(scores, candidates.shape[0] - k)[candidates.shape[0] - k] + lower[position + 1]
+            if or_mode and upper[position + 1] < threshold:
+                or_mode = False
+            if not or_mode:
+                keep = scores + upper[position + 1] >= threshold
+                candidates, scores = candidates[keep], scores[keep]
+
+        if candidates.shape[0] > k:
+            # Ties at the k-th score go to the lowest ids, as in the full ranking.
+            kth = np.partition(scores, candidates.shape[0] - k)[candidates.shape[0] - k]
+            above = scores > kth
+            ties = np.flatnonzero(scores == kth)[:k - np.count_nonzero(above)]
+            above[ties] = True
+            candidates, scores = candidates[above], scores[above]
+        return candidates, scores
@@ -0,0 +1,209 @@
+import logging
+from hashing import compute_note_hash
+from embedding_codec import decode_embedding, encode_embedding, is_legacy_pickle
+
+# Each migration is (version, description, function taking a cursor). They
+# run in order, once per database, and must never be edited after release:
+# change the schema by appending a new migration instead. Statements use
+# IF NOT EXISTS so databases created before versioning are upgraded in place.
+
+def _has_column(cursor, table, column):
+    cursor.execute(f"PRAGMA table_info({table})")
+    return any(row[1] == column for row in cursor.fetchall())
+
+def _baseline_schema(cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS notes(
+                    uuid TEXT PRIMARY KEY,
+                    title TEXT,
+                    contents TEXT,
+                    created_at DATETIME,
+                    last_updated DATETIME,
+                    embeddings BLOB,
+                    tags TEXT,
+                    deleted BOOLEAN DEFAULT 0,
+                    note_hash TEXT)""")
+    cursor.execute("""CREATE TABLE IF NOT EXISTS tokens(
+                    id INTEGER PRIMARY KEY,
+                    note_id TEXT,
+                    token TEXT,
+                    count INTEGER,
+                    FOREIGN KEY (note_id) REFERENCES notes (uuid))""")
+    cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS lexical USING fts5(note_id, title, contents)")
+    cursor.execute("""CREATE TABLE IF NOT EXISTS change_log (
+                        op_id TEXT PRIMARY KEY,
+                        note_id TEXT,
+                        operation_type TEXT,
+                        timestamp DATETIME,
+                        device_id TEXT,
+                        payload TEXT,
+                        lamport_clock INTEGER,
+                        origin_device TEXT)""")
+    cursor.execute("CREATE TABLE IF NOT EXISTS lamport_clock(timestamp INTEGER PRIMARY KEY)")
+    cursor.execute("""CREATE TABLE IF NOT EXISTS last_sync (
+                        id INTEGER PRIMARY KEY CHECK (id = 1) DEFAULT 1,
+                        last_updated DATETIME)""")
+    cursor.execute("INSERT INTO last_sync (last_updated) SELECT CURRENT_TIMESTAMP WHERE NOT EXISTS (SELECT * FROM last_sync)")
+    cursor.execute("""CREATE TABLE IF NOT EXISTS last_lamport_sync (
+                        peer_device_id TEXT PRIMARY KEY,
+                        last_lamport INTEGER NOT NULL)""")
+
+def _hot_path_indexes(cursor):
+    # Covers retrieve_similar_tokens and retrieve_term_frequency_in_document.
+    cursor.execute("CREATE INDEX IF NOT EXISTS tokens_token_idx ON tokens(token, note_id, count)")
+    # Covers retrieve_tokens_for_note, delete_tokens_for_note and the per note
+    # GROUP BY behind the average document length.
+    cursor.execute("CREATE INDEX IF NOT EXISTS tokens_note_idx ON tokens(note_id, token, count)")
+    # op_id lookups already use the primary key index.
+    cursor.execute("CREATE INDEX IF NOT EXISTS change_log_lamport_idx ON change_log(lamport_clock)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS change_log_timestamp_idx ON change_log(timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS change_log_note_idx ON change_log(note_id)")
+
+def _float32_embeddings(cursor):
+    # Rewrites pickled vectors in the float32 format. Hashes are recomputed
+    # so notes hashed from the pickled bytes match the new canonical hash.
+    if not _has_column(cursor, "notes", "embeddings"):
+        return
+    cursor.execute("SELECT uuid, title, contents, tags, embeddings, deleted FROM notes WHERE embeddings IS NOT NULL")
+    for row in cursor.fetchall():
+        if not is_legacy_pickle(row[4]):
+            continue
+        embeddings = encode_embedding(decode_embedding(row[4]))
+        note_hash = compute_note_hash(row[1], row[2], row[3], embeddings, row[5])
+        cursor.execute("UPDATE notes SET embeddings = ?, note_hash = ? WHERE uuid = ?", (embeddings, note_hash, row[0]))
+
+def _split_embeddings(cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS note_embeddings(
+                    note_id TEXT PRIMARY KEY,
+                    embedding BLOB,
+                    FOREIGN KEY (note_id) REFERENCES notes (uuid))""")
+    if not _has_column(cursor, "notes", "embeddings"):
+        return
+    cursor.execute("INSERT OR IGNORE INTO note_embeddings (note_id, embedding) SELECT uuid, embeddings FROM notes WHERE embeddings IS NOT NULL")
+    cursor.execute("ALTER TABLE notes DROP COLUMN embeddings")
+
+def _bm25_statistics(cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS note_stats(
+                    note_id TEXT PRIMARY KEY,
+                    length INTEGER NOT NULL,
+                    FOREIGN KEY (note_id) REFERENCES notes (uuid))""")
+    cursor.execute("""CREATE TABLE IF NOT EXISTS collection_stats(
+                    id INTEGER PRIMARY KEY CHECK (id = 1) DEFAULT 1,
+                    document_count INTEGER NOT NULL,
+                    total_length INTEGER NOT NULL)""")
+    cursor.execute("INSERT OR IGNORE INTO note_stats (note_id, length) SELECT note_id, SUM(count) FROM tokens GROUP BY note_id")
+    cursor.execute("""INSERT OR REPLACE INTO collection_stats (id, document_count, total_length)
+                      SELECT 1, COUNT(*), COALESCE(SUM(length), 0) FROM note_stats""")
+
+def _lexical_tags_column(cursor):
+    # FTS5 tables cannot be altered, so the lexical index is rebuilt with
+    # note_id UNINDEXED and tags as a searchable column.
+    cursor.execute("CREATE VIRTUAL TABLE lexical_v2 USING fts5(note_id UNINDEXED, title, contents, tags)")
+    cursor.execute("""INSERT INTO lexical_v2 (note_id, title, contents, tags)
+                      SELECT lexical.note_id, lexical.title, lexical.contents, COALESCE(notes.tags, '')
+                      FROM lexical LEFT JOIN notes ON notes.uuid = lexical.note_id""")
+    cursor.execute("DROP TABLE lexical")
+    cursor.execute("ALTER TABLE lexical_v2 RENAME TO lexical")
+
+def _integer_postings(cursor):
+    # Replaces the tokens table, which repeated the token text and note uuid
+    # in every row, with a terms dictionary and integer postings. note_stats
+    # gains an INTEGER PRIMARY KEY doc_id, which unlike an implicit rowid is
+    # never renumbered by VACUUM.
+    cursor.execute("""CREATE TABLE IF NOT EXISTS terms(
+                    term_id INTEGER PRIMARY KEY,
+                    term TEXT NOT NULL UNIQUE,
+                    doc_freq INTEGER NOT NULL DEFAULT 0)""")
+    cursor.execute("""CREATE TABLE IF NOT EXISTS postings(
+                    term_id INTEGER NOT NULL,
+                    doc_id INTEGER NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (term_id, doc_id)) WITHOUT ROWID""")
+    cursor.execute("CREATE INDEX IF NOT EXISTS postings_doc_idx ON postings(doc_id, term_id, count)")
+
+    if not _has_column(cursor, "note_stats", "doc_id"):
+        cursor.execute("""CREATE TABLE note_stats_v2(
+                        doc_id INTEGER PRIMARY KEY,
+                        note_id TEXT NOT NULL UNIQUE,
+                        length INTEGER NOT NULL,
+                        FOREIGN KEY (note_id) REFERENCES notes (uuid))""")
+        cursor.execute("INSERT INTO note_stats_v2 (note_id, length) SELECT note_id, length FROM note_stats ORDER BY rowid")
+        cursor.execute("DROP TABLE note_stats")
+        cursor.execute("ALTER TABLE note_stats_v2 RENAME TO note_stats")
+
+    cursor.execute("""INSERT OR IGNORE INTO terms (term, doc_freq)
+                      SELECT token, COUNT(DISTINCT note_id) FROM tokens GROUP BY token""")
+    cursor.execute("""INSERT OR IGNORE INTO postings (term_id, doc_id, count)
+                      SELECT terms.term_id, note_stats.doc_id, SUM(tokens.count) FROM tokens
+                      JOIN terms ON terms.term = tokens.token
+                      JOIN note_stats ON note_stats.note_id = tokens.note_id
+                      GROUP BY terms.term_id, note_stats.doc_id""")
+    cursor.execute("DROP TABLE tokens")
+
+def _pending_embeddings(cursor):
+    # Notes are written before their embedding is computed. Notes that have
+    # no vector yet are marked so the embedding queue picks them up.
+    if not _has_column(cursor, "notes", "pending_embedding"):
+        cursor.execute("ALTER TABLE notes ADD COLUMN pending_embedding INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("CREATE INDEX IF NOT EXISTS notes_pending_embedding_idx ON notes(pending_embedding) WHERE pending_embedding = 1")
+    cursor.execute("""UPDATE notes SET pending_embedding = 1
+                      WHERE deleted != 1 AND uuid NOT IN (SELECT note_id FROM note_embeddings WHERE embedding IS NOT NULL)""")
+
+def _embedding_cache(cursor):
+    # Embeddings by model and text, see EmbeddingCache. last_used orders evictions.
+    cursor.execute("""CREATE TABLE IF NOT EXISTS embedding_cache (
+                        key TEXT PRIMARY KEY,
+                        model TEXT NOT NULL,
+                        embedding BLOB NOT NULL,
+                        last_used REAL NOT NULL)""")
+    cursor.execute("CREATE INDEX IF NOT EXISTS embedding_cache_last_used_idx ON embedding_cache(last_used)")
+
+MIGRATIONS = [
+    (1, "Baseline schema", _baseline_schema),
+    (2, "Indexes for token and change log lookups", _hot_path_indexes),
+    (3, "Store embeddings as float32 instead of pickled lists", _float32_embeddings),
+    (4, "Move embeddings out of the notes table", _split_embeddings),
+    (5, "Per note and collection statistics for BM25", _bm25_statistics),
+    (6, "Index tags in the lexical table and stop indexing note ids", _lexical_tags_column),
+    (7, "Integer term dictionary and postings instead of the tokens table", _integer_postings),
+    (8, "Track notes waiting for an embedding", _pending_embeddings),
+    (9, "Persistent embedding cache", _embedding_cache),
+]
+
+class SchemaMigrator:
+    def __init__(self, db_worker, migrations=MIGRATIONS):
+        self.db_worker = db_worker
+        self.migrations = migrations
+
+    def current_version(self):
+        def _op(connection):
+            cursor = connection.cursor()
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'")
+            if cursor.fetchone() is None:
+                return 0
+            cursor.execute("SELECT MAX(version) FROM schema_version")
+            return cursor.fetchone()[0] or 0
+        return self.db_worker.execute(_op, wait=True)
+
+    def migrate(self):
+        """ Applies every pending migration in a single transaction and returns the resulting version. """
+        def _op(connection):
+            cursor = connection.cursor()
+            cursor.execute("""CREATE TABLE IF NOT EXISTS schema_version(
+                            version INTEGER PRIMARY KEY,
+                            description TEXT,
+                            applied_at DATETIME)""")
+            cursor.execute("SELECT MAX(version) FROM schema_version")
+            version = cursor.fetchone()[0] or 0
+
+            for migration_version, description, migration in self.migrations:
+                if migration_version <= version:
+                    continue
+                logging.info(f"Applying schema migration {migration_version}: {description}")
+                migration(cursor)
+                cursor.execute("INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, CURRENT_TIMESTAMP)",
+                               (migration_version, description))
+                version = migration_version
+            return version
+
+        with self.db_worker.transaction():
+            return self.db_worker.execute(_op, wait=True)
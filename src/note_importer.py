@@ -0,0 +1,26 @@
+from note_service import NoteService
+
+class NoteImporter:
+    """
+    Creates many notes at once. Each batch goes through
+    NoteService.create_notes(), so it is written to every index inside a
+    single transaction and its FAISS vectors are added with one call once
+    the transaction has committed.
+    """
+    def __init__(self, db_worker, device_id, notes_repository, search_engine, lexical_index,
+                 faiss_engine, embedding_provider, change_log, lamport_clock):
+        self.note_service = NoteService(db_worker, device_id, notes_repository, search_engine, lexical_index,
+                                        faiss_engine, embedding_provider, change_log, lamport_clock)
+
+    def import_notes(self, notes, batch_size=500):
+        """ Imports (title, contents, tags) tuples and returns the new note ids. """
+        note_ids = []
+        batch = []
+        for note in notes:
+            batch.append(note)
+            if len(batch) == batch_size:
+                note_ids.extend(self.note_service.create_notes(batch))
+                batch = []
+        if batch:
+            note_ids.extend(self.note_service.create_notes(batch))
+        return note_ids
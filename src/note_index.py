@@ -1,3 +1,108 @@
+import math
+import heapq
+from collections import Counter, defaultdict
+
+# Postings are stored with integer ids. terms maps each token to a term_id
+# and keeps its document frequency, and note_stats maps each indexed note to
+# a doc_id and keeps its length. collection_stats holds the totals BM25
+# needs. All of them are updated with each token write, so a search never
+# has to aggregate the postings.
+
+# Stay well below SQLite's limit on bound parameters.
+_MAX_VARIABLES = 900
+
+def _create_index_tables(cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS terms(
+                    term_id INTEGER PRIMARY KEY,
+                    term TEXT NOT NULL UNIQUE,
+                    doc_freq INTEGER NOT NULL DEFAULT 0)""")
+    cursor.execute("""CREATE TABLE IF NOT EXISTS note_stats(
+                    doc_id INTEGER PRIMARY KEY,
+                    note_id TEXT NOT NULL UNIQUE,
+                    length INTEGER NOT NULL,
+                    FOREIGN KEY (note_id) REFERENCES notes (uuid))""")
+    cursor.execute("""CREATE TABLE IF NOT EXISTS postings(
+                    term_id INTEGER NOT NULL,
+                    doc_id INTEGER NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (term_id, doc_id)) WITHOUT ROWID""")
+    cursor.execute("CREATE INDEX IF NOT EXISTS postings_doc_idx ON postings(doc_id, term_id, count)")
+    cursor.execute("""CREATE TABLE IF NOT EXISTS collection_stats(
+                    id INTEGER PRIMARY KEY CHECK (id = 1) DEFAULT 1,
+                    document_count INTEGER NOT NULL,
+                    total_length INTEGER NOT NULL)""")
+    cursor.execute("INSERT OR IGNORE INTO collection_stats (id, document_count, total_length) VALUES (1, 0, 0)")
+
+def _lookup_ids(cursor, query, keys):
+    """ Runs `query`, which selects (key, id) WHERE key IN ({}), over `keys` in chunks. """
+    keys = list(keys)
+    ids = {}
+    for start in range(0, len(keys), _MAX_VARIABLES):
+        chunk = keys[start:start + _MAX_VARIABLES]
+        cursor.execute(query.format(", ".join("?" for _ in chunk)), chunk)
+        ids.update((row[0], row[1]) for row in cursor.fetchall())
+    return ids
+
+def _term_ids(cursor, tokens):
+    """ Maps tokens to their term_id, adding the ones the dictionary does not know yet. """
+    tokens = list(tokens)
+    cursor.executemany("INSERT OR IGNORE INTO terms (term) VALUES (?)", [(token,) for token in tokens])
+    return _lookup_ids(cursor, "SELECT term, term_id FROM terms WHERE term IN ({})", tokens)
+
+def _drop_postings(cursor, doc_id, term_ids):
+    cursor.executemany("DELETE FROM postings WHERE term_id = ? AND doc_id = ?", [(term_id, doc_id) for term_id in term_ids])
+    cursor.executemany("UPDATE terms SET doc_freq = doc_freq - 1 WHERE term_id = ?", [(term_id,) for term_id in term_ids])
+    cursor.executemany("DELETE FROM terms WHERE term_id = ? AND doc_freq <= 0", [(term_id,) for term_id in term_ids])
+
+def _add_postings(cursor, rows):
+    """ Adds (note_id, token, count) rows to the postings and every statistic. """
+    documents = defaultdict(Counter)
+    for note_id, token, count in rows:
+        # Keys come back from SQLite as text.
+        documents[str(note_id)][token] += count
+    if not documents:
+        return
+
+    doc_query = "SELECT note_id, doc_id FROM note_stats WHERE note_id IN ({})"
+    existing_docs = set(_lookup_ids(cursor, doc_query, documents))
+    cursor.executemany("INSERT INTO note_stats (note_id, length) VALUES (?, 0)",
+                       [(note_id,) for note_id in documents if note_id not in existing_docs])
+    doc_ids = _lookup_ids(cursor, doc_query, documents)
+
+    term_ids = _term_ids(cursor, dict.fromkeys(token for token_counts in documents.values() for token in token_counts))
+
+    postings = []
+    new_postings = Counter()
+    for note_id, token_counts in documents.items():
+        doc_id = doc_ids[note_id]
+        known_terms = set()
+        if note_id in existing_docs:
+            cursor.execute("SELECT term_id FROM postings WHERE doc_id = ?", (doc_id,))
+            known_terms = {row[0] for row in cursor.fetchall()}
+        for token, count in token_counts.items():
+            term_id = term_ids[token]
+            postings.append((term_id, doc_id, count))
+            if term_id not in known_terms:
+                new_postings[term_id] += 1
+
+    cursor.executemany("""INSERT INTO postings (term_id, doc_id, count) VALUES (?, ?, ?)
+                          ON CONFLICT (term_id, doc_id) DO UPDATE SET count = count + excluded.count""", postings)
+    cursor.executemany("UPDATE terms SET doc_freq = doc_freq + ? WHERE term_id = ?",
+                       [(documents_added, term_id) for term_id, documents_added in new_postings.items()])
+    lengths = [(sum(token_counts.values()), doc_ids[note_id]) for note_id, token_counts in documents.items()]
+    cursor.executemany("UPDATE note_stats SET length = length + ? WHERE doc_id = ?", lengths)
+    cursor.execute("UPDATE collection_stats SET document_count = document_count + ?, total_length = total_length + ? WHERE id = 1",
+                   (len(documents) - len(existing_docs), sum(length for length, _ in lengths)))
+
+def _remove_postings(cursor, note_id):
+    cursor.execute("DELETE FROM note_stats WHERE note_id = ? RETURNING doc_id, length", (note_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return
+    doc_id, length = row
+    cursor.execute("SELECT term_id FROM postings WHERE doc_id = ?", (doc_id,))
+    _drop_postings(cursor, doc_id, [row[0] for row in cursor.fetchall()])
+    cursor.execute("UPDATE collection_stats SET document_count = document_count - 1, total_length = total_length - ? WHERE id = 1", (length,))
 
 class NoteIndex:
     def __init__(self, db_worker):
@@ -6,62 +111,267 @@ class NoteIndex:
     def create_word_index_table(self):
         def _op(connection):
             cursor = connection.cursor()
-            cursor.execute("""CREATE TABLE IF NOT EXISTS tokens(
-                            id INTEGER PRIMARY KEY,
-                            note_id TEXT,
-                            token TEXT,
-                            count INTEGER,
-                            FOREIGN KEY (note_id) REFERENCES notes (uuid))""")
+            _create_index_tables(cursor)
         self.db_worker.execute(_op)
 
     def insert_token(self, note_id, token, count, commit=True):
+        """ Adds one posting and returns the note's doc_id. """
         def _op(connection, note_id, token, count, commit):
             cursor = connection.cursor()
-            cursor.execute("INSERT INTO tokens (note_id, token, count) VALUES(?, ?, ?)", (note_id, token, count))
+            _add_postings(cursor, [(note_id, token, count)])
+            cursor.execute("SELECT doc_id FROM note_stats WHERE note_id = ?", (note_id,))
+            doc_id = cursor.fetchone()[0]
             if commit:
                 connection.commit()
-            return cursor.lastrowid
+            return doc_id
         return self.db_worker.execute(_op, (note_id, token, count, commit), wait=True)
 
     def insert_many_tokens(self, rows):
         def _op(connection, rows):
             cursor = connection.cursor()
-            cursor.executemany("INSERT INTO tokens (note_id, token, count) VALUES (?, ?, ?)", rows)
+            _add_postings(cursor, rows)
             connection.commit()
-        self.db_worker.execute(_op, args=(rows,), wait=True)
+        self.db_worker.execute(_op, args=(list(rows),), wait=True)
 
     def retrieve_tokens_for_note(self, note_id):
         def _op(connection, note_id):
             cursor = connection.cursor()
-            cursor.execute("SELECT * FROM tokens WHERE note_id = ?", (note_id,))
+            cursor.execute("""SELECT note_stats.note_id, terms.term AS token, postings.count FROM note_stats
+                              JOIN postings ON postings.doc_id = note_stats.doc_id
+                              JOIN terms ON terms.term_id = postings.term_id
+                              WHERE note_stats.note_id = ?""", (note_id,))
             return cursor.fetchall()
-        return self.db_worker.execute(_op, (note_id,), wait=True)
+        return self.db_worker.execute(_op, (note_id,), wait=True, read=True)
+
+    def iter_tokens(self, batch_size=5000):
+        """
+        Streams every posting as (doc_id, term_id, note_id, token, count) rows
+        in doc_id order, `batch_size` rows per worker call.
+        """
+        def _op(connection, after, batch_size):
+            cursor = connection.cursor()
+            cursor.execute("""SELECT postings.doc_id, postings.term_id, note_stats.note_id, terms.term AS token, postings.count FROM postings
+                              JOIN note_stats ON note_stats.doc_id = postings.doc_id
+                              JOIN terms ON terms.term_id = postings.term_id
+                              WHERE (postings.doc_id, postings.term_id) > (?, ?)
+                              ORDER BY postings.doc_id, postings.term_id LIMIT ?""", (*after, batch_size))
+            return cursor.fetchall()
+
+        after = (0, 0)
+        while True:
+            rows = self.db_worker.execute(_op, args=(after, batch_size), wait=True, read=True)
+            yield from rows
+            if len(rows) < batch_size:
+                return
+            after = (rows[-1]["doc_id"], rows[-1]["term_id"])
 
     def retrieve_similar_tokens(self, token):
         def _op(connection, token):
             cursor = connection.cursor()
-            cursor.execute("SELECT note_id, count FROM tokens WHERE token = ?", (token,))
+            cursor.execute("""SELECT note_stats.note_id, postings.count FROM terms
+                              JOIN postings ON postings.term_id = terms.term_id
+                              JOIN note_stats ON note_stats.doc_id = postings.doc_id
+                              WHERE terms.term = ?""", (token,))
             return cursor.fetchall()
-        return self.db_worker.execute(_op, (token,), wait=True)
+        return self.db_worker.execute(_op, (token,), wait=True, read=True)
 
     def retrieve_agerage_document_length(self):
         def _op(connection):
             cursor = connection.cursor()
-            cursor.execute("SELECT AVG(doc_len) FROM (SELECT SUM(count) AS doc_len FROM tokens GROUP BY note_id)")
-            return cursor.fetchone()[0]
-        return self.db_worker.execute(_op, wait=True)
+            cursor.execute("SELECT CAST(total_length AS REAL) / document_count FROM collection_stats WHERE document_count > 0")
+            row = cursor.fetchone()
+            return row[0] if row else None
+        return self.db_worker.execute(_op, wait=True, read=True)
+
+    def retrieve_collection_stats(self):
+        """ Returns (document_count, total_length) of every indexed note. """
+        def _op(connection):
+            cursor = connection.cursor()
+            cursor.execute("SELECT document_count, total_length FROM collection_stats WHERE id = 1")
+            row = cursor.fetchone()
+            return (row[0], row[1]) if row else (0, 0)
+        return self.db_worker.execute(_op, wait=True, read=True)
+
+    def retrieve_note_length(self, note_id):
+        def _op(connection, note_id):
+            cursor = connection.cursor()
+            cursor.execute("SELECT length FROM note_stats WHERE note_id = ?", (note_id,))
+            row = cursor.fetchone()
+            return row[0] if row else 0
+        return self.db_worker.execute(_op, (note_id,), wait=True, read=True)
 
     def retrieve_term_frequency_in_document(self, note_id, token):
         def _op(connection, note_id, token):
             cursor = connection.cursor()
-            cursor.execute("SELECT count FROM tokens WHERE note_id = ? AND token = ?", (note_id, token))
-            return cursor.fetchone()[0]
-        return self.db_worker.execute(_op, (note_id, token), wait=True)
+            cursor.execute("""SELECT postings.count FROM terms
+                              JOIN postings ON postings.term_id = terms.term_id
+                              JOIN note_stats ON note_stats.doc_id = postings.doc_id
+                              WHERE terms.term = ? AND note_stats.note_id = ?""", (token, note_id))
+            row = cursor.fetchone()
+            return row[0] if row else 0
+        return self.db_worker.execute(_op, (note_id, token), wait=True, read=True)
+
+    def retrieve_document_frequency(self, token):
+        def _op(connection, token):
+            cursor = connection.cursor()
+            cursor.execute("SELECT doc_freq FROM terms WHERE term = ?", (token,))
+            row = cursor.fetchone()
+            return row[0] if row else 0
+        return self.db_worker.execute(_op, (token,), wait=True, read=True)
+
+    def retrieve_bm25_postings(self, tokens):
+        """
+        Gathers everything BM25 needs for the query tokens in one call:
+        the number of indexed notes, the average document length and a
+        (token, note_id, doc_freq, term_frequency, document_length) row for
+        every posting of each token.
+        """
+        def _op(connection, tokens):
+            cursor = connection.cursor()
+            cursor.execute("SELECT document_count, total_length FROM collection_stats WHERE id = 1")
+            row = cursor.fetchone()
+            total_notes, total_length = (row[0], row[1]) if row else (0, 0)
+            average_document_length = total_length / total_notes if total_notes else None
+
+            values = ", ".join("(?)" for _ in tokens)
+            cursor.execute(f"""
+                    WITH query(token) AS (VALUES {values})
+                    SELECT terms.term AS token, note_stats.note_id, terms.doc_freq,
+                           postings.count AS term_frequency, note_stats.length AS document_length
+                    FROM query JOIN terms ON terms.term = query.token
+                    JOIN postings ON postings.term_id = terms.term_id
+                    JOIN note_stats ON note_stats.doc_id = postings.doc_id""", tokens)
+            return total_notes, average_document_length, cursor.fetchall()
+        return self.db_worker.execute(_op, (list(tokens),), wait=True, read=True)
+
+    def retrieve_bm25_top_k(self, query_counts, k, k1=1.5, b=0.75):
+        """
+        The best `k` BM25 (note_id, score) pairs for {token: count in query},
+        scored on the reader thread with the term at a time MaxScore of
+        MemoryIndex._score_top_k. Nothing bounds a term's tf per note here,
+        but BM25's tf part stays below 1, so a term can add at most its idf
+        times its count in the query. Once the terms left can't lift an
+        unseen note into the top k, their postings are only looked up for
+        the current candidates, by primary key.
+        """
+        def _op(connection, query_counts, k, k1, b):
+            cursor = connection.cursor()
+            cursor.execute("SELECT document_count, total_length FROM collection_stats WHERE id = 1")
+            row = cursor.fetchone()
+            total_notes, total_length = (row[0], row[1]) if row else (0, 0)
+            if not total_notes:
+                return []
+            average_document_length = total_length / total_notes or 1
+
+            tokens = list(query_counts)
+            values = ", ".join("(?)" for _ in tokens)
+            cursor.execute(f"""WITH query(token) AS (VALUES {values})
+                               SELECT terms.term, terms.term_id, terms.doc_freq
+                               FROM query JOIN terms ON terms.term = query.token""", tokens)
+            terms = []
+            for token, term_id, doc_freq in cursor.fetchall():
+                if not doc_freq:
+                    continue
+                weight = math.log((total_notes-doc_freq+0.5)/(doc_freq+0.5)) * query_counts[token]
+                terms.append((weight, term_id))
+            if not terms:
+                return []
+
+            def score(count, length, weight):
+                return count / (count + k1 * (1 - b + b * (length / average_document_length))) * weight
+
+            terms.sort(key=lambda term: term[0], reverse=True)
+            # What the unvisited terms can still add to, or take from, a score.
+            upper = [0.0] * (len(terms) + 1)
+            lower = [0.0] * (len(terms) + 1)
+            for position in range(len(terms) - 1, -1, -1):
+                upper[position] = upper[position + 1] + max(0.0, terms[position][0])
+                lower[position] = lower[position + 1] + min(0.0, terms[position][0])
+
+            scores = {}
+            documents = {}
+            or_mode = True
+            for position, (weight, term_id) in enumerate(terms):
+                if or_mode:
+                    cursor.execute("""SELECT postings.doc_id, postings.count, note_stats.note_id, note_stats.length
+                                      FROM postings JOIN note_stats ON note_stats.doc_id = postings.doc_id
+                                      WHERE postings.term_id = ?""", (term_id,))
+                    for doc_id, count, note_id, length in cursor:
+                        documents[doc_id] = (note_id, length)
+                        scores[doc_id] = scores.get(doc_id, 0.0) + score(count, length, weight)
+                else:
+                    candidates = list(scores)
+                    for start in range(0, len(candidates), _MAX_VARIABLES):
+                        chunk = candidates[start:start + _MAX_VARIABLES]
+                        cursor.execute(f"SELECT doc_id, count FROM postings WHERE term_id = ? AND doc_id IN ({', '.join('?' * len(chunk))})",
+                                       [term_id, *chunk])
+                        for doc_id, count in cursor.fetchall():
+                            scores[doc_id] += score(count, documents[doc_id][1], weight)
+
+                if len(scores) < k:
+                    continue
+                # Every candidate ends with at least its score plus what the
+                # remaining terms could take away, so the k-th of those is a
+                # score the final top k is guaranteed to reach.
+                threshold = heapq.nlargest(k, scores.values())[-1] + lower[position + 1]
+                if or_mode and upper[position + 1] < threshold:
+                    or_mode = False
+                if not or_mode:
+                    scores = {doc_id: value for doc_id, value in scores.items() if value + upper[position + 1] >= threshold}
+
+            # Ties go to the lowest doc ids, as in MemoryIndex.
+            best = heapq.nsmallest(k, scores.items(), key=lambda item: (-item[1], item[0]))
+            return [(documents[doc_id][0], value) for doc_id, value in best]
+        return self.db_worker.execute(_op, (dict(query_counts), k, k1, b), wait=True, read=True)
+
+    def update_tokens_for_note(self, note_id, token_counts):
+        """
+        Makes the note's postings match {token: count} by writing only the
+        difference with what is stored: new terms are inserted, changed
+        counts updated and vanished terms deleted. Returns how many postings
+        were written.
+        """
+        def _op(connection, note_id, token_counts):
+            cursor = connection.cursor()
+            cursor.execute("SELECT doc_id, length FROM note_stats WHERE note_id = ?", (note_id,))
+            row = cursor.fetchone()
+            if row is None or not token_counts:
+                _remove_postings(cursor, note_id)
+                _add_postings(cursor, [(note_id, token, count) for token, count in token_counts.items()])
+                connection.commit()
+                return len(token_counts)
+
+            doc_id, old_length = row
+            cursor.execute("""SELECT terms.term, postings.term_id, postings.count FROM postings
+                              JOIN terms ON terms.term_id = postings.term_id
+                              WHERE postings.doc_id = ?""", (doc_id,))
+            stored = {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+
+            removed = [term_id for token, (term_id, _) in stored.items() if token not in token_counts]
+            changed = [(count, stored[token][0], doc_id) for token, count in token_counts.items()
+                       if token in stored and stored[token][1] != count]
+            added = [token for token in token_counts if token not in stored]
+
+            _drop_postings(cursor, doc_id, removed)
+            cursor.executemany("UPDATE postings SET count = ? WHERE term_id = ? AND doc_id = ?", changed)
+            if added:
+                term_ids = _term_ids(cursor, added)
+                cursor.executemany("INSERT INTO postings (term_id, doc_id, count) VALUES (?, ?, ?)",
+                                   [(term_ids[token], doc_id, token_counts[token]) for token in added])
+                cursor.executemany("UPDATE terms SET doc_freq = doc_freq + 1 WHERE term_id = ?", [(term_ids[token],) for token in added])
+
+            new_length = sum(token_counts.values())
+            if new_length != old_length:
+                cursor.execute("UPDATE note_stats SET length = ? WHERE doc_id = ?", (new_length, doc_id))
+                cursor.execute("UPDATE collection_stats SET total_length = total_length + ? WHERE id = 1", (new_length - old_length,))
+            connection.commit()
+            return len(removed) + len(changed) + len(added)
+        return self.db_worker.execute(_op, (note_id, dict(token_counts)), wait=True)
 
     def delete_tokens_for_note(self, note_id):
         def _op(connection, note_id):
             cursor = connection.cursor()
-            cursor.execute("DELETE FROM tokens WHERE note_id = ?", (note_id,))
+            _remove_postings(cursor, note_id)
             connection.commit()
         return self.db_worker.execute(_op, (note_id,), wait=True)
 
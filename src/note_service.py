@@ -0,0 +1,338 @@
+import logging
+from contextlib import contextmanager
+from embedding_codec import encode_embedding
+from notes_repository import changed_fields
+
+def _note_text(title, contents, tags):
+    return f"{title} {contents} {tags}"
+
+def _encode(vector):
+    return None if vector is None else encode_embedding(vector)
+
+def _edited_text(note, changes):
+    return _note_text(changes.get('title', note['title']), changes.get('contents', note['contents']),
+                      changes.get('tags', note['tags']))
+
+def _remote_operation(op_id, note_id, operation_type, payload, lamport_time):
+    return {"op_id": op_id, "note_id": note_id, "operation_type": operation_type,
+            "payload": payload, "lamport_clock": lamport_time}
+
+def _remote_steps(operations, notes):
+    """
+    Walks a peer's operations over `notes`, {note_id: stored note or None},
+    updating it as they go. Yields (operation, note before it, changes) for
+    each: the payload of a create, the changed fields of an update, {} for
+    a delete, or None for an operation that doesn't fit the local notes.
+    """
+    for operation in operations:
+        note_id = operation['note_id']
+        payload = operation['payload']
+        note = notes.get(note_id)
+        changes = None
+        if operation['operation_type'] == 'create' and note is None:
+            changes = payload
+            notes[note_id] = {"title": payload['title'], "contents": payload['contents'],
+                              "tags": payload['tags'], "deleted": 0}
+        elif operation['operation_type'] == 'update' and note is not None:
+            changes = changed_fields(note, title=payload.get('title', None),
+                                     contents=payload.get('contents', None),
+                                     tags=payload.get('tags', None))
+            notes[note_id] = {**dict(note), **changes}
+        elif operation['operation_type'] == 'delete' and note is not None:
+            changes = {}
+            notes[note_id] = {**dict(note), "deleted": 1}
+        yield operation, note, changes
+
+class NoteService:
+    """
+    Single entry point for creating, editing and deleting notes, whether the
+    change is made locally or arrives from a peer.
+
+    A mutation writes the notes table, the token and FTS indexes, the
+    Lamport clock and the change log inside one DB transaction, so it either
+    reaches all of them or none. Embeddings are computed before the
+    transaction opens, and FAISS, which lives outside SQLite, is only
+    changed once it has committed. Every method has a batch variant that
+    shares a single transaction across its notes.
+
+    With an EmbeddingQueue, notes are written without an embedding and
+    marked as pending, and the queue embeds them in the background. Lexical
+    search covers them as soon as the transaction commits.
+    """
+    def __init__(self, db_worker, device_id, notes_repository, search_engine, lexical_index,
+                 faiss_engine, embedding_provider, change_log, lamport_clock, embedding_queue=None):
+        self.db_worker = db_worker
+        self.device_id = device_id
+        self.notes_repo = notes_repository
+        self.search_engine = search_engine
+        self.lexical_index = lexical_index
+        self.faiss_engine = faiss_engine
+        self.embedding_provider = embedding_provider
+        self.change_log = change_log
+        self.lamport_clock = lamport_clock
+        self.embedding_queue = embedding_queue
+
+    @contextmanager
+    def _transaction(self, note_ids):
+        """
+        DB transaction for a mutation of `note_ids`. Yields a list that
+        _reserve and _receive add the clock's (before, after) Lamport times
+        to, so the clock can be put back on rollback.
+        """
+        ticks = []
+        try:
+            with self.db_worker.transaction():
+                yield ticks
+        except Exception:
+            # The in-memory BM25 index and Lamport clock are updated as the
+            # writes are queued, so they have to be put back after a rollback.
+            self.search_engine.reload_memory_index(note_ids)
+            if ticks:
+                self.lamport_clock.rewind(ticks[0][0], ticks[-1][1])
+            raise
+
+    def _reserve(self, ticks, count):
+        """ Reserves `count` Lamport times for local operations. """
+        before = self.lamport_clock.now()
+        timestamps = self.lamport_clock.reserve_lamport_times(count)
+        ticks.append((before, self.lamport_clock.now()))
+        return timestamps
+
+    def _receive(self, ticks, lamport_time):
+        """ Moves the clock past a peer operation's `lamport_time` and returns the new time. """
+        before = self.lamport_clock.now()
+        self.lamport_clock.increment_lamport_time(lamport_time)
+        ticks.append((before, self.lamport_clock.now()))
+        return self.lamport_clock.now()
+
+    def _embed(self, texts):
+        """
+        Embeds the texts in batches, or returns None for each when the
+        embedding queue will do it. Texts in a failed batch also get None,
+        their notes are left pending.
+        """
+        texts = list(texts)
+        if self.embedding_queue is not None:
+            return [None for _ in texts]
+        return self.embedding_provider.embed_many(texts)
+
+    def _vectors_by_text(self, texts):
+        """ Embeds the distinct texts with one _embed call, returns {text: vector}. """
+        texts = list(dict.fromkeys(texts))
+        return dict(zip(texts, self._embed(texts))) if texts else {}
+
+    def _publish(self, note_ids, vectors):
+        """ Hands the committed notes' vectors to FAISS, or their ids to the embedding queue. """
+        for note_id, vector in zip(note_ids, vectors):
+            if vector is None:
+                # The old vector no longer matches the note's text.
+                self.faiss_engine.delete_embedding(note_id)
+            else:
+                self.faiss_engine.update_embedding(note_id, vector)
+        if self.embedding_queue is not None:
+            self.embedding_queue.submit_many(note_ids)
+
+    def _log(self, operations):
+        """ Saves the clock and logs (note_id, operation_type, payload, lamport, origin, op_id) tuples. """
+        self.lamport_clock.save_lamport_time_to_db()
+        self.change_log.log_operations(operations)
+
+    def _write_updates(self, edits, vectors):
+        """
+        Rewrites the (note_id, stored note, changes) edits, with the vectors
+        in `vectors`, {text: vector}, that match their new text. Returns the
+        vector of each edit, None for those left pending.
+        """
+        edit_vectors = [vectors.get(_edited_text(note, changes)) for _, note, changes in edits]
+        for (note_id, _, changes), vector in zip(edits, edit_vectors):
+            self.notes_repo.update_note(note_id, embeddings=_encode(vector), **changes)
+            self.lexical_index.update_note_for_lexical_search(note_id, **changes)
+            self.search_engine.update_index(note_id)
+        pending = [note_id for (note_id, _, _), vector in zip(edits, edit_vectors) if vector is None]
+        if pending:
+            self.notes_repo.mark_embeddings_pending(pending)
+        return edit_vectors
+
+    def _write_deletes(self, note_ids):
+        for note_id in note_ids:
+            self.notes_repo.mark_note_as_deleted(note_id)
+            self.lexical_index.delete_note_from_lexical_search(note_id)
+            self.search_engine.remove_from_index(note_id)
+
+    def _write_remote_create(self, note_id, payload, vector):
+        self.notes_repo.insert_note(note_id, payload['title'], payload['contents'], payload['created_at'],
+                                    payload['last_updated'], _encode(vector), payload['tags'])
+        self.search_engine.index_notes([{"uuid": note_id, "title": payload['title'],
+                                         "contents": payload['contents'], "tags": payload['tags']}])
+        self.lexical_index.index_note_for_lexical_search(note_id, payload.get('title', ''),
+                                                         payload.get('contents', ''), payload.get('tags', ''))
+
+    def create_note(self, title, contents, tags):
+        """ Creates a note and returns its id. """
+        return self.create_notes([(title, contents, tags)])[0]
+
+    def create_notes(self, notes):
+        """ Creates (title, contents, tags) tuples in one transaction and returns the new note ids. """
+        notes = list(notes)
+        if not notes:
+            return []
+        vectors = self._embed(_note_text(*note) for note in notes)
+
+        note_ids = []
+        with self._transaction(note_ids) as ticks:
+            timestamps = self._reserve(ticks, len(notes))
+            created = self.notes_repo.create_notes_bulk(
+                [(title, contents, _encode(vector), tags) for (title, contents, tags), vector in zip(notes, vectors)])
+            note_ids.extend(note['uuid'] for note in created)
+
+            self.search_engine.index_notes(created)
+            self.lexical_index.index_notes_for_lexical_search([(note['uuid'], note['title'], note['contents'], note['tags']) for note in created])
+
+            self._log([(note['uuid'], "create", dict(note), timestamp, self.device_id, None)
+                       for note, timestamp in zip(created, timestamps)])
+
+        if self.embedding_queue is not None:
+            self.embedding_queue.submit_many(note_ids)
+        else:
+            embedded = [(note_id, vector) for note_id, vector in zip(note_ids, vectors) if vector is not None]
+            self.faiss_engine.add_embeddings([note_id for note_id, _ in embedded], [vector for _, vector in embedded])
+        self.search_engine.invalidate_cache()
+        logging.info(f"Created {len(note_ids)} notes.")
+        return note_ids
+
+    def update_note(self, note_id, title=None, contents=None, tags=None):
+        """
+        Applies the given fields that differ from the stored note. Returns
+        the changed fields, {} if nothing changed, or None if the note does
+        not exist or was deleted.
+        """
+        return self.update_notes([(note_id, {"title": title, "contents": contents, "tags": tags})])[0]
+
+    def update_notes(self, updates):
+        """ Batch update_note for (note_id, {field: value}) pairs, returning one result per pair. """
+        updates = list(updates)
+        note_ids = [note_id for note_id, _ in updates]
+
+        # The new texts are embedded before the transaction, from the notes
+        # as they are now. A note changed again in between gets no vector
+        # for its text and is left pending.
+        texts = []
+        for (_, fields), note in zip(updates, self.notes_repo.get_notes(note_ids)):
+            changes = changed_fields(note, **fields) if note is not None and note['deleted'] != 1 else None
+            if changes:
+                texts.append(_edited_text(note, changes))
+        vectors = self._vectors_by_text(texts)
+
+        results = []
+        edits = []
+        edit_vectors = []
+        with self._transaction(note_ids) as ticks:
+            for (note_id, fields), note in zip(updates, self.notes_repo.get_notes(note_ids)):
+                if note is None or note['deleted'] == 1:
+                    results.append(None)
+                    continue
+                changes = changed_fields(note, **fields)
+                results.append(changes)
+                if changes:
+                    edits.append((note_id, note, changes))
+            if edits:
+                timestamps = self._reserve(ticks, len(edits))
+                edit_vectors = self._write_updates(edits, vectors)
+                self._log([(note_id, "update", dict(changes), timestamp, self.device_id, None)
+                           for (note_id, _, changes), timestamp in zip(edits, timestamps)])
+
+        if edits:
+            self._publish([note_id for note_id, _, _ in edits], edit_vectors)
+            self.search_engine.invalidate_cache()
+        return results
+
+    def delete_note(self, note_id):
+        self.delete_notes([note_id])
+
+    def delete_notes(self, note_ids):
+        """ Marks the notes as deleted and drops them from every index in one transaction. """
+        note_ids = list(note_ids)
+        if not note_ids:
+            return
+        with self._transaction(note_ids) as ticks:
+            timestamps = self._reserve(ticks, len(note_ids))
+            self._write_deletes(note_ids)
+            self._log([(note_id, "delete", {"deleted": 1}, timestamp, self.device_id, None)
+                       for note_id, timestamp in zip(note_ids, timestamps)])
+
+        for note_id in note_ids:
+            self.faiss_engine.delete_embedding(note_id)
+        self.search_engine.invalidate_cache()
+
+    def apply_remote_operations(self, operations, origin_device):
+        """
+        Applies a peer's operations in order and in one transaction,
+        skipping the ones that don't fit the local notes: a create of a
+        note that exists, an update or delete of one that doesn't. The texts
+        of every created and updated note are embedded together before the
+        transaction opens. Returns the number of operations applied.
+        """
+        operations = list(operations)
+        if not operations:
+            return 0
+        note_ids = list(dict.fromkeys(operation['note_id'] for operation in operations))
+
+        texts = []
+        for operation, note, changes in _remote_steps(operations, dict(zip(note_ids, self.notes_repo.get_notes(note_ids)))):
+            if operation['operation_type'] == 'create' and changes is not None:
+                texts.append(_note_text(changes['title'], changes['contents'], changes['tags']))
+            elif operation['operation_type'] == 'update' and changes:
+                texts.append(_edited_text(note, changes))
+        vectors = self._vectors_by_text(texts)
+
+        logged = []
+        published = {}
+        deleted = set()
+        with self._transaction(note_ids) as ticks:
+            # Walked again over the notes as they are inside the transaction.
+            stored = dict(zip(note_ids, self.notes_repo.get_notes(note_ids)))
+            for operation, note, changes in _remote_steps(operations, stored):
+                note_id = operation['note_id']
+                operation_type = operation['operation_type']
+                if changes is None:
+                    logging.warning(f"Skipping remote {operation_type} of note {note_id}, it doesn't match the local notes.")
+                    continue
+                timestamp = self._receive(ticks, operation['lamport_clock'])
+                if operation_type == 'create':
+                    vector = vectors.get(_note_text(changes['title'], changes['contents'], changes['tags']))
+                    self._write_remote_create(note_id, operation['payload'], vector)
+                    published[note_id] = vector
+                elif operation_type == 'update':
+                    # Always logged, even when nothing changed, so it is not replayed.
+                    if changes:
+                        published[note_id] = self._write_updates([(note_id, note, changes)], vectors)[0]
+                else:
+                    self._write_deletes([note_id])
+                    deleted.add(note_id)
+                logged.append((note_id, operation_type, operation['payload'], timestamp, origin_device, operation['op_id']))
+            if logged:
+                self._log(logged)
+
+        live = [note_id for note_id in published if note_id not in deleted]
+        self._publish(live, [published[note_id] for note_id in live])
+        for note_id in deleted:
+            self.faiss_engine.delete_embedding(note_id)
+        if published or deleted:
+            self.search_engine.invalidate_cache()
+        logging.info(f"Applied {len(logged)} of {len(operations)} operations from {origin_device}.")
+        return len(logged)
+
+    def apply_remote_create(self, note_id, payload, lamport_time, origin_device, op_id):
+        """ Inserts a note created on a peer under its original id and logs the peer's operation. """
+        self.apply_remote_operations([_remote_operation(op_id, note_id, "create", payload, lamport_time)], origin_device)
+
+    def apply_remote_update(self, note_id, payload, lamport_time, origin_device, op_id):
+        """
+        Applies a peer's update. Only fields that really changed are
+        rewritten and reindexed, but the operation is always logged so it
+        is not replayed.
+        """
+        self.apply_remote_operations([_remote_operation(op_id, note_id, "update", payload, lamport_time)], origin_device)
+
+    def apply_remote_delete(self, note_id, lamport_time, origin_device, op_id):
+        self.apply_remote_operations([_remote_operation(op_id, note_id, "delete", {"deleted": 1}, lamport_time)], origin_device)
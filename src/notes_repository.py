@@ -1,6 +1,33 @@
 import uuid
+from datetime import datetime, timezone
 from hashing import compute_note_hash
 
+# Columns of the notes table. Embeddings live in note_embeddings so reading
+# notes never drags the vectors along.
+NOTE_FIELDS = ("uuid", "title", "contents", "created_at", "last_updated", "tags", "deleted", "note_hash", "pending_embedding")
+# What listings and search results show.
+DISPLAY_FIELDS = ("uuid", "title", "contents", "created_at", "last_updated", "tags", "deleted")
+
+def _columns(fields):
+    if fields is None:
+        fields = NOTE_FIELDS
+    unknown = [field for field in fields if field not in NOTE_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown note fields: {unknown}")
+    return ", ".join(fields)
+
+def changed_fields(note, **fields):
+    """ The given fields that are not None and differ from the stored note. """
+    return {field: value for field, value in fields.items() if value is not None and value != note[field]}
+
+def _store_embedding(cursor, note_id, embeddings):
+    cursor.execute("INSERT OR REPLACE INTO note_embeddings (note_id, embedding) VALUES (?, ?)", (note_id, embeddings))
+
+def _load_embedding(cursor, note_id):
+    cursor.execute("SELECT embedding FROM note_embeddings WHERE note_id = ?", (note_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
 class NotesRepository:
     def __init__(self, db_worker):
         self.db_worker = db_worker
@@ -14,10 +41,14 @@ class NotesRepository:
                             contents TEXT,
                             created_at DATETIME,
                             last_updated DATETIME,
-                            embeddings BLOB,
                             tags TEXT,
                             deleted BOOLEAN DEFAULT 0,
-                            note_hash TEXT)""")
+                            note_hash TEXT,
+                            pending_embedding INTEGER NOT NULL DEFAULT 0)""")
+            cursor.execute("""CREATE TABLE IF NOT EXISTS note_embeddings(
+                            note_id TEXT PRIMARY KEY,
+                            embedding BLOB,
+                            FOREIGN KEY (note_id) REFERENCES notes (uuid))""")
         self.db_worker.execute(_op)
 
     def create_note(self, title, contents, embeddings, tags):
@@ -25,59 +56,215 @@ class NotesRepository:
             cursor = connection.cursor()
             unique_id = str(uuid.uuid4())
             note_hash = compute_note_hash(title, contents, tags, embeddings, deleted=0)
-            cursor.execute("INSERT INTO notes (uuid, title, contents, created_at, last_updated, embeddings, tags, note_hash) VALUES(?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, ?, ?, ?)", (unique_id, title, contents, embeddings, tags, note_hash))
+            cursor.execute("INSERT INTO notes (uuid, title, contents, created_at, last_updated, tags, note_hash, pending_embedding) VALUES(?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, ?, ?, ?)",
+                           (unique_id, title, contents, tags, note_hash, embeddings is None))
+            if embeddings is not None:
+                _store_embedding(cursor, unique_id, embeddings)
             connection.commit()
             return unique_id
         return self.db_worker.execute(_op, args=(title, contents, embeddings, tags), wait=True)
 
+    def create_notes_bulk(self, notes):
+        """
+        Inserts (title, contents, embeddings, tags) tuples with executemany in
+        one worker call. Notes without embeddings are marked as pending.
+        Returns the new notes as dicts shaped like get_note().
+        """
+        def _op(connection, notes):
+            cursor = connection.cursor()
+            # Same format as CURRENT_TIMESTAMP so bulk notes look like the others.
+            now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+            created = []
+            embedding_rows = []
+            for title, contents, embeddings, tags in notes:
+                note_id = str(uuid.uuid4())
+                created.append({"uuid": note_id, "title": title, "contents": contents,
+                                "created_at": now, "last_updated": now, "tags": tags, "deleted": 0,
+                                "note_hash": compute_note_hash(title, contents, tags, embeddings, deleted=0)})
+                if embeddings is not None:
+                    embedding_rows.append((note_id, embeddings))
+
+            embedded = {note_id for note_id, _ in embedding_rows}
+            cursor.executemany("INSERT INTO notes (uuid, title, contents, created_at, last_updated, tags, note_hash, pending_embedding) VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+                               [(n["uuid"], n["title"], n["contents"], n["created_at"], n["last_updated"], n["tags"], n["note_hash"], n["uuid"] not in embedded)
+                                for n in created])
+            cursor.executemany("INSERT OR REPLACE INTO note_embeddings (note_id, embedding) VALUES (?, ?)", embedding_rows)
+            connection.commit()
+            return created
+        return self.db_worker.execute(_op, args=(list(notes),), wait=True)
+
     def insert_note(self, uuid, title, contents, created_at, last_updated, embeddings, tags):
         def _op(connection, uuid, title, contents, created_at, last_updated, embeddings, tags):
             cursor = connection.cursor()
             note_hash = compute_note_hash(title, contents, tags, embeddings, deleted=0)
-            cursor.execute("INSERT INTO notes (uuid, title, contents, created_at, last_updated, embeddings, tags, note_hash) VALUES(?, ?, ?, ?, ?, ?, ?, ?)", (uuid, title, contents, created_at, last_updated, embeddings, tags, note_hash))
+            cursor.execute("INSERT INTO notes (uuid, title, contents, created_at, last_updated, tags, note_hash, pending_embedding) VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+                           (uuid, title, contents, created_at, last_updated, tags, note_hash, embeddings is None))
+            if embeddings is not None:
+                _store_embedding(cursor, uuid, embeddings)
             connection.commit()
         self.db_worker.execute(_op, args=(uuid, title, contents, created_at, last_updated, embeddings, tags), wait=True)
 
-    def get_note(self, note_id):
+    def get_note(self, note_id, fields=None):
+        """ Returns the note's row with only `fields` (all note columns by default), or None. """
+        columns = _columns(fields)
         def _op(connection, note_id):
             cursor = connection.cursor()
-            cursor.execute("SELECT * FROM notes WHERE uuid=(?)", (note_id,))
+            cursor.execute(f"SELECT {columns} FROM notes WHERE uuid=(?)", (note_id,))
             return cursor.fetchone()
-        return self.db_worker.execute(_op, args=(note_id,), wait=True)
+        return self.db_worker.execute(_op, args=(note_id,), wait=True, read=True)
+
+    def get_notes(self, note_ids, fields=None):
+        """
+        get_note for many ids with one query per 900 of them, in the order
+        asked for and None for missing notes. The rows always carry uuid.
+        """
+        note_ids = list(note_ids)
+        if fields is not None and "uuid" not in fields:
+            fields = ("uuid", *fields)
+        columns = _columns(fields)
+        def _op(connection, note_ids):
+            cursor = connection.cursor()
+            placeholders = ",".join("?" * len(note_ids))
+            cursor.execute(f"SELECT {columns} FROM notes WHERE uuid IN ({placeholders})", note_ids)
+            return cursor.fetchall()
+        # Chunked under SQLite's default limit of 999 bound parameters.
+        distinct = list(dict.fromkeys(note_ids))
+        chunks = [distinct[start:start + 900] for start in range(0, len(distinct), 900)]
+        notes = {}
+        for rows in self.db_worker.execute_batch([(_op, (chunk,)) for chunk in chunks], read=True):
+            notes.update((row["uuid"], row) for row in rows)
+        return [notes.get(note_id) for note_id in note_ids]
+
+    def get_note_embedding(self, note_id):
+        def _op(connection, note_id):
+            return _load_embedding(connection.cursor(), note_id)
+        return self.db_worker.execute(_op, args=(note_id,), wait=True, read=True)
 
     def get_number_of_non_deleted_notes(self):
         def _op(connection):
             cursor = connection.cursor()
             cursor.execute("SELECT COUNT(*) FROM notes WHERE deleted = 0")
             return cursor.fetchone()[0]
-        return self.db_worker.execute(_op, wait=True)
+        return self.db_worker.execute(_op, wait=True, read=True)
 
-    def list_all_notes(self, include_deleted=False):
+    def list_notes(self, fields=None, include_deleted=False):
+        columns = _columns(fields)
         def _op(connection, include_deleted):
             cursor = connection.cursor()
             if include_deleted:
-                query = "SELECT * FROM notes"
+                query = f"SELECT {columns} FROM notes"
             else:
-                query = "SELECT * FROM notes WHERE deleted != 1"
+                query = f"SELECT {columns} FROM notes WHERE deleted != 1"
             cursor.execute(query)
             return cursor.fetchall()
-        return self.db_worker.execute(_op, args=(include_deleted,), wait=True)
+        return self.db_worker.execute(_op, args=(include_deleted,), wait=True, read=True)
+
+    def list_all_notes(self, include_deleted=False):
+        return self.list_notes(include_deleted=include_deleted)
+
+    def iter_notes(self, batch_size=500, fields=None, include_deleted=False):
+        """
+        Yields notes in rowid order, fetching `batch_size` rows per worker
+        call with keyset pagination, so memory stays flat however large the
+        notes table grows. Like iter_embeddings' rows they also carry their
+        rowid as position.
+        """
+        columns = _columns(fields)
+        deleted_filter = "" if include_deleted else "AND deleted != 1"
+        def _op(connection, after, batch_size):
+            cursor = connection.cursor()
+            cursor.execute(f"SELECT rowid AS position, {columns} FROM notes WHERE rowid > ? {deleted_filter} ORDER BY rowid LIMIT ?",
+                           (after, batch_size))
+            return cursor.fetchall()
+
+        after = 0
+        while True:
+            rows = self.db_worker.execute(_op, args=(after, batch_size), wait=True, read=True)
+            yield from rows
+            if len(rows) < batch_size:
+                return
+            after = rows[-1]["position"]
+
+    def iter_embeddings(self, batch_size=500):
+        """ Streams the rows of list_embeddings() `batch_size` at a time. """
+        def _op(connection, after, batch_size):
+            cursor = connection.cursor()
+            cursor.execute("""SELECT note_embeddings.rowid AS position, notes.uuid, note_embeddings.embedding FROM note_embeddings
+                              JOIN notes ON notes.uuid = note_embeddings.note_id
+                              WHERE note_embeddings.rowid > ? AND notes.deleted != 1 AND notes.pending_embedding = 0
+                              ORDER BY note_embeddings.rowid LIMIT ?""", (after, batch_size))
+            return cursor.fetchall()
+
+        after = 0
+        while True:
+            rows = self.db_worker.execute(_op, args=(after, batch_size), wait=True, read=True)
+            yield from rows
+            if len(rows) < batch_size:
+                return
+            after = rows[-1]["position"]
+
+    def list_embeddings(self):
+        """ (uuid, embedding) rows of every non deleted note with an up to date vector. """
+        def _op(connection):
+            cursor = connection.cursor()
+            cursor.execute("""SELECT notes.uuid, note_embeddings.embedding FROM notes
+                              JOIN note_embeddings ON note_embeddings.note_id = notes.uuid
+                              WHERE notes.deleted != 1 AND notes.pending_embedding = 0""")
+            return cursor.fetchall()
+        return self.db_worker.execute(_op, wait=True, read=True)
+
+    def list_pending_embeddings(self, limit=-1):
+        """ Ids of the non deleted notes still waiting for an embedding, oldest first. """
+        def _op(connection, limit):
+            cursor = connection.cursor()
+            cursor.execute("SELECT uuid FROM notes WHERE pending_embedding = 1 AND deleted != 1 ORDER BY rowid LIMIT ?", (limit,))
+            return [row[0] for row in cursor.fetchall()]
+        return self.db_worker.execute(_op, args=(limit,), wait=True, read=True)
+
+    def mark_embeddings_pending(self, note_ids):
+        """ Flags notes whose text changed so their embedding is recomputed, dropping the stale one. """
+        def _op(connection, note_ids):
+            cursor = connection.cursor()
+            cursor.executemany("UPDATE notes SET pending_embedding = 1 WHERE uuid = ?", [(note_id,) for note_id in note_ids])
+            cursor.executemany("DELETE FROM note_embeddings WHERE note_id = ?", [(note_id,) for note_id in note_ids])
+            connection.commit()
+        self.db_worker.execute(_op, args=(list(note_ids),), wait=True)
+
+    def complete_embedding(self, note_id, title, contents, tags, embeddings):
+        """
+        Stores the embedding computed from (title, contents, tags) and clears
+        the pending flag, unless the note was deleted or edited since that
+        text was read. Returns whether the embedding was stored.
+        """
+        def _op(connection, note_id, title, contents, tags, embeddings):
+            cursor = connection.cursor()
+            cursor.execute("SELECT title, contents, tags, deleted FROM notes WHERE uuid = ?", (note_id,))
+            current_note = cursor.fetchone()
+            if current_note is None or tuple(current_note) != (title, contents, tags, 0):
+                return False
+
+            _store_embedding(cursor, note_id, embeddings)
+            note_hash = compute_note_hash(title, contents, tags, embeddings, deleted=0)
+            cursor.execute("UPDATE notes SET note_hash = ?, pending_embedding = 0 WHERE uuid = ?", (note_hash, note_id))
+            connection.commit()
+            return True
+        return self.db_worker.execute(_op, args=(note_id, title, contents, tags, embeddings), wait=True)
 
     def update_note(self, note_id, title=None, contents=None, embeddings=None, tags=None):
         def _op(connection, note_id, title, contents, embeddings, tags):
             cursor = connection.cursor()
 
-            cursor.execute("SELECT * FROM notes WHERE uuid = ?", (note_id,))
+            cursor.execute("SELECT title, contents, tags, deleted FROM notes WHERE uuid = ?", (note_id,))
             current_note = cursor.fetchone()
 
             if current_note is None:
                 return None
 
-            _, cur_title, cur_contents, _, _, cur_embeddings, cur_tags, cur_deleted, _, = current_note
+            cur_title, cur_contents, cur_tags, cur_deleted = current_note
 
             new_title = title if title is not None else cur_title
             new_contents = contents if contents is not None else cur_contents
-            new_embeddings = embeddings if embeddings is not None else cur_embeddings
+            new_embeddings = embeddings if embeddings is not None else _load_embedding(cursor, note_id)
             new_tags = tags if tags is not None else cur_tags
 
             new_hash = compute_note_hash(new_title, new_contents, new_tags, new_embeddings, cur_deleted)
@@ -94,18 +281,20 @@ class NotesRepository:
                 params.append(new_contents)
 
             if embeddings is not None:
-                updates.append("embeddings = ?")
-                params.append(new_embeddings)
+                _store_embedding(cursor, note_id, new_embeddings)
+                updates.append("pending_embedding = 0")
 
             if tags is not None:
                 updates.append("tags = ?")
                 params.append(new_tags)
 
-            updates.append("last_updated = CURRENT_TIMESTAMP")
-
-            if not params and len(updates) == 1:
+            if not params and embeddings is None:
                 return None
 
+            updates.append("note_hash = ?")
+            params.append(new_hash)
+            updates.append("last_updated = CURRENT_TIMESTAMP")
+
             query = f"UPDATE notes SET {', '.join(updates)} WHERE uuid = ?"
             params.append(note_id)
 
@@ -117,13 +306,14 @@ class NotesRepository:
         def _op(connection, note_id):
             cursor = connection.cursor()
 
-            cursor.execute("SELECT * FROM notes WHERE uuid = ?", (note_id,))
+            cursor.execute("SELECT title, contents, tags FROM notes WHERE uuid = ?", (note_id,))
             current_note = cursor.fetchone()
 
             if current_note is None:
                 return None
 
-            _, title, contents, _, _, embeddings, tags, _, _ = current_note
+            title, contents, tags = current_note
+            embeddings = _load_embedding(cursor, note_id)
 
             new_hash = compute_note_hash(title, contents, tags, embeddings, deleted=1)
             cursor.execute("UPDATE notes SET deleted = 1, note_hash = ?, last_updated = CURRENT_TIMESTAMP WHERE uuid = ?", (new_hash, note_id))
@@ -0,0 +1,73 @@
+import math
+import logging
+import threading
+from collections import defaultdict, deque
+
+def percentile(sorted_samples, fraction):
+    """ Nearest-rank percentile of an already sorted list. """
+    if not sorted_samples:
+        return None
+    rank = max(1, math.ceil(fraction * len(sorted_samples)))
+    return sorted_samples[rank - 1]
+
+def summarize(samples):
+    ordered = sorted(samples)
+    return {"p50": percentile(ordered, 0.50),
+            "p95": percentile(ordered, 0.95),
+            "p99": percentile(ordered, 0.99),
+            "max": ordered[-1] if ordered else None}
+
+class OperationStats:
+    """
+    Thread safe latency recorder keyed by operation name.
+
+    Keeps the last `max_samples` wait and run times per operation so
+    percentiles reflect recent behaviour, plus running totals. Operations
+    that run for at least `slow_threshold` seconds are logged and kept in a
+    bounded slow-operation log.
+    """
+    def __init__(self, max_samples=1024, slow_threshold=None, max_slow_ops=100):
+        self.max_samples = max_samples
+        self.slow_threshold = slow_threshold
+        self._lock = threading.Lock()
+        self._operations = defaultdict(self._new_operation)
+        self._slow = deque(maxlen=max_slow_ops)
+
+    def _new_operation(self):
+        return {"count": 0, "errors": 0, "rows": 0, "total_time": 0.0,
+                "wait": deque(maxlen=self.max_samples),
+                "run": deque(maxlen=self.max_samples)}
+
+    def record(self, name, wait, duration, size=0, failed=False):
+        with self._lock:
+            operation = self._operations[name]
+            operation["count"] += 1
+            operation["rows"] += size
+            operation["total_time"] += duration
+            operation["wait"].append(wait)
+            operation["run"].append(duration)
+            if failed:
+                operation["errors"] += 1
+
+            slow = self.slow_threshold is not None and duration >= self.slow_threshold
+            if slow:
+                self._slow.append({"name": name, "wait": wait, "duration": duration, "size": size})
+
+        if slow:
+            logging.warning("Slow operation %s took %.1f ms after waiting %.1f ms.", name, duration * 1000, wait * 1000)
+
+    def snapshot(self):
+        with self._lock:
+            operations = {name: {"count": op["count"],
+                                 "errors": op["errors"],
+                                 "rows": op["rows"],
+                                 "total_time": op["total_time"],
+                                 "wait": summarize(op["wait"]),
+                                 "run": summarize(op["run"])}
+                          for name, op in self._operations.items()}
+            return {"operations": operations, "slow_operations": list(self._slow)}
+
+    def reset(self):
+        with self._lock:
+            self._operations.clear()
+            self._slow.clear()
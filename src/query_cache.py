@@ -0,0 +1,74 @@
+import sys
+import threading
+from collections import OrderedDict
+
+def normalize_query(query):
+    """ Case and whitespace insensitive form of a query, used in cache keys. """
+    return " ".join(query.lower().split())
+
+def estimate_size(results):
+    """ Rough number of bytes held by a list of (note_id, score) results. """
+    if not results:
+        return sys.getsizeof(results)
+    note_id, score = results[0]
+    per_result = sys.getsizeof(results[0]) + sys.getsizeof(note_id) + sys.getsizeof(score)
+    return sys.getsizeof(results) + per_result * len(results)
+
+class QueryCache:
+    """
+    LRU cache of search results bounded by entry count and estimated bytes.
+
+    Every change to the corpus must call invalidate(), which empties the
+    cache and bumps `generation`. A search reads the generation before it
+    starts and hands it back to put(), so results computed against data that
+    changed mid-search are never stored.
+    """
+    def __init__(self, max_entries=256, max_bytes=4 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Returns a copy of the cached results for `key`, or None. """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return list(entry[0])
+
+    def put(self, key, results, generation):
+        size = estimate_size(results)
+        with self._lock:
+            if generation != self.generation or size > self.max_bytes:
+                return
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (list(results), size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.generation += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else None,
+                    "evictions": self.evictions, "entries": len(self._entries),
+                    "bytes": self._bytes, "generation": self.generation}
@@ -1,37 +1,127 @@
 import math
+import time
 import logging
+import threading
 import numpy as np
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from collections import Counter, defaultdict
+from query_cache import normalize_query
+
+LEXICAL_ENGINES = ("bm25", "fts5")
+# Notes longer than this many characters are tokenized in chunks with
+# Tokenizer.iter_tokens, so their full token list is never held in memory.
+STREAMING_TOKENIZE_CHARS = 65536
+
+class HybridResults(list):
+    """ (note_id, score) pairs from hybrid_search. `partial` is set when the semantic leg is missing from them. """
+    def __init__(self, results=(), partial=False):
+        super().__init__(results)
+        self.partial = partial
 
 class SearchEngine:
-    def __init__(self, notes_repo, notes_index, lexical_index, faiss_engine, emb_prov, tokenizer):
+    def __init__(self, notes_repo, notes_index, lexical_index, faiss_engine, emb_prov, tokenizer, memory_index=None, query_cache=None,
+                 search_workers=2):
         self.notes_repo = notes_repo
         self.notes_index = notes_index
         self.lexical_index = lexical_index
         self.embedding_database = faiss_engine
         self.embedding_provider = emb_prov
         self.tokenizer = tokenizer
+        # Optional MemoryIndex. When set it answers lexical_search and is kept
+        # in step with the tokens table.
+        self.memory_index = memory_index
+        # Optional QueryCache for hybrid_search results.
+        self.query_cache = query_cache
+        # Threads running the semantic leg of hybrid searches, started on first use.
+        self.search_workers = search_workers
+        self._executor = None
+        self._legs_lock = threading.Lock()
+        self._running_legs = 0
+
+    def _semantic_executor(self):
+        with self._legs_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.search_workers, thread_name_prefix="semantic-search")
+            return self._executor
+
+    def shutdown(self):
+        """ Stops the search threads without waiting on legs still running. """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def invalidate_cache(self):
+        """ Called once a change to the notes has reached every index. """
+        if self.query_cache is not None:
+            self.query_cache.invalidate()
+
+    def _count_tokens(self, text):
+        """ Token counts of a note's text, streamed for long notes. """
+        if len(text) > STREAMING_TOKENIZE_CHARS:
+            return self.tokenizer.count(self.tokenizer.iter_tokens(text))
+        return self.tokenizer.count(self.tokenizer.tokenize(text))
 
     def index_note(self, note_id):
-        note = self.notes_repo.get_note(note_id)
+        note = self.notes_repo.get_note(note_id, fields=("title", "contents", "tags"))
 
         if note is None:
             logging.error(f"Could not index node with ID {note_id} because it does not exist.")
             return
 
         note_text = f"{note['title']} {note['contents']} {note['tags']}"
-        tokens = self.tokenizer.tokenize(note_text)
-        token_count = self.tokenizer.count(tokens)
-        
+        token_count = self._count_tokens(note_text)
+
         rows = [(note_id, token, count) for token, count in token_count.items()]
         self.notes_index.insert_many_tokens(rows)
+        if self.memory_index is not None:
+            self.memory_index.add_document(note_id, token_count)
+
+    def index_notes(self, notes):
+        """ Bulk variant of index_note taking rows with uuid, title, contents and tags. """
+        rows = []
+        documents = []
+        notes = list(notes)
+        texts = [f"{note['title']} {note['contents']} {note['tags']}" for note in notes]
+        short = [text for text in texts if len(text) <= STREAMING_TOKENIZE_CHARS]
+        token_lists = iter(self.tokenizer.tokenize_many(short))
+        for note, text in zip(notes, texts):
+            if len(text) <= STREAMING_TOKENIZE_CHARS:
+                token_count = self.tokenizer.count(next(token_lists))
+            else:
+                token_count = self.tokenizer.count(self.tokenizer.iter_tokens(text))
+            rows.extend((note['uuid'], token, count) for token, count in token_count.items())
+            documents.append((note['uuid'], token_count))
+        self.notes_index.insert_many_tokens(rows)
+        if self.memory_index is not None:
+            self.memory_index.add_documents(documents)
 
     def update_index(self, note_id):
-        self.notes_index.delete_tokens_for_note(note_id)
-        self.index_note(note_id)
+        """ Reindexes an edited note, writing only the postings whose counts changed. """
+        note = self.notes_repo.get_note(note_id, fields=("title", "contents", "tags"))
+
+        if note is None:
+            logging.error(f"Could not reindex node with ID {note_id} because it does not exist.")
+            self.remove_from_index(note_id)
+            return
+
+        note_text = f"{note['title']} {note['contents']} {note['tags']}"
+        token_count = self._count_tokens(note_text)
+
+        self.notes_index.update_tokens_for_note(note_id, token_count)
+        if self.memory_index is not None:
+            self.memory_index.add_document(note_id, token_count)
 
     def remove_from_index(self, note_id):
         self.notes_index.delete_tokens_for_note(note_id)
+        if self.memory_index is not None:
+            self.memory_index.remove_document(note_id)
+
+    def reload_memory_index(self, note_ids):
+        """ Puts the in-memory index back in step with the stored postings of `note_ids`, e.g. after a rollback. """
+        if self.memory_index is None:
+            return
+        for note_id in note_ids:
+            rows = self.notes_index.retrieve_tokens_for_note(note_id)
+            self.memory_index.add_document(note_id, {row['token']: row['count'] for row in rows})
 
     def search(self, user_query):
         query_tokens = self.tokenizer.tokenize(user_query)
@@ -52,37 +142,38 @@ class SearchEngine:
         final_result = list(result_scores.items())
         return sorted(final_result, key=lambda x: x[1], reverse=True)
 
-    def lexical_search(self, user_query, k1=1.5, b=0.75):
-        query_tokens = self.tokenizer.tokenize(user_query)
-        total_num_notes = self.notes_repo.get_number_of_non_deleted_notes()
-        average_document_length = self.notes_index.retrieve_agerage_document_length()
-
-        bm25_scores = defaultdict(float)
+    def lexical_search(self, user_query, k1=1.5, b=0.75, k=None):
+        """ BM25 ranked (note_id, score) pairs, all of them or only the best `k`. """
+        # A token repeated in the query counts once per occurrence.
+        query_tokens = Counter(self.tokenizer.tokenize(user_query))
+        if not query_tokens:
+            return []
 
-        for token in query_tokens:
-            # Returns all document UUIDs that contain the token.
-            results = self.lexical_index.search_lexical_index(token)
-            notes_containing_token = len(results)
+        if self.memory_index is not None:
+            return self.memory_index.search(query_tokens, k1, b, k)
+        if k is not None:
+            return self.notes_index.retrieve_bm25_top_k(query_tokens, k, k1, b)
 
-            idf = math.log((total_num_notes-notes_containing_token+0.5)/(notes_containing_token+0.5))
+        # One round trip for the global statistics and every matching posting.
+        total_num_notes, average_document_length, postings = self.notes_index.retrieve_bm25_postings(query_tokens.keys())
+        average_document_length = average_document_length or 1
 
-            # For each document calculate its BM25 score.
-            for result in results:
-                note = self.notes_repo.get_note(result['note_id'])
-
-                temp_tags = " ".join(note['tags'].split(','))
-                document = f"{note['title']} {note['contents']} {temp_tags}"
-                document_length = len(document.split(" "))
+        bm25_scores = defaultdict(float)
 
-                local_token_count = self.notes_index.retrieve_term_frequency_in_document(note['uuid'], token)
+        for token, note_id, notes_containing_token, local_token_count, document_length in postings:
+            idf = math.log((total_num_notes-notes_containing_token+0.5)/(notes_containing_token+0.5))
 
-                tf = local_token_count / (local_token_count + k1 * (1 - b + b * (document_length / average_document_length)))
+            tf = local_token_count / (local_token_count + k1 * (1 - b + b * (document_length / average_document_length)))
 
-                bm25_scores[note['uuid']] += (tf * idf)
+            bm25_scores[note_id] += (tf * idf) * query_tokens[token]
 
         final_result = list(bm25_scores.items())
         return sorted(final_result, key=lambda x: x[1], reverse=True)
 
+    def fts_search(self, user_query, k=None):
+        """ Lexical search ranked entirely by FTS5, all (note_id, score) pairs or only the best `k`. """
+        return self.lexical_index.ranked_search(self.tokenizer.tokenize(user_query), k)
+
     def semantic_search(self, user_query, neighbours=10):
 
         response = self.embedding_provider.embed(user_query)
@@ -110,13 +201,90 @@ class SearchEngine:
 
         return sorted(results, key=lambda x: x[1])
 
-    def hybrid_search(self, user_query, alpha=0.5):
-        lexical_results = self.lexical_search(user_query)
-        semantic_results = self.semantic_search(user_query)
+    def hybrid_search(self, user_query, alpha=0.5, lexical_engine="bm25", k=None, deadline_ms=None):
+        """
+        `lexical_engine` picks the lexical leg: "bm25" for lexical_search or
+        "fts5" for fts_search. Only the best `k` results are returned when
+        set. Results are served from the query cache when there is one.
+
+        The semantic leg runs on a worker thread while the lexical leg runs
+        on the caller's, so a query takes as long as the slower leg rather
+        than both. If the semantic leg fails, for instance because Ollama is
+        down, or is still running `deadline_ms` milliseconds after the call,
+        the lexical results are returned on their own as a HybridResults
+        with `partial` set. Partial results are not cached.
+        """
+        if lexical_engine not in LEXICAL_ENGINES:
+            raise ValueError(f"Unknown lexical engine: {lexical_engine}")
+
+        if self.query_cache is None:
+            return self._hybrid_search(user_query, alpha, lexical_engine, k, deadline_ms)
+
+        key = (normalize_query(user_query), alpha, lexical_engine, k)
+        results = self.query_cache.get(key)
+        if results is not None:
+            return HybridResults(results)
+
+        generation = self.query_cache.generation
+        results = self._hybrid_search(user_query, alpha, lexical_engine, k, deadline_ms)
+        if results is not None and not results.partial:
+            self.query_cache.put(key, results, generation)
+        return results
+
+    def _start_semantic_leg(self, user_query):
+        """
+        Submits semantic_search to the search threads, or returns None while
+        embedding is paused or every search thread is still busy with a leg
+        that missed its deadline.
+        """
+        if not self.embedding_provider.is_available():
+            logging.warning("Embedding calls are paused, returning lexical results only.")
+            return None
+        with self._legs_lock:
+            if self._running_legs >= self.search_workers:
+                logging.warning("Every semantic search thread is busy, returning lexical results only.")
+                return None
+            self._running_legs += 1
+        semantic = self._semantic_executor().submit(self.semantic_search, user_query)
+        semantic.add_done_callback(self._semantic_leg_done)
+        return semantic
+
+    def _semantic_leg_done(self, semantic):
+        with self._legs_lock:
+            self._running_legs -= 1
+
+    def _finish_semantic_leg(self, semantic, deadline_ms, started):
+        """ The semantic leg's results, or False if it failed or missed the deadline. """
+        if semantic is None:
+            return False
+        timeout = None if deadline_ms is None else max(0.0, deadline_ms / 1000 - (time.monotonic() - started))
+        try:
+            return semantic.result(timeout=timeout)
+        except TimeoutError:
+            # Only stops a leg that hasn't started, a running one finishes in the background.
+            semantic.cancel()
+            logging.warning(f"Semantic search missed the {deadline_ms} ms deadline, returning lexical results only.")
+        except Exception as e:
+            logging.warning(f"Semantic search failed, returning lexical results only: {e}")
+        return False
+
+    def _hybrid_search(self, user_query, alpha, lexical_engine, k, deadline_ms):
+        started = time.monotonic()
+        semantic = self._start_semantic_leg(user_query)
+
+        # With k set only the best k lexical matches are scored in full.
+        if lexical_engine == "fts5":
+            lexical_results = self.fts_search(user_query, k)
+        else:
+            lexical_results = self.lexical_search(user_query, k=k)
+
+        semantic_results = self._finish_semantic_leg(semantic, deadline_ms, started)
+        partial = semantic_results is False
 
         if not lexical_results and semantic_results is None:
             logging.warning("Could not perform hybrid search, database is empty.")
             return None
+        semantic_results = semantic_results or []
 
         def normalize_scores(results):
             min_score = min(results, key=lambda x: x[1])[1]
@@ -166,4 +334,4 @@ class SearchEngine:
             hybrid_score = alpha * lex_score + (1-alpha) * sem_score
             hybrid_scores.append((note_id, hybrid_score))
 
-        return sorted(hybrid_scores, key=lambda x: x[1], reverse=True)
+        return HybridResults(sorted(hybrid_scores, key=lambda x: x[1], reverse=True)[:k], partial)
@@ -1,12 +1,10 @@
 import json
 import logging
-import pickle
-from change_log_repository import ChangeLog
-from notes_repository import NotesRepository
+from note_service import NoteService
 
 class SyncManager:
 
-    def __init__(self, db_worker, device_id, notes_repository, change_log, lamport_clock, se, li, fe, ep, transport_layer):
+    def __init__(self, db_worker, device_id, notes_repository, change_log, lamport_clock, se, li, fe, ep, transport_layer, note_service=None):
         self.db_worker = db_worker
         self.device_id = device_id
         self.notes_repo = notes_repository
@@ -17,8 +15,7 @@ class SyncManager:
         self.faiss_engine = fe
         self.embedding_provider = ep
         self.transport_layer = transport_layer
-        self.create_last_sync_table()
-        self.initialize_sync_table()
+        self.note_service = note_service or NoteService(db_worker, device_id, notes_repository, se, li, fe, ep, change_log, lamport_clock)
         self.transport_layer.register_message_handler(self.sync_down)
 
     def create_last_sync_table(self):
@@ -106,6 +103,7 @@ class SyncManager:
         last_sync_at = self.get_last_sync()
 
         results = sorted(message, key=lambda x: x.get('lamport_clock', 0))
+        operations = []
 
         for remote_operation in results:
 
@@ -113,80 +111,13 @@ class SyncManager:
             if self.change_log.check_operation_exists(remote_operation['op_id']) == 1:
                 continue
 
-            remote_note_id = remote_operation['note_id']
-
-            local_note = self.notes_repo.get_note(remote_note_id)
-
             # Payload comes as a string and needs to be convereted to a dictionary.
             remote_operation["payload"] = json.loads(remote_operation["payload"])
+            operations.append(remote_operation)
 
-            if remote_operation['operation_type'] == 'create':
-                if local_note is None:
-                    self.lamport_clock.increment_lamport_time(remote_operation['lamport_clock'])
-                    self.lamport_clock.save_lamport_time_to_db()
-
-                    response = self.embedding_provider.embed(
-                        f"{remote_operation['payload']['title']} {remote_operation['payload']['contents']} {remote_operation['payload']['tags']}")
-
-                    embeddings = pickle.dumps(response['embedding'])
-
-                    self.notes_repo.insert_note(remote_note_id, remote_operation['payload']['title'],
-                                                remote_operation['payload']['contents'], remote_operation['payload']['created_at'],
-                                                remote_operation['payload']['last_updated'],
-                                                embeddings, remote_operation['payload']['tags'])
-
-                    self.search_engine.index_note(remote_note_id)
-
-                    self.lexical_index.index_note_for_lexical_search(remote_note_id,
-                                                                    remote_operation['payload'].get('title', ''),
-                                                                    remote_operation['payload'].get('contents', ''))
-                    self.faiss_engine.add_embedding(remote_note_id, response['embedding'])
-
-                    self.change_log.log_operation(remote_note_id, "create", remote_operation['payload'], self.lamport_clock.now(),
-                                                    peer_device_id, remote_operation['op_id'])
-                    logging.info(f"Inserted note from remote with id: {remote_note_id}")
-                    self.update_last_sync()
-                else:
-                    logging.warning(f"Could not create note because a note with this id already exists. Note id : {remote_note_id}")
-
-            if remote_operation['operation_type'] == 'update':
-                if local_note is not None:  # Use .get because parameters may not exist in update function.
-                    self.lamport_clock.increment_lamport_time(remote_operation['lamport_clock'])
-                    self.lamport_clock.save_lamport_time_to_db()
-                    self.notes_repo.update_note(remote_note_id,
-                                                remote_operation['payload'].get('title', None),
-                                                remote_operation['payload'].get('contents', None),
-                                                remote_operation['payload'].get('embeddings', None),
-                                                remote_operation['payload'].get('tags', None))
-
-                    self.search_engine.index_note(remote_note_id)
-
-                    note = self.notes_repo.get_note(remote_note_id)
-                    self.lexical_index.index_note_for_lexical_search(remote_note_id, note['title'], note['contents'])
-
-                    response = self.embedding_provider.embed(f"{note['title']} {note['contents']} {note['tags']}")
-                    self.faiss_engine.add_embedding(remote_note_id, response['embedding'])
-
-                    self.change_log.log_operation(remote_note_id, "update", remote_operation['payload'], self.lamport_clock.now(),
-                                                    peer_device_id, remote_operation['op_id'])
-                    logging.info(f"Succesfully updated note with id: {remote_note_id}")
-                    self.update_last_sync()
-                else:
-                    logging.warning(f"Could not update note because a note with this id does not exist. Note id : {remote_note_id}")
-
-            if remote_operation['operation_type'] == 'delete':
-                if local_note is not None:
-                    self.lamport_clock.increment_lamport_time(remote_operation['lamport_clock'])
-                    self.lamport_clock.save_lamport_time_to_db()
-                    self.notes_repo.mark_note_as_deleted(remote_note_id)
-                    self.lexical_index.delete_note_from_lexical_search(remote_note_id)
-                    self.search_engine.remove_from_index(remote_note_id)
-                    self.faiss_engine.delete_embedding(remote_note_id)
-                    self.change_log.log_operation(remote_note_id, "delete", {'deleted': 1}, self.lamport_clock.now(), peer_device_id, remote_operation['op_id'])
-                    logging.info(f"Marked note for deletion with id: {remote_note_id}")
-                    self.update_last_sync()
-                else:
-                    logging.warning(f"Could not delete note because a note with this id does not exist. Note id : {remote_note_id}")
+        # Applied as a batch so the notes' texts are embedded together.
+        if operations and self.note_service.apply_remote_operations(operations, peer_device_id):
+            self.update_last_sync()
 
     def sync(self):
         self.sync_up()
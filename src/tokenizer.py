@@ -1,13 +1,44 @@
 import string
 from collections import Counter
 
+# Built once and shared by every Tokenizer.
+PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation)
+
 class Tokenizer:
 
     def tokenize(self, text):
-        lower_text = text.lower()
-        no_punctuation = lower_text.translate(str.maketrans("", "", string.punctuation))
-        tokens = no_punctuation.split(" ")
+        # split() with no argument breaks on any run of whitespace, so words
+        # separated by newlines or tabs stay apart.
+        tokens = text.lower().translate(PUNCTUATION_TABLE).split()
         return [token for token in tokens if len(token) > 1]
 
+    def tokenize_many(self, texts):
+        """ Tokenizes each text, returning one token list per text. """
+        tokenize = self.tokenize
+        return [tokenize(text) for text in texts]
+
+    def iter_tokens(self, text, chunk_size=65536):
+        """
+        Yields the same tokens as tokenize() one at a time. `text` is either
+        a string, read `chunk_size` characters at a time, or any iterable of
+        string chunks such as an open file. Only one chunk is normalized at
+        once, and a word cut by a chunk boundary is carried into the next.
+        """
+        if isinstance(text, str):
+            chunks = (text[start:start + chunk_size] for start in range(0, len(text), chunk_size))
+        else:
+            chunks = text
+
+        carry = ""
+        for chunk in chunks:
+            chunk = carry + chunk.lower().translate(PUNCTUATION_TABLE)
+            words = chunk.split()
+            carry = words.pop() if words and not chunk[-1].isspace() else ""
+            for word in words:
+                if len(word) > 1:
+                    yield word
+        if len(carry) > 1:
+            yield carry
+
     def count(self, tokens):
         return Counter(tokens)
@@ -0,0 +1,202 @@
+import threading
+import pytest
+from database_worker import DBWorker
+
+@pytest.fixture
+def clean_db(tmp_path):
+    db_path = tmp_path / "test.db"
+    db = DBWorker(db_path=str(db_path))
+    yield db
+    db.shutdown()
+
+@pytest.fixture
+def wal_db(tmp_path):
+    db_path = tmp_path / "test.db"
+    db = DBWorker(db_path=str(db_path), wal=True, readers=2)
+    yield db
+    db.shutdown()
+
+def create_table(connection):
+    connection.execute("CREATE TABLE items(value INTEGER)")
+
+def insert_value(connection, value):
+    connection.execute("INSERT INTO items (value) VALUES (?)", (value,))
+    connection.commit()
+
+def count_values(connection):
+    return connection.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+def test_execute_returns_result(clean_db):
+    clean_db.execute(create_table)
+    clean_db.execute(insert_value, (1,))
+    assert clean_db.execute(count_values, wait=True) == 1
+
+def test_execute_raises_operation_errors(clean_db):
+    def _op(connection):
+        connection.execute("SELECT * FROM missing_table")
+
+    with pytest.raises(Exception):
+        clean_db.execute(_op, wait=True)
+
+def test_wal_mode_is_enabled(wal_db):
+    def _op(connection):
+        return connection.execute("PRAGMA journal_mode").fetchone()[0]
+    assert wal_db.execute(_op, wait=True, read=True) == "wal"
+
+def test_read_sees_writes_queued_before_it(wal_db):
+    wal_db.execute(create_table)
+    for value in range(20):
+        wal_db.execute(insert_value, (value,))
+    assert wal_db.execute(count_values, wait=True, read=True) == 20
+
+def test_read_does_not_wait_for_other_threads_writes(wal_db):
+    wal_db.execute(create_table, wait=True)
+    release = threading.Event()
+    def slow_insert(connection):
+        release.wait(5)
+        insert_value(connection, 1)
+    writer = threading.Thread(target=lambda: wal_db.execute(slow_insert, wait=True))
+    writer.start()
+    try:
+        # Served by a reader while the other thread's write is still running.
+        assert wal_db.execute_async(count_values, read=True).result(timeout=2) == 0
+    finally:
+        release.set()
+        writer.join()
+    wal_db.execute(insert_value, (2,))
+    assert wal_db.execute(count_values, wait=True, read=True) == 2
+
+def test_reader_connections_are_read_only(wal_db):
+    wal_db.execute(create_table, wait=True)
+    with pytest.raises(Exception):
+        wal_db.execute(insert_value, (1,), wait=True, read=True)
+
+def test_reads_run_in_parallel(wal_db):
+    wal_db.execute(create_table, wait=True)
+    barrier = threading.Barrier(2, timeout=5)
+
+    def _op(connection):
+        # Only returns if both readers are inside an operation at once.
+        barrier.wait()
+        return count_values(connection)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(wal_db.execute(_op, wait=True, read=True))) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [0, 0]
+
+@pytest.fixture
+def group_db(tmp_path):
+    db_path = tmp_path / "test.db"
+    db = DBWorker(db_path=str(db_path), group_commit=True, commit_interval=0.2, max_batch_ops=1000)
+    yield db
+    db.shutdown()
+
+def test_transaction_commits_once(clean_db):
+    clean_db.execute(create_table, wait=True)
+    with clean_db.transaction():
+        for value in range(10):
+            clean_db.execute(insert_value, (value,))
+        # Reads inside the block see the uncommitted writes.
+        assert clean_db.execute(count_values, wait=True, read=True) == 10
+    assert clean_db.execute(count_values, wait=True) == 10
+
+def test_transaction_rolls_back_when_block_raises(clean_db):
+    clean_db.execute(create_table, wait=True)
+    with pytest.raises(RuntimeError):
+        with clean_db.transaction():
+            clean_db.execute(insert_value, (1,), wait=True)
+            raise RuntimeError("abort")
+    assert clean_db.execute(count_values, wait=True) == 0
+
+def test_transaction_rolls_back_when_an_op_fails(clean_db):
+    clean_db.execute(create_table, wait=True)
+
+    def _fail(connection):
+        connection.execute("INSERT INTO missing_table VALUES (1)")
+
+    with pytest.raises(Exception):
+        with clean_db.transaction():
+            clean_db.execute(insert_value, (1,))
+            clean_db.execute(_fail)
+    assert clean_db.execute(count_values, wait=True) == 0
+
+def test_group_commit_merges_queued_writes(group_db):
+    group_db.execute(create_table, wait=True)
+    commits = []
+    group_db.execute(lambda connection: connection._connection.set_trace_callback(
+        lambda sql: commits.append(sql) if sql == "COMMIT" else None), wait=True)
+
+    for value in range(100):
+        group_db.execute(insert_value, (value,))
+    # Reads on the writer see the open batch without forcing a commit.
+    assert group_db.execute(count_values, wait=True, read=True) == 100
+    commits.clear()
+    # A waited write acknowledges the batch; every queued write shares its commit.
+    group_db.execute(insert_value, (100,), wait=True)
+    assert commits == ["COMMIT"]
+
+def test_group_commit_failed_op_does_not_abort_batch(group_db):
+    group_db.execute(create_table, wait=True)
+
+    def _fail(connection):
+        connection.execute("INSERT INTO items (value) VALUES (1)")
+        connection.execute("INSERT INTO missing_table VALUES (1)")
+
+    group_db.execute(insert_value, (1,))
+    with pytest.raises(Exception):
+        group_db.execute(_fail, wait=True)
+    group_db.execute(insert_value, (2,), wait=True)
+    assert group_db.execute(count_values, wait=True) == 2
+
+def test_execute_async_returns_future(clean_db):
+    clean_db.execute(create_table)
+    futures = [clean_db.execute_async(insert_value, (value,)) for value in range(5)]
+    assert [future.result() for future in futures] == [None] * 5
+    assert clean_db.execute_async(count_values, read=True).result() == 5
+
+def test_execute_async_future_carries_exception(clean_db):
+    def _op(connection):
+        connection.execute("SELECT * FROM missing_table")
+
+    future = clean_db.execute_async(_op)
+    assert isinstance(future.exception(), Exception)
+
+def test_execute_batch_keeps_order(wal_db):
+    wal_db.execute(create_table)
+    for value in range(5):
+        wal_db.execute(insert_value, (value,))
+
+    def _op(connection, value):
+        return connection.execute("SELECT value FROM items WHERE value = ?", (value,)).fetchone()[0]
+
+    assert wal_db.execute_batch([(_op, (value,)) for value in range(5)], read=True) == [0, 1, 2, 3, 4]
+
+def test_stats_records_named_operations(clean_db):
+    from notes_repository import NotesRepository
+
+    notes_db = NotesRepository(clean_db)
+    notes_db.create_notes_table()
+    notes_db.create_note("Title", "Body", None, "tag1")
+    notes_db.list_all_notes()
+
+    stats = clean_db.stats()
+    operation = stats["operations"]["NotesRepository.list_notes"]
+    assert operation["count"] == 1
+    assert operation["rows"] == 1
+    assert operation["run"]["p50"] >= 0
+    assert operation["wait"]["p99"] >= 0
+    assert stats["queues"]["write"]["depth"] == 0
+
+def test_stats_logs_slow_operations(tmp_path):
+    db = DBWorker(db_path=str(tmp_path / "test.db"), slow_op_threshold=0.0)
+    try:
+        db.execute(create_table, wait=True)
+        slow = db.stats()["slow_operations"]
+        assert slow[0]["name"] == "create_table"
+    finally:
+        db.shutdown()
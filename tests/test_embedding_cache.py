@@ -0,0 +1,57 @@
+import time
+import pytest
+from database_worker import DBWorker
+from migrations import SchemaMigrator
+from embedding_cache import EmbeddingCache, cache_key
+
+@pytest.fixture
+def clean_db(tmp_path):
+    db_path = tmp_path / "test.db"
+    db = DBWorker(db_path=str(db_path))
+    SchemaMigrator(db).migrate()
+    yield db
+    db.shutdown()
+
+def test_embeddings_survive_a_restart(clean_db):
+    EmbeddingCache(clean_db).put("model", "apple banana", [0.5, 0.25])
+
+    cache = EmbeddingCache(clean_db)
+    assert cache.get("model", "apple banana") == [0.5, 0.25]
+    assert cache.get("model", "apple banana") == [0.5, 0.25]
+    assert cache.get("other-model", "apple banana") is None
+
+    stats = cache.stats()
+    assert (stats["disk_hits"], stats["memory_hits"], stats["misses"]) == (1, 1, 1)
+
+def test_keys_ignore_whitespace_but_not_case():
+    assert cache_key("model", " apple\n banana ") == cache_key("model", "apple banana")
+    assert cache_key("model", "Apple banana") != cache_key("model", "apple banana")
+
+def test_least_recently_used_rows_are_evicted(clean_db):
+    cache = EmbeddingCache(clean_db, max_memory_entries=1, max_entries=2)
+    cache.put("model", "a", [1.0])
+    cache.put("model", "b", [2.0])
+    cache.get("model", "a")
+    cache.put("model", "c", [3.0])
+
+    restarted = EmbeddingCache(clean_db)
+    assert restarted.get("model", "a") == [1.0]
+    assert restarted.get("model", "b") is None
+    assert restarted.get("model", "c") == [3.0]
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["memory_entries"] == 1
+
+def test_lookups_run_on_the_readers_and_touch_rows_in_the_background(tmp_path):
+    db = DBWorker(db_path=str(tmp_path / "test.db"), wal=True, readers=1)
+    SchemaMigrator(db).migrate()
+    EmbeddingCache(db).put("model", "apple", [1.0])
+    def _last_used(connection):
+        return connection.execute("SELECT last_used FROM embedding_cache").fetchone()[0]
+    stored = db.execute(_last_used, wait=True)
+    time.sleep(0.01)
+
+    assert EmbeddingCache(db).get("model", "apple") == [1.0]
+
+    # Queued behind the touch on the writer thread.
+    assert db.execute(_last_used, wait=True) > stored
+    db.shutdown()
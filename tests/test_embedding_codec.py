@@ -0,0 +1,59 @@
+import os
+import sys
+import pickle
+import pytest
+import subprocess
+import numpy as np
+import embedding_codec
+from hashing import compute_note_hash
+from embedding_codec import (encode_embedding, decode_embedding, embedding_model,
+                             is_encoded, embedding_payload)
+
+@pytest.fixture
+def vector():
+    return [0.123, 0.69, 0.93, -1.5]
+
+def test_round_trip(vector):
+    blob = encode_embedding(vector)
+    decoded = decode_embedding(blob)
+
+    assert is_encoded(blob)
+    assert decoded.dtype == np.float32
+    assert np.allclose(decoded, vector)
+
+def test_decode_does_not_copy(vector):
+    blob = encode_embedding(vector)
+    decoded = decode_embedding(blob)
+
+    assert not decoded.flags.owndata
+    assert not decoded.flags.writeable
+
+def test_header_keeps_model(vector):
+    assert embedding_model(encode_embedding(vector, model="test-model")) == "test-model"
+    assert embedding_model(pickle.dumps(vector)) is None
+
+def test_encoded_is_smaller_than_pickle():
+    vector = list(np.random.default_rng(0).random(768))
+    assert len(encode_embedding(vector)) * 2 < len(pickle.dumps(vector))
+
+def test_decodes_legacy_pickles(vector):
+    assert np.allclose(decode_embedding(pickle.dumps(vector)), vector)
+
+def test_decode_rejects_unknown_bytes():
+    with pytest.raises(ValueError):
+        decode_embedding(b"not an embedding")
+
+def test_note_hash_ignores_storage_format(vector):
+    legacy = pickle.dumps(vector)
+    encoded = encode_embedding(vector)
+
+    assert embedding_payload(legacy) == embedding_payload(encoded)
+    assert compute_note_hash("t", "c", "x", legacy, 0) == compute_note_hash("t", "c", "x", encoded, 0)
+
+def test_codec_does_not_import_the_provider():
+    # hashing imports the codec, neither should pull in ollama.
+    code = "import sys, hashing, embedding_codec; print('embedding_provider' in sys.modules or 'ollama' in sys.modules)"
+    src = os.path.dirname(embedding_codec.__file__)
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                            env={**os.environ, "PYTHONPATH": src})
+    assert result.stdout.strip() == "False"
@@ -0,0 +1,261 @@
+import time
+import ollama
+import asyncio
+import threading
+import pytest
+from database_worker import DBWorker
+from migrations import SchemaMigrator
+from embedding_cache import EmbeddingCache
+from embedding_provider import EmbeddingProvider, EmbeddingUnavailableError, RequestGate, INTERACTIVE, BULK
+
+class FakeOllama():
+    """ Stands in for ollama.embed, failing the next `failures` calls. """
+    def __init__(self):
+        self.failures = 0
+        self.calls = 0
+        self.inputs = []
+
+    def embed(self, model, input):
+        self.calls += 1
+        self.inputs.append(list(input))
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("ollama is not running")
+        return {"embeddings": [[float(len(text))] * 8 for text in input]}
+
+@pytest.fixture
+def fake_ollama(monkeypatch):
+    fake = FakeOllama()
+    monkeypatch.setattr(ollama, "embed", fake.embed)
+    return fake
+
+def test_breaker_opens_after_consecutive_failures(fake_ollama):
+    fake_ollama.failures = 3
+    provider = EmbeddingProvider(failure_threshold=3, cooldown=60, retries=0)
+
+    for _ in range(3):
+        with pytest.raises(ConnectionError):
+            provider.embed("text")
+    assert not provider.is_available()
+
+    with pytest.raises(EmbeddingUnavailableError) as error:
+        provider.embed("text")
+    assert fake_ollama.calls == 3
+    assert 0 < error.value.retry_after <= 60
+
+def test_breaker_closes_after_successful_probe(fake_ollama):
+    fake_ollama.failures = 2
+    provider = EmbeddingProvider(failure_threshold=2, cooldown=0.05, retries=0)
+
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            provider.embed("text")
+    time.sleep(0.06)
+
+    assert provider.is_available()
+    assert provider.embed("text") == {"embedding": [4.0] * 8}
+    assert provider.is_available()
+
+def test_only_one_caller_probes_a_half_open_breaker(fake_ollama, monkeypatch):
+    fake_ollama.failures = 1
+    provider = EmbeddingProvider(failure_threshold=1, cooldown=0.05, retries=0)
+    with pytest.raises(ConnectionError):
+        provider.embed("text")
+    time.sleep(0.06)
+
+    probing = threading.Event()
+    release = threading.Event()
+    def slow_embed(model, input):
+        probing.set()
+        release.wait(5)
+        return fake_ollama.embed(model, input)
+    monkeypatch.setattr(ollama, "embed", slow_embed)
+
+    results = []
+    probe = threading.Thread(target=lambda: results.append(provider.embed("text")))
+    probe.start()
+    assert probing.wait(5)
+
+    # The second caller is turned away while the probe is out.
+    with pytest.raises(EmbeddingUnavailableError):
+        provider.embed("other")
+    assert not provider.is_available()
+
+    release.set()
+    probe.join(5)
+    assert results == [{"embedding": [4.0] * 8}]
+    assert provider.is_available()
+    assert provider.embed("other") == {"embedding": [5.0] * 8}
+    assert fake_ollama.calls == 3
+
+def test_success_resets_failure_count(fake_ollama):
+    fake_ollama.failures = 1
+    provider = EmbeddingProvider(failure_threshold=2, retries=0)
+
+    with pytest.raises(ConnectionError):
+        provider.embed("text")
+    provider.embed("text")
+    fake_ollama.failures = 1
+    with pytest.raises(ConnectionError):
+        provider.embed("text")
+
+    assert provider.is_available()
+
+def test_cached_texts_are_not_sent_to_ollama(fake_ollama, tmp_path):
+    db = DBWorker(db_path=str(tmp_path / "test.db"))
+    SchemaMigrator(db).migrate()
+    EmbeddingProvider(cache=EmbeddingCache(db)).embed("apple banana")
+
+    # A restarted provider whose circuit breaker is open.
+    provider = EmbeddingProvider(failure_threshold=1, cache=EmbeddingCache(db), retries=0)
+    fake_ollama.failures = 1
+    with pytest.raises(ConnectionError):
+        provider.embed("kiwi")
+
+    assert provider.embed("apple  banana") == {"embedding": [12.0] * 8}
+    assert fake_ollama.calls == 2
+    db.shutdown()
+
+def test_embed_many_batches_and_keeps_order(fake_ollama):
+    provider = EmbeddingProvider(max_in_flight=1)
+
+    vectors = provider.embed_many(["a", "bb", "a", "ccc", "dddd"], batch_size=2)
+
+    assert [vector[0] for vector in vectors] == [1.0, 2.0, 1.0, 3.0, 4.0]
+    # Repeated texts are only sent once.
+    assert fake_ollama.inputs == [["a", "bb"], ["ccc", "dddd"]]
+
+def test_embed_many_leaves_failed_batches_out(fake_ollama):
+    provider = EmbeddingProvider(max_in_flight=1, retries=0)
+    fake_ollama.failures = 1
+
+    vectors = provider.embed_many(["a", "bb", "ccc"], batch_size=2)
+
+    assert vectors[:2] == [None, None]
+    assert vectors[2] == [3.0] * 8
+
+    fake_ollama.failures = 2
+    with pytest.raises(ConnectionError):
+        provider.embed_many(["a", "bb", "ccc"], batch_size=2)
+    provider.shutdown()
+
+def test_failed_requests_are_retried_with_backoff(fake_ollama):
+    provider = EmbeddingProvider(failure_threshold=1, retries=2, retry_delay=0.01)
+    fake_ollama.failures = 2
+
+    assert provider.embed("text") == {"embedding": [4.0] * 8}
+    assert fake_ollama.calls == 3
+    assert provider.is_available()
+    assert provider.stats()["retried"] == 2
+    assert provider.stats()["requests"]["interactive"]["errors"] == 2
+
+def test_queries_go_ahead_of_waiting_bulk_requests(monkeypatch):
+    release = threading.Event()
+    order = []
+    def fake_embed(model, input):
+        if input == ["first"]:
+            release.wait(5)
+        order.append(input[0])
+        return {"embeddings": [[0.0] * 8 for _ in input]}
+    monkeypatch.setattr(ollama, "embed", fake_embed)
+    provider = EmbeddingProvider(max_in_flight=1)
+
+    def wait_for(condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    first = provider.embed_many_async(["first"])
+    wait_for(lambda: provider.gate.in_flight == 1)
+    bulk = provider.embed_many_async(["bulk"])
+    wait_for(lambda: provider.gate.waiting()["bulk"] == 1)
+
+    async def search():
+        # The asyncio flavour, a query waiting alongside the bulk request.
+        query = asyncio.wrap_future(provider.embed_many_async(["query"], priority=INTERACTIVE))
+        await asyncio.sleep(0.05)
+        release.set()
+        return await query
+    assert asyncio.run(search()) == [[0.0] * 8]
+
+    first.result()
+    bulk.result()
+    assert order == ["first", "query", "bulk"]
+    assert provider.stats()["max_waiting"] == 2
+    provider.shutdown()
+
+def test_aembed_many_sends_batches_through_the_gate(monkeypatch):
+    running = []
+    peak = []
+    clients = []
+    class FakeAsyncClient():
+        def __init__(self, timeout=None):
+            self.closed = False
+            clients.append(self)
+
+        async def close(self):
+            self.closed = True
+
+        async def embed(self, model, input):
+            running.append(input)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(input)
+            return {"embeddings": [[float(len(text))] * 8 for text in input]}
+    monkeypatch.setattr(ollama, "AsyncClient", FakeAsyncClient)
+    provider = EmbeddingProvider(max_in_flight=1)
+
+    async def embed_twice():
+        first = await provider.aembed_many(["a", "bb", "a", "ccc"], batch_size=1)
+        await provider.aembed_many(["dddd"])
+        await provider.aclose()
+        return first
+    vectors = asyncio.run(embed_twice())
+
+    assert [vector[0] for vector in vectors] == [1.0, 2.0, 1.0, 3.0]
+    assert max(peak) == 1
+    assert provider.stats()["requests"]["bulk"]["count"] == 4
+    # Both calls went over the loop's one session, closed with it.
+    assert len(clients) == 1 and clients[0].closed
+
+def test_coroutines_wait_for_the_gate_without_threads():
+    gate = RequestGate(max_in_flight=1)
+    gate.acquire(BULK)
+    order = []
+
+    async def request(name, priority):
+        await gate.acquire_async(priority)
+        order.append(name)
+        gate.release()
+
+    async def main():
+        threads = threading.active_count()
+        waiting = [asyncio.create_task(request(f"bulk-{n}", BULK)) for n in range(50)]
+        waiting.append(asyncio.create_task(request("query", INTERACTIVE)))
+        await asyncio.sleep(0.05)
+        assert gate.waiting() == {"interactive": 1, "bulk": 50}
+        assert threading.active_count() == threads
+        # Released from another thread, as a finished sync request would.
+        threading.Thread(target=gate.release).start()
+        await asyncio.gather(*waiting)
+    asyncio.run(main())
+
+    assert order[0] == "query"
+    assert order[1:] == [f"bulk-{n}" for n in range(50)]
+    assert gate.in_flight == 0
+
+def test_cancelled_coroutine_leaves_the_gate():
+    gate = RequestGate(max_in_flight=1)
+    gate.acquire(BULK)
+
+    async def main():
+        waiter = asyncio.create_task(gate.acquire_async(BULK))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+    asyncio.run(main())
+
+    assert gate.waiting()["bulk"] == 0
+    gate.release()
+    assert gate.in_flight == 0
@@ -0,0 +1,166 @@
+import time
+import pytest
+from faiss_engine import Faiss
+from tokenizer import Tokenizer
+from note_index import NoteIndex
+from database_worker import DBWorker
+from migrations import SchemaMigrator
+from lamport_clock import LamportClock
+from search_engine import SearchEngine
+from lexical_index import LexicalIndex
+from note_service import NoteService
+from embedding_queue import EmbeddingQueue
+from embedding_provider import EmbeddingUnavailableError
+from change_log_repository import ChangeLog
+from notes_repository import NotesRepository
+
+@pytest.fixture
+def clean_db(tmp_path):
+    db_path = tmp_path / "test.db"
+    db = DBWorker(db_path=str(db_path))
+    SchemaMigrator(db).migrate()
+    yield db
+    db.shutdown()
+
+class FlakyEmbeddingProvider():
+    """ Fails the first `failures` calls made after the FAISS dimension probe. """
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.calls = 0
+
+    def is_available(self):
+        return True
+
+    def embed(self, text):
+        self.calls += 1
+        if text != "dimension probe" and self.failures:
+            self.failures -= 1
+            raise ConnectionError("ollama is not running")
+        return {"embedding": [float(len(text))] * 8}
+
+    def embed_many(self, texts):
+        return [self.embed(text)["embedding"] for text in texts]
+
+def make_service(db_worker, emb_prov, **queue_options):
+    lamport_clock = LamportClock(db_worker)
+    lamport_clock.initialize_lamport_clock()
+    nr = NotesRepository(db_worker)
+    li = LexicalIndex(db_worker)
+    fe = Faiss(emb_prov, nr)
+    se = SearchEngine(nr, NoteIndex(db_worker), li, fe, emb_prov, Tokenizer())
+    embedding_queue = EmbeddingQueue(nr, emb_prov, fe, se, **queue_options)
+    service = NoteService(db_worker, "DEVICE", nr, se, li, fe, emb_prov, ChangeLog(db_worker, "DEVICE"),
+                          lamport_clock, embedding_queue)
+    return service, embedding_queue
+
+def test_notes_are_searchable_before_they_are_embedded(clean_db):
+    emb_prov = FlakyEmbeddingProvider()
+    service, embedding_queue = make_service(clean_db, emb_prov)
+
+    note_id = service.create_note("apple", "banana", "fruit")
+
+    assert emb_prov.calls == 1
+    assert service.notes_repo.list_pending_embeddings() == [note_id]
+    assert service.search_engine.lexical_search("banana")[0][0] == note_id
+    assert service.faiss_engine.faiss_to_uuid == []
+
+    embedding_queue.start()
+    embedding_queue.shutdown()
+
+    assert service.notes_repo.list_pending_embeddings() == []
+    assert service.notes_repo.get_note_embedding(note_id) is not None
+    assert service.faiss_engine.faiss_to_uuid == [note_id]
+    assert embedding_queue.stats()["completed"] == 1
+
+def test_queued_edit_drops_the_stale_vector(clean_db):
+    service, embedding_queue = make_service(clean_db, FlakyEmbeddingProvider())
+    note_id = service.create_note("apple", "banana", "fruit")
+    embedding_queue.start()
+    embedding_queue.shutdown()
+    assert service.faiss_engine.faiss_to_uuid == [note_id]
+
+    # The workers are stopped, so the edit stays queued.
+    service.update_note(note_id, contents="kiwi")
+
+    assert service.faiss_engine.faiss_to_uuid == []
+    assert service.notes_repo.list_pending_embeddings() == [note_id]
+
+    # A restart doesn't load the old vector back before the note is re-embedded.
+    restarted, _ = make_service(clean_db, FlakyEmbeddingProvider())
+    assert restarted.faiss_engine.faiss_to_uuid == []
+    assert restarted.notes_repo.get_note_embedding(note_id) is None
+
+def test_failed_embeddings_are_retried(clean_db):
+    service, embedding_queue = make_service(clean_db, FlakyEmbeddingProvider(failures=2), retry_delay=0)
+    embedding_queue.start()
+
+    note_id = service.create_note("apple", "banana", "fruit")
+    embedding_queue.drain()
+
+    assert service.faiss_engine.faiss_to_uuid == [note_id]
+    embedding_queue.shutdown()
+
+def test_notes_stay_pending_when_every_attempt_fails(clean_db):
+    service, embedding_queue = make_service(clean_db, FlakyEmbeddingProvider(failures=3), max_attempts=3, retry_delay=0)
+    embedding_queue.start()
+
+    note_id = service.create_note("apple", "banana", "fruit")
+    embedding_queue.shutdown()
+
+    assert embedding_queue.stats()["failed"] == 1
+    assert service.notes_repo.list_pending_embeddings() == [note_id]
+
+def test_pending_notes_resume_after_restart(clean_db):
+    service, _ = make_service(clean_db, FlakyEmbeddingProvider())
+    note_ids = service.create_notes([("apple", "banana", ""), ("cherry", "kiwi", "")])
+
+    # A new process with an empty FAISS index and queue.
+    restarted, embedding_queue = make_service(clean_db, FlakyEmbeddingProvider(), max_queued=1)
+    embedding_queue.start()
+    embedding_queue.shutdown()
+
+    assert sorted(restarted.faiss_engine.faiss_to_uuid) == sorted(note_ids)
+    assert restarted.notes_repo.list_pending_embeddings() == []
+
+def test_embedding_of_edited_text_is_discarded(clean_db):
+    notes_db = NotesRepository(clean_db)
+    note_id = notes_db.create_note("apple", "banana", None, "")
+    notes_db.update_note(note_id, contents="kiwi")
+
+    assert not notes_db.complete_embedding(note_id, "apple", "banana", "", b"stale")
+    assert notes_db.complete_embedding(note_id, "apple", "kiwi", "", b"fresh")
+    assert notes_db.get_note_embedding(note_id) == b"fresh"
+    assert notes_db.list_pending_embeddings() == []
+
+def test_shutdown_gives_up_waiting_while_embedding_is_paused(clean_db):
+    emb_prov = FlakyEmbeddingProvider()
+    service, embedding_queue = make_service(clean_db, emb_prov)
+    def paused(text):
+        raise EmbeddingUnavailableError(30)
+    emb_prov.embed = paused
+    embedding_queue.start()
+
+    note_id = service.create_note("apple", "banana", "fruit")
+    started = time.monotonic()
+    embedding_queue.shutdown(timeout=0.1)
+
+    assert time.monotonic() - started < 2
+    assert embedding_queue.stats()["failed"] == 0
+    assert service.notes_repo.list_pending_embeddings() == [note_id]
+
+def test_queued_notes_are_embedded_in_batches(clean_db):
+    emb_prov = FlakyEmbeddingProvider()
+    batches = []
+    embed_many = emb_prov.embed_many
+    def record(texts):
+        batches.append(len(texts))
+        return embed_many(texts)
+    emb_prov.embed_many = record
+    service, embedding_queue = make_service(clean_db, emb_prov, workers=1, batch_size=3)
+    service.create_notes([(f"note {i}", "", "") for i in range(5)])
+
+    embedding_queue.start()
+    embedding_queue.shutdown()
+
+    assert batches == [3, 2]
+    assert embedding_queue.stats()["completed"] == 5
@@ -1,6 +1,6 @@
 import pytest
 from database_worker import DBWorker
-from lexical_index import LexicalIndex
+from lexical_index import LexicalIndex, build_match_query
 
 @pytest.fixture
 def clean_db(tmp_path):
@@ -36,3 +36,48 @@ def test_search_lexical_index(clean_db):
     result = li.search_lexical_index("contents")
     result = result[0]
     assert result['note_id'] == "abc"
+
+def test_build_match_query_escapes_input():
+    assert build_match_query(["foo", 'say"hi', "foo", "OR", ""]) == '"foo" OR "say""hi" OR "OR"'
+    assert build_match_query([]) == ""
+
+def test_ranked_search(clean_db):
+
+    li = LexicalIndex(clean_db)
+    li.create_lexical_table()
+    li.index_note_for_lexical_search("title", "Gardening", "Notes about plants.", "home")
+    li.index_note_for_lexical_search("body", "Weekend", "Some gardening and cooking.", "home")
+    li.index_note_for_lexical_search("tag", "Recipes", "Soup and bread.", "gardening,kitchen")
+    li.index_note_for_lexical_search("other", "Travel", "Trains and boats.", "trips")
+
+    results = li.ranked_search(["gardening", "cooking"], k=10)
+    assert {note_id for note_id, _ in results} == {"title", "body", "tag"}
+    assert [score for _, score in results] == sorted((score for _, score in results), reverse=True)
+
+    assert len(li.ranked_search(["gardening"], k=2)) == 2
+    # Operators and note ids are plain text, not query syntax.
+    assert li.ranked_search(["NOT", "title"], k=10) == []
+    assert li.ranked_search(['"', "*"], k=10) == []
+
+def test_ranked_search_weights_title(clean_db):
+
+    li = LexicalIndex(clean_db)
+    li.create_lexical_table()
+    li.index_note_for_lexical_search("in_title", "gardening", "one two three", "")
+    li.index_note_for_lexical_search("in_contents", "one", "gardening two three", "")
+    li.index_note_for_lexical_search("neither", "one", "two three", "")
+
+    assert li.ranked_search(["gardening"], weights=(5.0, 1.0, 1.0))[0][0] == "in_title"
+    assert li.ranked_search(["gardening"], weights=(1.0, 5.0, 1.0))[0][0] == "in_contents"
+
+def test_update_note_for_lexical_search_only_touches_given_columns(clean_db):
+
+    li = LexicalIndex(clean_db)
+    li.create_lexical_table()
+    li.index_note_for_lexical_search("abc", "Title", "contents", "tag")
+    li.update_note_for_lexical_search("abc", tags="gardening")
+    li.update_note_for_lexical_search("abc")
+
+    result = li.get_note_from_lexical_index("abc")
+    assert (result['title'], result['contents'], result['tags']) == ("Title", "contents", "gardening")
+    assert li.ranked_search(["gardening"])[0][0] == "abc"
@@ -1,116 +1,72 @@
-import math
 import pytest
-from collections import defaultdict
+from collections import Counter
 
+from note_index import NoteIndex
+from database_worker import DBWorker
+from migrations import SchemaMigrator
+from lexical_index import LexicalIndex
 from search_engine import SearchEngine
+from notes_repository import NotesRepository
 
 
 @pytest.fixture
 def tokenizer():
     class T:
         def tokenize(self, text):
-            return text.split()
-    return T()
-
-
-@pytest.fixture
-def notes_repo():
-    class MockRepo:
-        def __init__(self):
-            # Pretend "A" and "B" are our example notes.
-            self.notes = {
-                "A": {
-                    "uuid": "A",
-                    "title": "hello world",
-                    "contents": "foo bar foo",
-                    "tags": "x,y",
-                    "deleted": 0
-                },
-                "B": {
-                    "uuid": "B",
-                    "title": "bar baz",
-                    "contents": "foo foo baz",
-                    "tags": "z",
-                    "deleted": 0
-                },
-            }
-
-        def get_note(self, uuid):
-            return self.notes.get(uuid)
-
-        def get_number_of_non_deleted_notes(self):
-            return 2
-
-    return MockRepo()
-
-
-@pytest.fixture
-def notes_index():
-    class MockIndex:
-        def __init__(self):
-            # term-frequency for each token in each note
-            self.tf = {
-                ("A", "foo"): 2,
-                ("A", "bar"): 1,
-                ("B", "foo"): 2,
-                ("B", "bar"): 0,
-            }
+            return text.replace(",", " ").split()
 
-        def retrieve_agerage_document_length(self):
-            return 5.0
-
-        def retrieve_term_frequency_in_document(self, note_id, token):
-            return self.tf.get((note_id, token), 0)
-
-    return MockIndex()
+        def count(self, tokens):
+            return Counter(tokens)
+    return T()
 
 
 @pytest.fixture
-def lexical_index():
-    class MockLexicalIndex:
-        def __init__(self):
-            # Simulate FTS5 lookup results
-            # Each entry looks like {"note_id": "..."}
-            self.results = {
-                "foo": [{"note_id": "A"}, {"note_id": "B"}],
-                "bar": [{"note_id": "A"}],
-            }
+def clean_db(tmp_path):
+    db_path = tmp_path / "test.db"
+    worker = DBWorker(db_path=str(db_path))
+    SchemaMigrator(worker).migrate()
+    yield worker
+    worker.shutdown()
+
+
+def _build_engine(db_worker, tokenizer, notes):
+    notes_repo = NotesRepository(db_worker)
+    notes_index = NoteIndex(db_worker)
+    lexical_index = LexicalIndex(db_worker)
+    engine = SearchEngine(notes_repo, notes_index, lexical_index, None, None, tokenizer)
+    for note in notes:
+        notes_repo.insert_note(note["uuid"], note["title"], note["contents"], None, None, None, note["tags"])
+        engine.index_note(note["uuid"])
+        lexical_index.index_note_for_lexical_search(note["uuid"], note["title"], note["contents"])
+    return engine
+
+
+# Pretend "A" and "B" are our example notes.
+# foo -> A,B (tf=2 in both)
+# bar -> A,B (tf=1 in both, in B's title)
+NOTES = [
+    {"uuid": "A", "title": "hello world", "contents": "foo bar foo", "tags": "x,y"},
+    {"uuid": "B", "title": "bar baz", "contents": "foo foo baz", "tags": "z"},
+]
 
-        def search_lexical_index(self, token):
-            return self.results.get(token, [])
-
-    return MockLexicalIndex()
-
-@pytest.fixture
-def faiss_engine():
-    class MockFaiss:
-        def __init__(self):
-            pass
-    return MockFaiss()
 
 @pytest.fixture
-def emb_prov():
-    class MockEmbeddingProvider:
-        def __init__(self):
-            pass
-    return MockEmbeddingProvider()
+def engine(clean_db, tokenizer):
+    return _build_engine(clean_db, tokenizer, NOTES)
 
 # -------------------------------------------------------------
 #                    TEST CASES
 # -------------------------------------------------------------
 
-def test_returns_empty_if_no_docs(tokenizer, notes_repo, notes_index, faiss_engine, emb_prov, lexical_index):
-    # override lexical index to return zero results
-    lexical_index.results = {}
-
-    engine = SearchEngine(notes_repo, notes_index, lexical_index, faiss_engine, emb_prov, tokenizer)
+def test_returns_empty_if_no_docs(clean_db, tokenizer):
+    # No notes are indexed, so the lexical index returns zero results.
+    engine = _build_engine(clean_db, tokenizer, [])
     result = engine.lexical_search("foo")
 
     assert result == []
 
 
-def test_bm25_correctly_ranks_documents(tokenizer, notes_repo, notes_index, faiss_engine, emb_prov, lexical_index):
-    engine = SearchEngine(notes_repo, notes_index, lexical_index, faiss_engine, emb_prov, tokenizer)
+def test_bm25_correctly_ranks_documents(engine):
     
     # Query: "foo"
     result = engine.lexical_search("foo")
@@ -124,8 +80,7 @@ def test_bm25_correctly_ranks_documents(tokenizer, notes_repo, notes_index, fais
     assert result[0][1] >= result[1][1]
 
 
-def test_multiple_tokens_accumulate(tokenizer, notes_repo, notes_index, faiss_engine, emb_prov, lexical_index):
-    engine = SearchEngine(notes_repo, notes_index, lexical_index, faiss_engine, emb_prov, tokenizer)
+def test_multiple_tokens_accumulate(engine):
 
     # Query containing two tokens that both appear in A
     # foo -> A,B
@@ -140,7 +95,7 @@ def test_multiple_tokens_accumulate(tokenizer, notes_repo, notes_index, faiss_en
     assert score_A > score_B
 
 
-def test_idf_computation_is_called_properly(tokenizer, notes_repo, notes_index, faiss_engine, emb_prov, lexical_index, monkeypatch):
+def test_idf_computation_is_called_properly(engine, monkeypatch):
     """
     We mock math.log to ensure IDF is being passed the correct numerator/denominator.
     """
@@ -152,9 +107,35 @@ def test_idf_computation_is_called_properly(tokenizer, notes_repo, notes_index,
 
     monkeypatch.setattr("math.log", fake_log)
 
-    engine = SearchEngine(notes_repo, notes_index, lexical_index, faiss_engine, emb_prov, tokenizer)
     engine.lexical_search("foo")
 
     # total=2 notes, "foo" appears in both (2)
     # IDF arg should be: (2 - 2 + 0.5) / (2 + 0.5) = 0.5 / 2.5 = 0.2
     assert pytest.approx(captured_value["idf_argument"], 0.01) == 0.2
+
+
+def test_repeated_query_token_counts_twice(engine):
+    single = dict(engine.lexical_search("bar"))
+    repeated = dict(engine.lexical_search("bar bar"))
+
+    assert repeated["A"] == pytest.approx(2 * single["A"])
+
+
+def test_title_terms_are_searched(engine):
+    result = engine.lexical_search("hello")
+
+    assert [note_id for note_id, _ in result] == ["A"]
+
+
+def test_single_query_per_search(engine, clean_db):
+    calls = []
+    original = clean_db.execute
+
+    def counting_execute(fn, *args, **kwargs):
+        calls.append(fn)
+        return original(fn, *args, **kwargs)
+
+    clean_db.execute = counting_execute
+    engine.lexical_search("foo bar baz")
+
+    assert len(calls) == 1
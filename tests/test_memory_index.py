@@ -0,0 +1,146 @@
+import random
+import pytest
+from tokenizer import Tokenizer
+from note_index import NoteIndex
+from memory_index import MemoryIndex
+from database_worker import DBWorker
+from migrations import SchemaMigrator
+from lexical_index import LexicalIndex
+from search_engine import SearchEngine
+from notes_repository import NotesRepository
+
+WORDS = "alpha beta gamma delta epsilon zeta theta kappa lambda sigma".split()
+
+@pytest.fixture
+def clean_db(tmp_path):
+    db_path = tmp_path / "test.db"
+    db = DBWorker(db_path=str(db_path))
+    SchemaMigrator(db).migrate()
+    yield db
+    db.shutdown()
+
+def make_engine(db_worker, memory_index=None):
+    return SearchEngine(NotesRepository(db_worker), NoteIndex(db_worker), LexicalIndex(db_worker),
+                        None, None, Tokenizer(), memory_index)
+
+def add_notes(engine, number_of_notes):
+    rng = random.Random(0)
+    note_ids = []
+    for _ in range(number_of_notes):
+        title = " ".join(rng.choices(WORDS, k=3))
+        contents = " ".join(rng.choices(WORDS, k=rng.randint(3, 15)))
+        tags = ",".join(rng.choices(WORDS, k=2))
+        note_id = engine.notes_repo.create_note(title, contents, None, tags)
+        engine.index_note(note_id)
+        engine.lexical_index.index_note_for_lexical_search(note_id, title, contents)
+        note_ids.append(note_id)
+    return note_ids
+
+def assert_same_ranking(expected, actual):
+    assert dict(actual) == pytest.approx(dict(expected))
+    assert [score for _, score in actual] == sorted((score for _, score in actual), reverse=True)
+
+def test_memory_index_matches_sql_scores(clean_db):
+    sql_engine = make_engine(clean_db)
+    add_notes(sql_engine, 40)
+    memory_engine = make_engine(clean_db, MemoryIndex(NoteIndex(clean_db)))
+
+    for query in ["alpha", "beta gamma", "zeta zeta kappa", "missing"]:
+        assert_same_ranking(sql_engine.lexical_search(query), memory_engine.lexical_search(query))
+
+def test_memory_index_follows_updates_and_removals(clean_db):
+    memory_index = MemoryIndex(NoteIndex(clean_db), compaction_ratio=0.1)
+    engine = make_engine(clean_db, memory_index)
+    note_ids = add_notes(engine, 30)
+
+    for note_id in note_ids[:5]:
+        engine.remove_from_index(note_id)
+        engine.lexical_index.delete_note_from_lexical_search(note_id)
+    engine.notes_repo.update_note(note_ids[5], contents="omega omega omega")
+    engine.update_index(note_ids[5])
+    note = engine.notes_repo.get_note(note_ids[5])
+    engine.lexical_index.delete_note_from_lexical_search(note_ids[5])
+    engine.lexical_index.index_note_for_lexical_search(note_ids[5], note["title"], note["contents"])
+
+    results = dict(engine.lexical_search("alpha omega"))
+    assert not set(note_ids[:5]) & set(results)
+    assert note_ids[5] in results
+    # Removing a sixth of the notes crossed the compaction ratio.
+    assert memory_index.tombstones < 6
+
+    sql_engine = make_engine(clean_db)
+    assert_same_ranking(sql_engine.lexical_search("alpha omega"), engine.lexical_search("alpha omega"))
+
+def test_compaction_keeps_results(clean_db):
+    memory_index = MemoryIndex(NoteIndex(clean_db), compaction_ratio=1.0)
+    engine = make_engine(clean_db, memory_index)
+    note_ids = add_notes(engine, 20)
+    engine.remove_from_index(note_ids[0])
+    before = engine.lexical_search("alpha beta")
+
+    memory_index.compact()
+
+    assert memory_index.tombstones == 0
+    assert len(memory_index.doc_to_uuid) == 19
+    assert engine.lexical_search("alpha beta") == pytest.approx(before)
+
+def test_top_k_matches_full_ranking(clean_db):
+    memory_index = MemoryIndex(NoteIndex(clean_db), compaction_ratio=1.0)
+    engine = make_engine(clean_db, memory_index)
+    rng = random.Random(1)
+    vocabulary = WORDS + [f"rare{i}" for i in range(200)]
+    documents = []
+    for number in range(400):
+        # "common" is in almost every note, so its idf is negative.
+        tokens = rng.choices(vocabulary, k=rng.randint(5, 40)) + ["common"] * rng.randint(0, 3)
+        documents.append((f"note{number}", engine.tokenizer.count(tokens)))
+    memory_index.add_documents(documents)
+    for number in range(0, 400, 7):
+        memory_index.remove_document(f"note{number}")
+
+    for query in ["alpha rare3", "common alpha beta rare10 rare11", "rare5 rare6 rare7", "common", "gamma gamma delta"]:
+        full = engine.lexical_search(query)
+        for k in (1, 5, 20):
+            top = engine.lexical_search(query, k=k)
+            assert len(top) == min(k, len(full))
+            assert [score for _, score in top] == pytest.approx([score for _, score in full[:k]])
+            assert [note_id for note_id, _ in top] == [note_id for note_id, _ in full[:k]]
+
+def test_sql_top_k_matches_full_ranking(clean_db):
+    engine = make_engine(clean_db)
+    add_notes(engine, 30)
+
+    full = engine.lexical_search("alpha beta gamma")
+    assert engine.lexical_search("alpha beta gamma", k=3) == full[:3]
+
+def test_sql_top_k_prunes_common_terms(clean_db):
+    engine = make_engine(clean_db)
+    rng = random.Random(2)
+    for number in range(120):
+        rare = [f"rare{number % 40}"] * rng.randint(1, 3)
+        contents = " ".join(rng.choices(WORDS, k=rng.randint(3, 10)) + rare)
+        note_id = engine.notes_repo.create_note(f"note {number}", contents, None, "")
+        engine.index_note(note_id)
+
+    statements = []
+    execute = clean_db.execute
+    def traced(fn, args=(), **kwargs):
+        def _traced(connection, *fn_args):
+            raw = getattr(connection, "_connection", connection)
+            raw.set_trace_callback(statements.append)
+            try:
+                return fn(connection, *fn_args)
+            finally:
+                raw.set_trace_callback(None)
+        return execute(_traced, args, **kwargs)
+    clean_db.execute = traced
+
+    for query in ["rare3 alpha", "rare7 rare8 beta gamma", "alpha beta"]:
+        full = engine.lexical_search(query)
+        for k in (1, 3, 10):
+            top = engine.lexical_search(query, k=k)
+            assert [score for _, score in top] == pytest.approx([score for _, score in full[:k]])
+            assert set(dict(top)) <= {note_id for note_id, score in full if score >= full[min(k, len(full)) - 1][1] - 1e-9}
+
+    # The common words' postings were only probed for the rare words' notes.
+    assert any("doc_id IN" in statement for statement in statements)
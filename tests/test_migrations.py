@@ -0,0 +1,141 @@
+import pickle
+import pytest
+from note_index import NoteIndex
+from lexical_index import LexicalIndex
+from database_worker import DBWorker
+from migrations import MIGRATIONS, SchemaMigrator
+from notes_repository import NotesRepository
+from change_log_repository import ChangeLog
+from hashing import compute_note_hash
+from embedding_codec import decode_embedding, is_encoded
+
+@pytest.fixture
+def clean_db(tmp_path):
+    db_path = tmp_path / "test.db"
+    db = DBWorker(db_path=str(db_path))
+    yield db
+    db.shutdown()
+
+def list_objects(db_worker, object_type):
+    def _op(connection, object_type):
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = ?", (object_type,))
+        return {row[0] for row in cursor.fetchall()}
+    return db_worker.execute(_op, args=(object_type,), wait=True)
+
+def query_plan(db_worker, query, params):
+    def _op(connection):
+        cursor = connection.cursor()
+        cursor.execute(f"EXPLAIN QUERY PLAN {query}", params)
+        return " ".join(row["detail"] for row in cursor.fetchall())
+    return db_worker.execute(_op, wait=True)
+
+def test_migrate_creates_schema(clean_db):
+    version = SchemaMigrator(clean_db).migrate()
+
+    assert version == MIGRATIONS[-1][0]
+    tables = list_objects(clean_db, "table")
+    assert {"notes", "terms", "postings", "note_stats", "lexical", "change_log", "last_sync", "last_lamport_sync", "embedding_cache", "schema_version"} <= tables
+    assert "tokens" not in tables
+    indexes = list_objects(clean_db, "index")
+    assert {"postings_doc_idx", "change_log_lamport_idx", "change_log_note_idx"} <= indexes
+
+def test_migrate_is_idempotent(clean_db):
+    migrator = SchemaMigrator(clean_db)
+    first = migrator.migrate()
+    second = migrator.migrate()
+
+    assert first == second == migrator.current_version()
+
+def test_migrate_upgrades_unversioned_database(clean_db):
+    notes_db = NotesRepository(clean_db)
+    notes_db.create_notes_table()
+    note_index = NoteIndex(clean_db)
+    note_index.create_word_index_table()
+    ChangeLog(clean_db, "DEVICE").create_change_log_table()
+    note_id = notes_db.create_note("Title", "Body", None, "tag1")
+    note_index.insert_many_tokens([(note_id, "title", 1)])
+
+    assert SchemaMigrator(clean_db).current_version() == 0
+    SchemaMigrator(clean_db).migrate()
+
+    assert notes_db.get_note(note_id)["title"] == "Title"
+    assert note_index.retrieve_similar_tokens("title")[0]["note_id"] == note_id
+
+def test_bm25_statistics_are_backfilled(clean_db):
+    SchemaMigrator(clean_db, MIGRATIONS[:4]).migrate()
+    def _op(connection):
+        connection.executemany("INSERT INTO tokens (note_id, token, count) VALUES (?, ?, ?)",
+                               [("A", "foo", 2), ("A", "bar", 1), ("B", "foo", 3)])
+    clean_db.execute(_op, wait=True)
+
+    SchemaMigrator(clean_db).migrate()
+
+    note_index = NoteIndex(clean_db)
+    assert note_index.retrieve_collection_stats() == (2, 6)
+    assert note_index.retrieve_note_length("A") == 3
+    assert note_index.retrieve_agerage_document_length() == 3.0
+    assert note_index.retrieve_document_frequency("foo") == 2
+    assert note_index.retrieve_term_frequency_in_document("B", "foo") == 3
+
+def test_lexical_index_is_rebuilt_with_tags(clean_db):
+    SchemaMigrator(clean_db, MIGRATIONS[:5]).migrate()
+    note_id = "a"
+    # Written with raw SQL, the repository targets the latest notes schema.
+    def _op(connection, note_id):
+        connection.execute("INSERT INTO notes (uuid, title, contents, tags) VALUES (?, ?, ?, ?)", (note_id, "Title", "Body", "gardening,home"))
+        connection.execute("INSERT INTO lexical (note_id, title, contents) VALUES (?, ?, ?)", (note_id, "Title", "Body"))
+        connection.commit()
+    clean_db.execute(_op, args=(note_id,), wait=True)
+
+    SchemaMigrator(clean_db).migrate()
+
+    lexical_index = LexicalIndex(clean_db)
+    assert lexical_index.get_note_from_lexical_index(note_id)["tags"] == "gardening,home"
+    assert lexical_index.ranked_search(["gardening"])[0][0] == note_id
+    assert lexical_index.ranked_search([note_id]) == []
+
+def test_notes_without_embeddings_are_marked_pending(clean_db):
+    SchemaMigrator(clean_db, MIGRATIONS[:7]).migrate()
+    def _op(connection):
+        connection.execute("INSERT INTO notes (uuid, title, contents, tags) VALUES ('a', 'Title', 'Body', '')")
+        connection.execute("INSERT INTO notes (uuid, title, contents, tags) VALUES ('b', 'Title', 'Body', '')")
+        connection.execute("INSERT INTO note_embeddings (note_id, embedding) VALUES ('b', x'00')")
+        connection.commit()
+    clean_db.execute(_op, wait=True)
+
+    SchemaMigrator(clean_db).migrate()
+
+    assert NotesRepository(clean_db).list_pending_embeddings() == ["a"]
+
+def test_token_lookups_use_indexes(clean_db):
+    SchemaMigrator(clean_db).migrate()
+
+    plan = query_plan(clean_db, "SELECT doc_id, count FROM postings WHERE term_id = ?", (1,))
+    assert "PRIMARY KEY" in plan
+    plan = query_plan(clean_db, "SELECT term_id, count FROM postings WHERE doc_id = ?", (1,))
+    assert "COVERING INDEX postings_doc_idx" in plan
+
+    plan = query_plan(clean_db, "SELECT * FROM change_log WHERE lamport_clock > ? ORDER BY lamport_clock ASC", (0,))
+    assert "change_log_lamport_idx" in plan
+
+def test_migrate_converts_pickled_embeddings(clean_db):
+    # A database as written before embeddings were versioned.
+    SchemaMigrator(clean_db, MIGRATIONS[:1]).migrate()
+    legacy = pickle.dumps([0.5, 0.25])
+    old_hash = compute_note_hash("Title", "Body", "tag1", legacy, 0)
+
+    def _op(connection):
+        connection.execute("INSERT INTO notes (uuid, title, contents, embeddings, tags, note_hash) VALUES ('a', 'Title', 'Body', ?, 'tag1', ?)",
+                           (legacy, old_hash))
+        connection.commit()
+    clean_db.execute(_op, wait=True)
+
+    SchemaMigrator(clean_db).migrate()
+
+    notes_db = NotesRepository(clean_db)
+    embedding = notes_db.get_note_embedding("a")
+    assert is_encoded(embedding)
+    assert list(decode_embedding(embedding)) == [0.5, 0.25]
+    assert notes_db.get_note("a")["note_hash"] == old_hash
+    assert "embeddings" not in notes_db.get_note("a").keys()
@@ -0,0 +1,72 @@
+import pytest
+from faiss_engine import Faiss
+from tokenizer import Tokenizer
+from note_index import NoteIndex
+from database_worker import DBWorker
+from migrations import SchemaMigrator
+from lamport_clock import LamportClock
+from search_engine import SearchEngine
+from lexical_index import LexicalIndex
+from note_importer import NoteImporter
+from change_log_repository import ChangeLog
+from notes_repository import NotesRepository
+
+@pytest.fixture
+def clean_db(tmp_path):
+    db_path = tmp_path / "test.db"
+    db = DBWorker(db_path=str(db_path))
+    SchemaMigrator(db).migrate()
+    yield db
+    db.shutdown()
+
+@pytest.fixture
+def emb_prov():
+    class MockEmbeddingProvider():
+        def is_available(self):
+            return True
+
+        def embed(self, text):
+            return {"embedding": [float(len(text))] * 8}
+
+        def embed_many(self, texts):
+            return [self.embed(text)["embedding"] for text in texts]
+    return MockEmbeddingProvider()
+
+@pytest.fixture
+def importer(clean_db, emb_prov):
+    lamport_clock = LamportClock(clean_db)
+    lamport_clock.initialize_lamport_clock()
+    nr = NotesRepository(clean_db)
+    ni = NoteIndex(clean_db)
+    li = LexicalIndex(clean_db)
+    fe = Faiss(emb_prov, nr)
+    se = SearchEngine(nr, ni, li, fe, emb_prov, Tokenizer())
+    cl = ChangeLog(clean_db, "DEVICE")
+    return NoteImporter(clean_db, "DEVICE", nr, se, li, fe, emb_prov, cl, lamport_clock)
+
+def test_import_notes_fills_every_index(importer):
+    notes = [(f"title {i}", f"some contents number{i}", "tag") for i in range(25)]
+    note_ids = importer.import_notes(notes, batch_size=10)
+
+    assert len(note_ids) == 25
+    assert importer.note_service.notes_repo.get_number_of_non_deleted_notes() == 25
+    assert len(importer.note_service.search_engine.notes_index.retrieve_similar_tokens("contents")) == 25
+    assert len(importer.note_service.lexical_index.search_lexical_index("number7")) == 1
+    assert importer.note_service.faiss_engine.faiss_to_uuid == note_ids
+    assert importer.note_service.faiss_engine.embedding_database.ntotal == 25
+
+def test_import_notes_logs_consecutive_lamport_times(importer):
+    note_ids = importer.import_notes([("a", "b", "c"), ("d", "e", "f")])
+
+    operations = importer.note_service.change_log.get_operation_since_lamport(0)
+    assert [op["note_id"] for op in operations] == note_ids
+    assert [op["lamport_clock"] for op in operations] == [1, 2]
+    assert importer.note_service.lamport_clock.now() == 2
+
+def test_import_commits_once_per_batch(importer):
+    def transactions():
+        return importer.note_service.db_worker.stats()["operations"]["DBWorker.transaction"]["count"]
+
+    before = transactions()
+    importer.import_notes([(f"title {i}", "body", "tag") for i in range(30)], batch_size=10)
+    assert transactions() - before == 3
@@ -19,3 +19,65 @@ def test_insert_token(clean_db):
     assert tokens is not None
     assert len(tokens) == 1
     
+
+def test_statistics_follow_token_writes(clean_db):
+    n_index = NoteIndex(clean_db)
+    n_index.create_word_index_table()
+
+    n_index.insert_many_tokens([("A", "foo", 2), ("A", "bar", 1), ("B", "foo", 1)])
+    n_index.insert_token("B", "baz", 4)
+
+    assert n_index.retrieve_collection_stats() == (2, 8)
+    assert n_index.retrieve_note_length("A") == 3
+    assert n_index.retrieve_note_length("B") == 5
+    assert n_index.retrieve_agerage_document_length() == 4.0
+
+    n_index.delete_tokens_for_note("A")
+
+    assert n_index.retrieve_collection_stats() == (1, 5)
+    assert n_index.retrieve_note_length("A") == 0
+
+    n_index.delete_tokens_for_note("A")
+    assert n_index.retrieve_collection_stats() == (1, 5)
+
+def test_term_dictionary_tracks_document_frequency(clean_db):
+    n_index = NoteIndex(clean_db)
+    n_index.create_word_index_table()
+
+    n_index.insert_many_tokens([("A", "foo", 2), ("A", "bar", 1), ("B", "foo", 1)])
+    n_index.insert_many_tokens([("A", "foo", 1)])
+
+    assert n_index.retrieve_document_frequency("foo") == 2
+    assert n_index.retrieve_document_frequency("bar") == 1
+    assert n_index.retrieve_term_frequency_in_document("A", "foo") == 3
+    assert sorted((row["note_id"], row["count"]) for row in n_index.retrieve_similar_tokens("foo")) == [("A", 3), ("B", 1)]
+    assert [(row["note_id"], row["token"]) for row in n_index.iter_tokens(batch_size=1)] == \
+        [("A", "foo"), ("A", "bar"), ("B", "foo")]
+
+    n_index.delete_tokens_for_note("A")
+
+    assert n_index.retrieve_document_frequency("foo") == 1
+    assert n_index.retrieve_document_frequency("bar") == 0
+    assert n_index.retrieve_term_frequency_in_document("A", "foo") == 0
+
+def test_update_tokens_for_note_writes_only_the_difference(clean_db):
+    n_index = NoteIndex(clean_db)
+    n_index.create_word_index_table()
+    original = {f"word{i}": 1 for i in range(100)}
+    n_index.insert_many_tokens([("A", token, count) for token, count in original.items()])
+    n_index.insert_many_tokens([("B", "word1", 1)])
+
+    edited = dict(original)
+    del edited["word1"]
+    edited["word2"] = 3
+    edited["new"] = 1
+    written = n_index.update_tokens_for_note("A", edited)
+
+    assert written == 3
+    assert n_index.retrieve_term_frequency_in_document("A", "word2") == 3
+    assert n_index.retrieve_term_frequency_in_document("A", "word1") == 0
+    assert n_index.retrieve_document_frequency("word1") == 1
+    assert n_index.retrieve_document_frequency("new") == 1
+    assert n_index.retrieve_note_length("A") == sum(edited.values())
+    assert n_index.retrieve_collection_stats() == (2, sum(edited.values()) + 1)
+    assert n_index.update_tokens_for_note("A", edited) == 0
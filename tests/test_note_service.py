@@ -0,0 +1,191 @@
+import pytest
+from faiss_engine import Faiss
+from tokenizer import Tokenizer
+from note_index import NoteIndex
+from memory_index import MemoryIndex
+from database_worker import DBWorker
+from migrations import SchemaMigrator
+from lamport_clock import LamportClock
+from search_engine import SearchEngine
+from lexical_index import LexicalIndex
+from note_service import NoteService
+from change_log_repository import ChangeLog
+from notes_repository import NotesRepository
+
+@pytest.fixture
+def clean_db(tmp_path):
+    db_path = tmp_path / "test.db"
+    db = DBWorker(db_path=str(db_path))
+    SchemaMigrator(db).migrate()
+    yield db
+    db.shutdown()
+
+@pytest.fixture
+def emb_prov():
+    class MockEmbeddingProvider():
+        def is_available(self):
+            return True
+
+        def embed(self, text):
+            return {"embedding": [float(len(text))] * 8}
+
+        def embed_many(self, texts):
+            return [self.embed(text)["embedding"] for text in texts]
+    return MockEmbeddingProvider()
+
+@pytest.fixture
+def service(clean_db, emb_prov):
+    lamport_clock = LamportClock(clean_db)
+    lamport_clock.initialize_lamport_clock()
+    nr = NotesRepository(clean_db)
+    ni = NoteIndex(clean_db)
+    li = LexicalIndex(clean_db)
+    fe = Faiss(emb_prov, nr)
+    se = SearchEngine(nr, ni, li, fe, emb_prov, Tokenizer(), MemoryIndex(ni))
+    cl = ChangeLog(clean_db, "DEVICE")
+    return NoteService(clean_db, "DEVICE", nr, se, li, fe, emb_prov, cl, lamport_clock)
+
+def transactions(service):
+    return service.db_worker.stats()["operations"]["DBWorker.transaction"]["count"]
+
+def test_create_note_reaches_every_index_in_one_transaction(service):
+    before = transactions(service)
+    note_id = service.create_note("apple", "banana cherry", "fruit")
+
+    assert service.notes_repo.get_note(note_id)["title"] == "apple"
+    assert [row["note_id"] for row in service.search_engine.notes_index.retrieve_similar_tokens("banana")] == [note_id]
+    assert service.search_engine.lexical_search("banana")[0][0] == note_id
+    assert service.lexical_index.search_lexical_index("cherry")[0]["note_id"] == note_id
+    assert service.faiss_engine.faiss_to_uuid == [note_id]
+    assert [op["operation_type"] for op in service.change_log.get_operation_since_lamport(0)] == ["create"]
+    assert transactions(service) - before == 1
+
+def test_update_note_writes_only_changes(service):
+    note_id = service.create_note("apple", "banana", "fruit")
+
+    assert service.update_note(note_id, title="apple", contents="kiwi") == {"contents": "kiwi"}
+    assert service.update_note(note_id, title="apple") == {}
+    assert service.update_note("missing", title="x") is None
+
+    assert service.search_engine.lexical_search("banana") == []
+    assert service.search_engine.lexical_search("kiwi")[0][0] == note_id
+    assert service.lexical_index.get_note_from_lexical_index(note_id)["contents"] == "kiwi"
+    operations = service.change_log.get_operation_since_lamport(0)
+    assert [op["operation_type"] for op in operations] == ["create", "update"]
+    assert [op["lamport_clock"] for op in operations] == [1, 2]
+
+def test_delete_notes_in_one_transaction(service):
+    note_ids = service.create_notes([("apple", "banana", ""), ("cherry", "banana", "")])
+    before = transactions(service)
+
+    service.delete_notes(note_ids)
+
+    assert transactions(service) - before == 1
+    assert service.notes_repo.get_number_of_non_deleted_notes() == 0
+    assert service.search_engine.lexical_search("banana") == []
+    assert service.lexical_index.search_lexical_index("banana") == []
+    assert service.faiss_engine.embedding_database.ntotal == 0
+    assert service.update_note(note_ids[0], title="pear") is None
+
+def test_failed_mutation_leaves_no_partial_state(service, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError("lexical index unavailable")
+    monkeypatch.setattr(service.lexical_index, "index_notes_for_lexical_search", fail)
+
+    with pytest.raises(RuntimeError):
+        service.create_note("apple", "banana", "fruit")
+
+    assert service.notes_repo.get_number_of_non_deleted_notes() == 0
+    assert service.search_engine.notes_index.retrieve_similar_tokens("banana") == []
+    assert service.search_engine.lexical_search("banana") == []
+    assert service.change_log.get_operation_since_lamport(0) == []
+    assert service.faiss_engine.faiss_to_uuid == []
+    assert service.lamport_clock.now() == 0
+
+def test_failed_update_rolls_back_the_lamport_clock(service, monkeypatch):
+    note_id = service.create_note("apple", "banana", "fruit")
+    before = service.lamport_clock.now()
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("lexical index unavailable")
+    monkeypatch.setattr(service.lexical_index, "update_note_for_lexical_search", fail)
+
+    with pytest.raises(RuntimeError):
+        service.update_note(note_id, title="pear")
+    with pytest.raises(RuntimeError):
+        service.apply_remote_update(note_id, {"title": "plum"}, 50, "PEER", "op-1")
+
+    assert service.lamport_clock.now() == before
+
+def test_remote_operations_keep_the_peer_ids(service):
+    payload = {"title": "apple", "contents": "banana", "tags": "", "created_at": "2020", "last_updated": "2020"}
+    service.apply_remote_create("remote-1", payload, 10, "PEER", "op-1")
+    service.apply_remote_update("remote-1", {"title": "pear"}, 12, "PEER", "op-2")
+
+    assert service.notes_repo.get_note("remote-1")["title"] == "pear"
+    assert service.search_engine.lexical_search("pear")[0][0] == "remote-1"
+    operations = service.change_log.get_operation_since_lamport(0)
+    assert [op["op_id"] for op in operations] == ["op-1", "op-2"]
+    assert [op["origin_device"] for op in operations] == ["PEER", "PEER"]
+    assert service.lamport_clock.now() == 13
+
+def remote(op_id, note_id, operation_type, payload, lamport_time):
+    return {"op_id": op_id, "note_id": note_id, "operation_type": operation_type,
+            "payload": payload, "lamport_clock": lamport_time}
+
+def test_remote_batch_is_applied_in_one_transaction(service):
+    payload = {"title": "apple", "contents": "banana", "tags": "", "created_at": "2020", "last_updated": "2020"}
+    before = transactions(service)
+
+    applied = service.apply_remote_operations([remote("op-1", "remote-1", "create", payload, 10),
+                                               remote("op-2", "remote-1", "update", {"title": "pear"}, 11),
+                                               remote("op-3", "missing", "delete", {"deleted": 1}, 12),
+                                               remote("op-4", "remote-2", "create", dict(payload, title="plum"), 13)], "PEER")
+
+    assert applied == 3
+    assert transactions(service) == before + 1
+    assert service.notes_repo.get_note("remote-1")["title"] == "pear"
+    assert sorted(service.faiss_engine.faiss_to_uuid) == ["remote-1", "remote-2"]
+    assert service.lamport_clock.now() == 14
+
+def test_failed_remote_batch_leaves_no_partial_state(service, monkeypatch):
+    payload = {"title": "apple", "contents": "banana", "tags": "", "created_at": "2020", "last_updated": "2020"}
+    def fail(*args, **kwargs):
+        raise RuntimeError("lexical index unavailable")
+    monkeypatch.setattr(service.lexical_index, "update_note_for_lexical_search", fail)
+
+    with pytest.raises(RuntimeError):
+        service.apply_remote_operations([remote("op-1", "remote-1", "create", payload, 10),
+                                         remote("op-2", "remote-1", "update", {"title": "pear"}, 11)], "PEER")
+
+    assert service.notes_repo.get_note("remote-1") is None
+    assert service.change_log.get_operation_since_lamport(0) == []
+    assert service.lamport_clock.now() == 0
+
+def test_update_reads_the_notes_inside_its_transaction(service, monkeypatch):
+    note_id = service.create_note("apple", "banana", "fruit")
+    get_notes = service.notes_repo.get_notes
+    in_transaction = []
+    def spy(*args, **kwargs):
+        in_transaction.append(getattr(service.db_worker._local, "tx_queue", None) is not None)
+        return get_notes(*args, **kwargs)
+    monkeypatch.setattr(service.notes_repo, "get_notes", spy)
+
+    service.update_note(note_id, title="pear")
+
+    # Once to embed the new text, then again for the write.
+    assert in_transaction == [False, True]
+
+def test_notes_from_a_failed_embedding_batch_are_left_pending(service, monkeypatch):
+    embed_many = service.embedding_provider.embed_many
+    monkeypatch.setattr(service.embedding_provider, "embed_many",
+                        lambda texts: [None if "kiwi" in text else vector for text, vector in zip(texts, embed_many(texts))])
+
+    apple, kiwi = service.create_notes([("apple", "banana", ""), ("kiwi", "lime", "")])
+
+    assert service.faiss_engine.faiss_to_uuid == [apple]
+    assert service.notes_repo.list_pending_embeddings() == [kiwi]
+
+    service.update_note(apple, contents="kiwi")
+    assert service.faiss_engine.faiss_to_uuid == []
+    assert service.notes_repo.list_pending_embeddings() == [apple, kiwi]
@@ -81,3 +81,80 @@ def test_update_note(clean_db, fake_embedding):
     note = notes_db.get_note(note_id)
     assert note is not None
     assert note[1] == "New Title"
+
+def test_get_notes_keeps_order_and_missing(clean_db, fake_embedding):
+    notes_db = NotesRepository(clean_db)
+    notes_db.create_notes_table()
+
+    first = notes_db.create_note("First", "Body", pickle.dumps(fake_embedding['embedding']), "tag1")
+    second = notes_db.create_note("Second", "Body", pickle.dumps(fake_embedding['embedding']), "tag1")
+
+    notes = notes_db.get_notes([second, "missing", first])
+    assert notes[0]['title'] == "Second"
+    assert notes[1] is None
+    assert notes[2]['title'] == "First"
+
+def test_get_notes_runs_one_query(clean_db, fake_embedding):
+    notes_db = NotesRepository(clean_db)
+    notes_db.create_notes_table()
+    note_id = notes_db.create_note("Title", "Body", pickle.dumps(fake_embedding['embedding']), "tag1")
+
+    notes = notes_db.get_notes([note_id, "missing", note_id], fields=("title",))
+
+    assert [note and note['title'] for note in notes] == ["Title", None, "Title"]
+    assert clean_db.stats()["operations"]["NotesRepository.get_notes"]["count"] == 1
+
+def test_get_note_with_fields(clean_db, fake_embedding):
+    notes_db = NotesRepository(clean_db)
+    notes_db.create_notes_table()
+    note_id = notes_db.create_note("Title", "Body", pickle.dumps(fake_embedding['embedding']), "tag1")
+
+    note = notes_db.get_note(note_id, fields=("uuid", "title"))
+    assert note.keys() == ["uuid", "title"]
+
+    with pytest.raises(ValueError):
+        notes_db.get_note(note_id, fields=("embeddings",))
+
+def test_embeddings_are_stored_apart(clean_db, fake_embedding):
+    notes_db = NotesRepository(clean_db)
+    notes_db.create_notes_table()
+    embeddings = pickle.dumps(fake_embedding['embedding'])
+    note_id = notes_db.create_note("Title", "Body", embeddings, "tag1")
+    deleted_id = notes_db.create_note("Title", "Body", embeddings, "tag1")
+    notes_db.mark_note_as_deleted(deleted_id)
+
+    assert "embeddings" not in notes_db.get_note(note_id).keys()
+    assert notes_db.get_note_embedding(note_id) == embeddings
+    assert [row["uuid"] for row in notes_db.list_embeddings()] == [note_id]
+
+def test_update_note_refreshes_hash(clean_db, fake_embedding):
+    notes_db = NotesRepository(clean_db)
+    notes_db.create_notes_table()
+    note_id = notes_db.create_note("Title", "Body", pickle.dumps(fake_embedding['embedding']), "tag1")
+    old_hash = notes_db.get_note(note_id)["note_hash"]
+
+    notes_db.update_note(note_id, title="New Title")
+
+    assert notes_db.get_note(note_id)["note_hash"] != old_hash
+
+def test_iter_notes_streams_every_batch(clean_db):
+    notes_db = NotesRepository(clean_db)
+    notes_db.create_notes_table()
+    note_ids = [notes_db.create_note(f"Title {i}", "Body", None, "tag1") for i in range(7)]
+    notes_db.mark_note_as_deleted(note_ids[3])
+
+    notes = list(notes_db.iter_notes(batch_size=2, fields=("uuid",)))
+    assert [note["uuid"] for note in notes] == note_ids[:3] + note_ids[4:]
+
+    notes = list(notes_db.iter_notes(batch_size=3, include_deleted=True))
+    assert len(notes) == 7
+
+def test_iter_embeddings_skips_deleted(clean_db, fake_embedding):
+    notes_db = NotesRepository(clean_db)
+    notes_db.create_notes_table()
+    embeddings = pickle.dumps(fake_embedding['embedding'])
+    note_ids = [notes_db.create_note("Title", "Body", embeddings, "tag1") for _ in range(5)]
+    notes_db.mark_note_as_deleted(note_ids[0])
+
+    rows = list(notes_db.iter_embeddings(batch_size=2))
+    assert [row["uuid"] for row in rows] == note_ids[1:]
@@ -0,0 +1,52 @@
+from query_cache import QueryCache, normalize_query, estimate_size
+
+def test_normalize_query():
+    assert normalize_query("  Hello\tWORLD \n") == "hello world"
+
+def test_get_and_put():
+    cache = QueryCache()
+    assert cache.get("q") is None
+
+    cache.put("q", [("A", 1.0)], cache.generation)
+    results = cache.get("q")
+    results.append(("B", 0.5))
+
+    assert cache.get("q") == [("A", 1.0)]
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["misses"] == 1
+
+def test_least_recently_used_entry_is_evicted():
+    cache = QueryCache(max_entries=2)
+    cache.put("a", [("A", 1.0)], 0)
+    cache.put("b", [("B", 1.0)], 0)
+    cache.get("a")
+    cache.put("c", [("C", 1.0)], 0)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == [("A", 1.0)]
+    assert cache.stats()["evictions"] == 1
+
+def test_memory_bound():
+    results = [(f"note{i}", float(i)) for i in range(100)]
+    cache = QueryCache(max_bytes=estimate_size(results) * 2)
+    for query in "abc":
+        cache.put(query, results, 0)
+
+    stats = cache.stats()
+    assert stats["entries"] == 2
+    assert stats["bytes"] <= cache.max_bytes
+    cache.put("huge", results * 10, 0)
+    assert cache.get("huge") is None
+
+def test_invalidate_drops_entries_and_stale_results():
+    cache = QueryCache()
+    cache.put("q", [("A", 1.0)], cache.generation)
+    generation = cache.generation
+
+    cache.invalidate()
+    # Results computed before the invalidation are not stored.
+    cache.put("late", [("A", 1.0)], generation)
+
+    assert cache.get("q") is None
+    assert cache.get("late") is None
+    assert cache.stats()["generation"] == generation + 1
@@ -1,4 +1,5 @@
 import time
+import threading
 import pytest
 import random
 import ollama
@@ -8,7 +9,9 @@ from unittest.mock import Mock
 from notes_repository import NotesRepository
 from embedding_provider import EmbeddingProvider
 from lexical_index import LexicalIndex
+import search_engine
 from search_engine import SearchEngine
+from query_cache import QueryCache
 from database_worker import DBWorker
 from note_index import NoteIndex
 from tokenizer import Tokenizer
@@ -36,6 +39,9 @@ def emb_prov(fake_embedding):
         def __init__(self, embedding):
             self.embedding = embedding
 
+        def is_available(self):
+            return True
+
         def embed(self, text):
             return self.embedding
     return MockEmbeddingProvider(fake_embedding)
@@ -73,6 +79,22 @@ def make_engine():
     tokenizer = Mock()
     return SearchEngine(notes_repo, notes_index, lexical_index, faiss_engine, emb_prov, tokenizer), notes_repo, notes_index, lexical_index, faiss_engine, emb_prov, tokenizer
 
+def test_long_notes_are_tokenized_in_chunks(monkeypatch):
+    monkeypatch.setattr(search_engine, "STREAMING_TOKENIZE_CHARS", 20)
+    engine, repo, index, *_ = make_engine()
+    engine.tokenizer = Tokenizer()
+    streamed = []
+    iter_tokens = engine.tokenizer.iter_tokens
+    monkeypatch.setattr(engine.tokenizer, "iter_tokens", lambda text: streamed.append(text) or iter_tokens(text, 8))
+
+    engine.index_notes([{"uuid": "A", "title": "short", "contents": "", "tags": ""},
+                        {"uuid": "B", "title": "garden", "contents": "garden tools and seeds", "tags": "home"}])
+
+    assert streamed == ["garden garden tools and seeds home"]
+    rows = index.insert_many_tokens.call_args.args[0]
+    assert ("A", "short", 1) in rows
+    assert ("B", "garden", 2) in rows and ("B", "seeds", 1) in rows
+
 def test_search_returns_sorted_results():
     engine, repo, index, l_index, faiss_engine, emb_prov, tokenizer = make_engine()
 
@@ -135,3 +157,129 @@ def test_search_tokenizes_query_once():
     engine.search("anything")
 
     tokenizer.tokenize.assert_called_once_with("anything")
+
+def test_hybrid_search_can_use_fts5_ranking():
+    engine, repo, index, l_index, faiss_engine, emb_prov, tokenizer = make_engine()
+
+    tokenizer.tokenize.return_value = ["garden"]
+    l_index.ranked_search.return_value = [("A", 3.0), ("B", 1.0)]
+    engine.semantic_search = Mock(return_value=[("B", 0.1), ("C", 0.9)])
+
+    result = dict(engine.hybrid_search("garden", lexical_engine="fts5"))
+
+    l_index.ranked_search.assert_called_once_with(["garden"], None)
+    index.retrieve_bm25_postings.assert_not_called()
+    assert set(result) == {"A", "B", "C"}
+
+def test_hybrid_search_passes_k_to_the_lexical_leg():
+    engine, repo, index, l_index, faiss_engine, emb_prov, tokenizer = make_engine()
+    engine.memory_index = Mock()
+    engine.memory_index.search.return_value = [("A", 3.0), ("B", 1.0)]
+    tokenizer.tokenize.return_value = ["garden"]
+    engine.semantic_search = Mock(return_value=[("B", 0.1)])
+
+    engine.hybrid_search("garden", k=3)
+    assert engine.memory_index.search.call_args.args[3] == 3
+
+    l_index.ranked_search.return_value = [("A", 3.0)]
+    engine.hybrid_search("garden", lexical_engine="fts5", k=3)
+    l_index.ranked_search.assert_called_once_with(["garden"], 3)
+    engine.shutdown()
+
+def test_hybrid_search_rejects_unknown_engine():
+    engine, *_ = make_engine()
+
+    with pytest.raises(ValueError):
+        engine.hybrid_search("garden", lexical_engine="grep")
+
+def test_hybrid_search_uses_query_cache():
+    engine, repo, index, l_index, faiss_engine, emb_prov, tokenizer = make_engine()
+    engine.query_cache = QueryCache()
+    engine.lexical_search = Mock(return_value=[("A", 2.0), ("B", 1.0)])
+    engine.semantic_search = Mock(return_value=[("A", 0.1)])
+
+    first = engine.hybrid_search("Garden  tools", k=1)
+    second = engine.hybrid_search("garden tools", k=1)
+
+    assert first == second == [("A", 1.0)]
+    assert engine.lexical_search.call_count == 1
+    assert engine.hybrid_search("garden tools", k=2) != first
+
+    engine.invalidate_cache()
+    engine.hybrid_search("garden tools", k=1)
+    assert engine.lexical_search.call_count == 3
+
+def test_hybrid_search_runs_both_legs_concurrently():
+    engine, *_ = make_engine()
+
+    def slow(results):
+        def leg(query, k=None):
+            time.sleep(0.2)
+            return results
+        return leg
+    engine.lexical_search = slow([("A", 2.0)])
+    engine.semantic_search = slow([("B", 0.1)])
+
+    start = time.perf_counter()
+    result = engine.hybrid_search("garden")
+    elapsed = time.perf_counter() - start
+
+    assert {note_id for note_id, _ in result} == {"A", "B"}
+    assert elapsed < 0.35
+    engine.shutdown()
+
+def test_hybrid_search_drops_semantic_leg_after_deadline():
+    engine, *_ = make_engine()
+    engine.query_cache = QueryCache()
+    engine.lexical_search = Mock(return_value=[("A", 2.0)])
+
+    def slow_semantic(query):
+        time.sleep(0.3)
+        return [("B", 0.1)]
+    engine.semantic_search = slow_semantic
+
+    results = engine.hybrid_search("garden", deadline_ms=50)
+    assert results == [("A", 0.5)]
+    assert results.partial
+    # Results missing a leg are not cached.
+    assert engine.query_cache.stats()["entries"] == 0
+    engine.shutdown()
+
+def test_hybrid_search_skips_semantic_leg_while_search_threads_are_busy():
+    engine, *_ = make_engine()
+    engine.search_workers = 1
+    engine.lexical_search = Mock(return_value=[("A", 2.0)])
+    release = threading.Event()
+    calls = []
+
+    def stuck_semantic(query):
+        calls.append(query)
+        release.wait(5)
+        return [("B", 0.1)]
+    engine.semantic_search = stuck_semantic
+
+    assert engine.hybrid_search("garden", deadline_ms=20).partial
+    # The first leg still holds the only thread, so no second one is queued.
+    assert engine.hybrid_search("flowers", deadline_ms=20).partial
+    assert calls == ["garden"]
+
+    release.set()
+    engine._executor.shutdown(wait=True)
+    assert engine._running_legs == 0
+    engine.shutdown()
+
+def test_hybrid_search_falls_back_to_lexical_results_when_embedding_fails():
+    engine, _, _, _, _, emb_prov, _ = make_engine()
+    engine.lexical_search = Mock(return_value=[("A", 2.0), ("B", 1.0)])
+    engine.semantic_search = Mock(side_effect=ConnectionError("ollama is not running"))
+
+    results = engine.hybrid_search("garden")
+    assert [note_id for note_id, _ in results] == ["A", "B"]
+    assert results.partial
+
+    # While the circuit breaker is open the semantic leg isn't attempted.
+    emb_prov.is_available.return_value = False
+    engine.semantic_search.reset_mock()
+    assert engine.hybrid_search("garden").partial
+    engine.semantic_search.assert_not_called()
+    engine.shutdown()
@@ -1,5 +1,6 @@
 import json
 import pytest
+from contextlib import contextmanager
 from unittest.mock import Mock
 from sync_manager import SyncManager
 
@@ -22,6 +23,10 @@ class FakeDBWorker:
         result = fn(FakeConn(), *(args or ()))
         return result
 
+    @contextmanager
+    def transaction(self):
+        yield
+
 class FakeNotesRepository:
     def __init__(self):
         self.notes = {}
@@ -58,6 +63,9 @@ class FakeNotesRepository:
     def get_note(self, uuid):
         return self.notes.get(uuid)
 
+    def get_notes(self, uuids):
+        return [self.notes.get(uuid) for uuid in uuids]
+
     def get_operations_since(self, ts):
         return []
 
@@ -102,11 +110,21 @@ class FakeChangeLog:
     def log_operation(self, note_id, op_type, payload, ts, origin, op_id):
         self.ops[op_id] = True
 
+    def log_operations(self, operations):
+        for note_id, op_type, payload, ts, origin, op_id in operations:
+            self.log_operation(note_id, op_type, payload, ts, origin, op_id)
+
 
 class FakeEmbeddings:
+    def is_available(self):
+        return True
+
     def embed(self, text):
         return {"embedding": [0.1, 0.2, 0.3]}
 
+    def embed_many(self, texts):
+        return [self.embed(text)["embedding"] for text in texts]
+
 def get_operation_since_lamport(self, lamport):
     return []
 
@@ -420,6 +438,7 @@ def test_sync_down_ignores_existing_operation(mocker):
 def test_sync_down_create_uses_remote_uuid(mocker):
     notes_repo = mocker.Mock()
     notes_repo.get_note.return_value = None
+    notes_repo.get_notes.side_effect = lambda note_ids: [None] * len(note_ids)
 
     change_log = mocker.Mock()
     change_log.check_operation_exists.return_value = 0
@@ -449,6 +468,7 @@ def test_sync_down_create_uses_remote_uuid(mocker):
 def test_sync_down_update_missing_note(mocker):
     notes_repo = mocker.Mock()
     notes_repo.get_note.return_value = None
+    notes_repo.get_notes.side_effect = lambda note_ids: [None] * len(note_ids)
 
     change_log = mocker.Mock()
     change_log.check_operation_exists.return_value = 0
@@ -477,6 +497,7 @@ def test_sync_down_advances_lamport(mocker):
 
     notes_repo = mocker.Mock()
     notes_repo.get_note.return_value = None
+    notes_repo.get_notes.side_effect = lambda note_ids: [None] * len(note_ids)
 
     sm, _ = make_sync_manager(
         mocker,
@@ -502,3 +523,87 @@ def test_sync_down_advances_lamport(mocker):
     sm.sync_down("peerA", msg)
 
     lamport.increment_lamport_time.assert_called_with(20)
+
+
+def test_update_from_remote_skips_reindex_when_nothing_changed():
+    sm, notes = make_sync_manager()
+    notes.insert_note("A", "Same", "Body", "2020", "2020", None, "")
+
+    message = [{
+        "op_id": "5",
+        "note_id": "A",
+        "lamport_clock": 10,
+        "operation_type": "update",
+        "payload": json.dumps({"title": "Same"})
+    }]
+
+    sm.sync_down("A", message)
+
+    sm.search_engine.update_index.assert_not_called()
+    sm.lexical_index.update_note_for_lexical_search.assert_not_called()
+    sm.faiss_engine.update_embedding.assert_not_called()
+
+
+def test_update_from_remote_reindexes_changed_fields_only():
+    sm, notes = make_sync_manager()
+    notes.insert_note("A", "Old", "Body", "2020", "2020", None, "")
+
+    message = [{
+        "op_id": "6",
+        "note_id": "A",
+        "lamport_clock": 10,
+        "operation_type": "update",
+        "payload": json.dumps({"title": "New", "contents": "Body"})
+    }]
+
+    sm.sync_down("A", message)
+
+    sm.search_engine.update_index.assert_called_once_with("A")
+    sm.lexical_index.update_note_for_lexical_search.assert_called_once_with("A", title="New")
+    sm.faiss_engine.update_embedding.assert_called_once()
+    sm.faiss_engine.add_embedding.assert_not_called()
+
+
+def test_sync_batch_is_embedded_in_one_call():
+    sm, notes = make_sync_manager()
+    notes.insert_note("A", "Old", "Body", "2020", "2020", None, "")
+    calls = []
+    embed_many = sm.embedding_provider.embed_many
+    sm.embedding_provider.embed_many = lambda texts: calls.append(list(texts)) or embed_many(texts)
+
+    def create(op_id, note_id, lamport):
+        return {"op_id": op_id, "note_id": note_id, "lamport_clock": lamport, "operation_type": "create",
+                "payload": json.dumps({"title": note_id, "contents": "c", "created_at": "t", "last_updated": "t", "tags": ""})}
+    message = [create("1", "B", 1), create("2", "C", 2),
+               {"op_id": "3", "note_id": "A", "lamport_clock": 3, "operation_type": "update",
+                "payload": json.dumps({"title": "New"})},
+               {"op_id": "4", "note_id": "B", "lamport_clock": 4, "operation_type": "update",
+                "payload": json.dumps({"contents": "d"})}]
+
+    sm.sync_down("peerA", message)
+
+    assert calls == [["B c ", "C c ", "New Body ", "B d "]]
+    assert notes.get_note("B")["contents"] == "d"
+    assert notes.get_note("A")["title"] == "New"
+    # B's final vector reaches FAISS once.
+    assert sm.faiss_engine.update_embedding.call_count == 3
+
+
+def test_sync_batch_is_applied_in_one_transaction():
+    class CountingDBWorker(FakeDBWorker):
+        transactions = 0
+
+        @contextmanager
+        def transaction(self):
+            CountingDBWorker.transactions += 1
+            yield
+
+    sm, notes = make_sync_manager(db_worker=CountingDBWorker())
+    message = [{"op_id": str(n), "note_id": f"N{n}", "lamport_clock": n, "operation_type": "create",
+                "payload": json.dumps({"title": "t", "contents": "c", "created_at": "t", "last_updated": "t", "tags": ""})}
+               for n in range(50)]
+
+    sm.sync_down("peerA", message)
+
+    assert len(notes.notes) == 50
+    assert CountingDBWorker.transactions == 1
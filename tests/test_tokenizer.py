@@ -0,0 +1,23 @@
+import io
+import random
+from tokenizer import Tokenizer
+
+def test_tokenize_normalizes_text():
+    tokens = Tokenizer().tokenize("Hello, World!\nNew\tline  a I'm")
+    assert tokens == ["hello", "world", "new", "line", "im"]
+
+def test_tokenize_many():
+    tokenizer = Tokenizer()
+    texts = ["First note.", "", "Second\nnote"]
+    assert tokenizer.tokenize_many(texts) == [tokenizer.tokenize(text) for text in texts]
+
+def test_iter_tokens_matches_tokenize_across_chunk_boundaries():
+    tokenizer = Tokenizer()
+    rng = random.Random(0)
+    words = ["alpha", "Beta,", "gam-ma", "x", "delta\n", "eps.", "\t", "zeta"]
+    text = " ".join(rng.choices(words, k=500))
+
+    for chunk_size in (1, 3, 7, 64, len(text) + 1):
+        assert list(tokenizer.iter_tokens(text, chunk_size)) == tokenizer.tokenize(text)
+    assert list(tokenizer.iter_tokens(io.StringIO(text))) == tokenizer.tokenize(text)
+    assert list(tokenizer.iter_tokens("")) == []